@@ -0,0 +1,73 @@
+"""
+Compares throughput of serving a LocalFileStorage file through
+the DEPOT _FileIter with sending it through its file descriptor
+like WSGI servers do when ``wsgi.file_wrapper`` supports sendfile.
+
+Usage: python benchmarks/serve_local.py [size_in_mb] [rounds]
+"""
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import threading
+
+from depot.io.local import LocalFileStorage
+from depot.middleware import _FileIter, _BLOCK_SIZE
+
+
+def drain(sock):
+    while sock.recv(1024 * 1024):
+        pass
+
+
+def serve_with_fileiter(stored_file, sock):
+    for chunk in _FileIter(stored_file, _BLOCK_SIZE):
+        sock.sendall(chunk)
+
+
+def serve_with_sendfile(stored_file, sock):
+    fd = stored_file.fileno()
+    size = os.fstat(fd).st_size
+    offset = 0
+    while offset < size:
+        offset += os.sendfile(sock.fileno(), fd, offset, size - offset)
+
+
+def measure(storage, file_id, serve, rounds):
+    elapsed = 0
+    for _ in range(rounds):
+        sender, receiver = socket.socketpair()
+        reader = threading.Thread(target=drain, args=(receiver, ))
+        reader.start()
+
+        stored_file = storage.get(file_id)
+        start = time.perf_counter()
+        serve(stored_file, sender)
+        sender.close()
+        reader.join()
+        elapsed += time.perf_counter() - start
+
+        stored_file.close()
+        receiver.close()
+    return elapsed
+
+
+def main(size_mb=256, rounds=5):
+    storage_path = tempfile.mkdtemp()
+    try:
+        storage = LocalFileStorage(storage_path)
+        file_id = storage.create(os.urandom(size_mb * 1024 * 1024), 'bench.bin')
+
+        total_mb = size_mb * rounds
+        for name, serve in (('_FileIter', serve_with_fileiter),
+                            ('sendfile', serve_with_sendfile)):
+            elapsed = measure(storage, file_id, serve, rounds)
+            print('%-10s %8.1f MB/s' % (name, total_mb / elapsed))
+    finally:
+        shutil.rmtree(storage_path)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -103,10 +103,7 @@ class DepotExtension(SessionExtension):
 
     def _flush_object(self, obj):
         history = self.get_depot_history(obj)
-        for entry in history.deleted:
-            depot, fileid = entry.split('/', 1)
-            depot = DepotManager.get(depot)
-            depot.delete(fileid)
+        DepotManager._delete_files(history.deleted)
         history.clear()
 
     def before_flush(self, obj=None):
@@ -110,19 +110,13 @@ class _SQLAMutationTracker(object):
         if hasattr(session, '_depot_old'):
             del session._depot_old
         if hasattr(session, '_depot_new'):
-            for entry in session._depot_new:
-                depot, fileid = entry.split('/', 1)
-                depot = DepotManager.get(depot)
-                depot.delete(fileid)
+            DepotManager._delete_files(session._depot_new)
             del session._depot_new
 
     @classmethod
     def _session_committed(cls, session):
         if hasattr(session, '_depot_old'):
-            for entry in session._depot_old:
-                depot, fileid = entry.split('/', 1)
-                depot = DepotManager.get(depot)
-                depot.delete(fileid)
+            DepotManager._delete_files(session._depot_old)
             del session._depot_old
         if hasattr(session, '_depot_new'):
             del session._depot_new
@@ -4,12 +4,16 @@ Provides FileStorage implementation for Amazon S3 through boto3 library.
 This is useful for storing files in S3.
 
 """
+import os
 from datetime import datetime
+from io import BytesIO
 import uuid
+import threading
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 from urllib.parse import quote, unquote
-from depot.utils import make_content_disposition
+from depot.utils import make_content_disposition, asbool
 
 from .interfaces import FileStorage, StoredFile
 from . import utils
@@ -17,43 +21,112 @@ from . import utils
 CANNED_ACL_PUBLIC_READ = 'public-read'
 CANNED_ACL_PRIVATE = 'private'
 
+ENSURE_BUCKET_OFF = 'off'
+ENSURE_BUCKET_HEAD = 'head'
+ENSURE_BUCKET_CREATE = 'create'
+
+
+def _metadata_property(name):
+    def _get(self):
+        if self._metadata is None:
+            self._load_metadata()
+        return self._metadata[name]
+    return property(_get)
+
 
 class S3StoredFile(StoredFile):
-    def __init__(self, file_id, key):
+    def __init__(self, file_id, key, transfer_config=None, parallel_download=False,
+                 lazy_metadata=False):
         _check_file_id(file_id)
         self._closed = False
         self._key = key
         self._body = None
-        filename = key.metadata.get('x-depot-filename')
+        self._transfer_config = transfer_config or TransferConfig()
+        self._parallel_download = parallel_download
+
+        # Metadata is exposed through properties, so StoredFile.__init__ is not used.
+        self.file_id = file_id
+        self._metadata = None
+        if not lazy_metadata:
+            self._set_metadata(key.metadata, key.content_type, key.content_length)
+
+    filename = _metadata_property('filename')
+    content_type = _metadata_property('content_type')
+    content_length = _metadata_property('content_length')
+    last_modified = _metadata_property('last_modified')
+
+    def _set_metadata(self, metadata, content_type, content_length):
+        filename = metadata.get('x-depot-filename')
         if filename:
             filename = unquote(filename)
 
         metadata_info = {'filename': filename,
-                         'content_type': key.content_type,
-                         'content_length': key.content_length,
+                         'content_type': content_type,
+                         'content_length': content_length,
                          'last_modified': None}
 
         try:
-            last_modified = key.metadata.get('x-depot-modified')
+            last_modified = metadata.get('x-depot-modified')
             if last_modified:
                 metadata_info['last_modified'] = datetime.strptime(last_modified,
                                                                    '%Y-%m-%d %H:%M:%S')
         except:
             pass
 
-        super(S3StoredFile, self).__init__(file_id=file_id, **metadata_info)
+        self._metadata = metadata_info
+
+    def _load_metadata(self):
+        try:
+            self._key.reload()
+        except ClientError as exc:
+            if exc.response['Error']['Code'] != '404':
+                raise
+            raise IOError('File %s not existing' % self.file_id)
+        self._set_metadata(self._key.metadata, self._key.content_type, self._key.content_length)
 
     def read(self, n=-1):
         if self.closed:
             raise ValueError("cannot read from a closed file")
 
         if self._body is None:
-            self._body = self._key.get()['Body']
+            chunksize = self._transfer_config.multipart_chunksize
+            if self._parallel_download and self.content_length > chunksize:
+                self._body = utils._RangedReader(self._read_range, self.content_length,
+                                                 chunksize,
+                                                 self._transfer_config.max_concurrency)
+            else:
+                try:
+                    response = self._key.get()
+                except ClientError as exc:
+                    if exc.response['Error']['Code'] != 'NoSuchKey':
+                        raise
+                    raise IOError('File %s not existing' % self.file_id)
+
+                if self._metadata is None:
+                    # Metadata is also provided by the GET, no need for a HEAD.
+                    self._set_metadata(response['Metadata'], response['ContentType'],
+                                       response['ContentLength'])
+                self._body = response['Body']
 
         if n <= 0:
             n = None
         return self._body.read(n)
 
+    def _read_range(self, start, end):
+        # Ranges must all come from the same version of the object.
+        response = self._key.get(Range='bytes=%d-%d' % (start, end - 1),
+                                 IfMatch=self._key.e_tag)
+        with response['Body'] as body:
+            return body.read()
+
+    def download_to(self, path):
+        """Downloads the file content to a local ``path``.
+
+        Big files are downloaded through parallel range requests,
+        according to the multipart options of the storage.
+        """
+        self._key.download_file(path, Config=self._transfer_config)
+
     def close(self):
         self._closed = True
         if self._body is not None:
@@ -96,10 +169,30 @@ class BucketDriver(object):
     def new_key(self, key_name):
         return self.bucket.Object('%s%s' % (self.prefix, key_name))
 
+    def delete_keys(self, key_names):
+        response = self.bucket.delete_objects(Delete={
+            'Objects': [{'Key': '%s%s' % (self.prefix, key_name)} for key_name in key_names],
+            'Quiet': True
+        })
+        errors = response.get('Errors')
+        if errors:
+            raise IOError('Failed to delete %s: %s' % (errors[0]['Key'], errors[0]['Message']))
+
     def list_key_names(self):
         keys = self.bucket.objects.filter(Prefix=self.prefix)
         return [k.key[len(self.prefix):] for k in keys]
 
+    def iter_key_names(self, page_size, start_after=None):
+        params = {'Bucket': self.bucket.name, 'Prefix': self.prefix,
+                  'PaginationConfig': {'PageSize': page_size}}
+        if start_after is not None:
+            params['StartAfter'] = '%s%s' % (self.prefix, start_after)
+
+        paginator = self.s3.meta.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**params):
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(self.prefix):]
+
 
 class S3Storage(FileStorage):
     """:class:`depot.io.interfaces.FileStorage` implementation that stores files on S3.
@@ -120,15 +213,59 @@ class S3Storage(FileStorage):
         * ``prefix`` parameter can be used to store all files under 
           specified prefix. Use a prefix like **dirname/** (*see trailing slash*)
           to store in a subdirectory.
+        * ``multipart_threshold`` files bigger than this size in bytes are uploaded
+          through a multipart upload, by default 8MB.
+        * ``multipart_chunksize`` the size in bytes of each part of multipart uploads,
+          by default 8MB.
+        * ``max_concurrency`` how many parts of a multipart upload are sent in
+          parallel, by default 10.
+        * ``parallel_download`` when enabled reading files bigger than ``multipart_chunksize``
+          downloads them through up to ``max_concurrency`` parallel range requests.
+          Disabled by default, as it only pays off for big files.
+        * ``lazy_metadata`` when enabled :meth:`get` doesn't send any request, metadata
+          of the file is retrieved by the first request that needs it. So a HEAD request
+          is done when only metadata is accessed, while reading the content first gets
+          metadata from the same GET request. Serving public files only requires
+          their url, so they are redirected without any request. As :meth:`get` doesn't
+          check the file exists, ``IOError`` for missing files is raised when accessing
+          its metadata or content.
+        * ``ensure_bucket`` how the bucket is checked, ``create`` (the default) creates it
+          when it doesn't exist, ``head`` raises ``IOError`` when it doesn't exist and ``off``
+          doesn't check it at all. The check is done by the first operation on the storage,
+          so creating the storage doesn't send any request.
+
+    :meth:`delete_many` deletes up to 1000 files with a single request.
+    :meth:`copy` copies files within S3 without downloading them when the target storage
+    uses the same S3 endpoint and credentials.
+
+    When uploading file objects that are not seekable, like streams of a request body,
+    parts are read and buffered one at a time, so memory used depends on
+    ``multipart_chunksize`` and ``max_concurrency`` instead of the size of the file.
     """
+    # Maximum number of keys that S3 deletes with a single request.
+    DELETE_BATCH_SIZE = 1000
 
     def __init__(self, access_key_id, secret_access_key, bucket=None, region_name=None,
-                 policy=None, storage_class=None, endpoint_url=None, prefix=''):
+                 policy=None, storage_class=None, endpoint_url=None, prefix='',
+                 multipart_threshold=8*1024*1024, multipart_chunksize=8*1024*1024,
+                 max_concurrency=10, parallel_download=False, lazy_metadata=False,
+                 ensure_bucket=ENSURE_BUCKET_CREATE):
         policy = policy or CANNED_ACL_PUBLIC_READ
         assert policy in [CANNED_ACL_PUBLIC_READ, CANNED_ACL_PRIVATE], (
             "Key policy must be %s or %s" % (CANNED_ACL_PUBLIC_READ, CANNED_ACL_PRIVATE))
+        assert ensure_bucket in [ENSURE_BUCKET_OFF, ENSURE_BUCKET_HEAD, ENSURE_BUCKET_CREATE], (
+            "Bucket check must be %s, %s or %s" % (ENSURE_BUCKET_OFF, ENSURE_BUCKET_HEAD,
+                                                   ENSURE_BUCKET_CREATE))
         self._policy = policy or CANNED_ACL_PUBLIC_READ
         self._storage_class = storage_class or 'STANDARD'
+        self._transfer_config = TransferConfig(multipart_threshold=int(multipart_threshold),
+                                               multipart_chunksize=int(multipart_chunksize),
+                                               max_concurrency=int(max_concurrency))
+        self._parallel_download = asbool(parallel_download)
+        self._lazy_metadata = asbool(lazy_metadata)
+        self._ensure_bucket = ensure_bucket
+        self._bucket_checked = ensure_bucket == ENSURE_BUCKET_OFF
+        self._bucket_lock = threading.Lock()
 
         if bucket is None:
             bucket = 'filedepot-%s' % (access_key_id.lower(),)
@@ -143,33 +280,59 @@ class S3Storage(FileStorage):
         self._s3 = self._conn.resource('s3', **kw)
         bucket = self._s3.Bucket(bucket)
 
-        # Create bucket if it doesn't exist.
-        buckets = set(b['Name'] for b in self._s3.meta.client.list_buckets()['Buckets'])
-        if bucket.name not in buckets:
-            bucket.create(ObjectOwnership="BucketOwnerPreferred")
-            bucket.wait_until_exists()
-            if self._policy == CANNED_ACL_PUBLIC_READ:
-                self._conn.client('s3').put_public_access_block(
-                    Bucket=bucket.name,
-                    PublicAccessBlockConfiguration={
-                        'BlockPublicAcls': False,
-                        'IgnorePublicAcls': False,
-                        'BlockPublicPolicy': True,
-                        'RestrictPublicBuckets': True
-                    }
-                )
-
         self._bucket_driver = BucketDriver(self._s3, bucket, prefix)
 
+    def _check_bucket(self):
+        # Bucket is checked on first use, so that creating
+        # the storage doesn't require any request.
+        if self._bucket_checked:
+            return
+
+        with self._bucket_lock:
+            if self._bucket_checked:
+                return
+
+            bucket = self._bucket_driver.bucket
+            try:
+                self._s3.meta.client.head_bucket(Bucket=bucket.name)
+            except ClientError as exc:
+                if exc.response['Error']['Code'] not in ('404', 'NoSuchBucket'):
+                    raise
+                if self._ensure_bucket != ENSURE_BUCKET_CREATE:
+                    raise IOError('Bucket %s not existing' % bucket.name)
+                self.__create_bucket(bucket)
+
+            self._bucket_checked = True
+
+    def __create_bucket(self, bucket):
+        bucket.create(ObjectOwnership="BucketOwnerPreferred")
+        bucket.wait_until_exists()
+        if self._policy == CANNED_ACL_PUBLIC_READ:
+            self._conn.client('s3').put_public_access_block(
+                Bucket=bucket.name,
+                PublicAccessBlockConfiguration={
+                    'BlockPublicAcls': False,
+                    'IgnorePublicAcls': False,
+                    'BlockPublicPolicy': True,
+                    'RestrictPublicBuckets': True
+                }
+            )
+
     def get(self, file_or_id):
         fileid = self.fileid(file_or_id)
         _check_file_id(fileid)
+        self._check_bucket()
+
+        if self._lazy_metadata:
+            return S3StoredFile(fileid, self._bucket_driver.new_key(fileid),
+                                self._transfer_config, self._parallel_download,
+                                lazy_metadata=True)
 
         key = self._bucket_driver.get_key(fileid)
         if key is None:
             raise IOError('File %s not existing' % fileid)
 
-        return S3StoredFile(fileid, key)
+        return S3StoredFile(fileid, key, self._transfer_config, self._parallel_download)
 
     def __save_file(self, key, content, filename, content_type=None):
         if filename:
@@ -186,18 +349,25 @@ class S3Storage(FileStorage):
         }
 
         if hasattr(content, 'read'):
-            try:
-                pos = content.tell()
-                content.seek(pos)
-            except:
-                content = content.read()
-            key.put(Body=content, **attrs)
+            size = _remaining_size(content)
+            if size is not None and size < self._transfer_config.multipart_threshold:
+                # Small files only need a single request.
+                key.put(Body=content.read(), **attrs)
+            else:
+                # Big files are uploaded in parallel parts, streams that
+                # are not seekable get read one part at a time.
+                key.upload_fileobj(content, ExtraArgs=attrs, Config=self._transfer_config)
         else:
             if isinstance(content, str):
                 raise TypeError('Only bytes can be stored, not unicode')
-            key.put(Body=content, **attrs)
+            if len(content) >= self._transfer_config.multipart_threshold:
+                key.upload_fileobj(BytesIO(content), ExtraArgs=attrs,
+                                   Config=self._transfer_config)
+            else:
+                key.put(Body=content, **attrs)
 
     def create(self, content, filename=None, content_type=None):
+        self._check_bucket()
         content, filename, content_type = self.fileinfo(content, filename, content_type)
         new_file_id = str(uuid.uuid1())
         key = self._bucket_driver.new_key(new_file_id)
@@ -207,43 +377,116 @@ class S3Storage(FileStorage):
     def replace(self, file_or_id, content, filename=None, content_type=None):
         fileid = self.fileid(file_or_id)
         _check_file_id(fileid)
+        self._check_bucket()
 
         if isinstance(file_or_id, StoredFile) and file_or_id is content:
             # This is a backup, no need to check if file exists.
-            pass
-        elif not self.exists(fileid):
+            key = self._bucket_driver.new_key(fileid)
+            existing = lambda: self.get(fileid)
+        else:
             # Check file existed and we are not using replace
             # as a way to force a specific file id on creation.
-            raise IOError('File %s not existing' % fileid)
+            # The same request also provides metadata of the existing file.
+            key = self._bucket_driver.get_key(fileid)
+            if key is None:
+                raise IOError('File %s not existing' % fileid)
+            existing = lambda: S3StoredFile(fileid, key, self._transfer_config,
+                                            self._parallel_download)
 
         content, filename, content_type = self.fileinfo(content, filename, content_type,
-                                                        lambda: self.get(fileid))
-
-        key = self._bucket_driver.get_key(fileid)
-        if key is None:
-            key = self._bucket_driver.new_key(fileid)
-
+                                                        existing)
         self.__save_file(key, content, filename, content_type)
         return fileid
 
     def delete(self, file_or_id):
         fileid = self.fileid(file_or_id)
         _check_file_id(fileid)
+        self._check_bucket()
 
-        k = self._bucket_driver.get_key(fileid)
-        if k:
-            k.delete()
+        # Deleting missing keys succeeds, so there is no need to check they exist.
+        self._bucket_driver.new_key(fileid).delete()
+
+    def delete_many(self, files_or_ids):
+        fileids = [self.fileid(file_or_id) for file_or_id in files_or_ids]
+        for fileid in fileids:
+            _check_file_id(fileid)
+        self._check_bucket()
+
+        for start in range(0, len(fileids), self.DELETE_BATCH_SIZE):
+            self._bucket_driver.delete_keys(fileids[start:start + self.DELETE_BATCH_SIZE])
+
+    def copy(self, file_or_id, target_storage=None):
+        fileid = self.fileid(file_or_id)
+        _check_file_id(fileid)
+
+        if target_storage is None:
+            target_storage, copy_id = self, str(uuid.uuid1())
+        elif self._same_service(target_storage):
+            copy_id = fileid
+        else:
+            return super(S3Storage, self).copy(file_or_id, target_storage)
+
+        source = {'Bucket': self._bucket_driver.bucket.name,
+                  'Key': '%s%s' % (self._bucket_driver.prefix, fileid)}
+        key = target_storage._bucket_driver.new_key(copy_id)
+        if source == {'Bucket': key.bucket_name, 'Key': key.key}:
+            # Copying a file on itself.
+            return copy_id
+
+        self._check_bucket()
+        target_storage._check_bucket()
+        try:
+            # Big files are copied in parallel parts, data never leaves S3.
+            key.copy(source, ExtraArgs={'ACL': target_storage._policy,
+                                        'StorageClass': target_storage._storage_class},
+                     Config=target_storage._transfer_config)
+        except ClientError as exc:
+            if exc.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            raise IOError('File %s not existing' % fileid)
+        return copy_id
+
+    def _same_service(self, storage):
+        # Files can be copied server side when the target storage can read them.
+        if not isinstance(storage, S3Storage):
+            return False
+        client, other_client = self._s3.meta.client, storage._s3.meta.client
+        return (client.meta.endpoint_url == other_client.meta.endpoint_url and
+                self._conn.get_credentials().access_key ==
+                storage._conn.get_credentials().access_key)
 
     def exists(self, file_or_id):
         fileid = self.fileid(file_or_id)
         _check_file_id(fileid)
+        self._check_bucket()
 
         k = self._bucket_driver.get_key(fileid)
         return k is not None
 
     def list(self):
+        self._check_bucket()
         return self._bucket_driver.list_key_names()
 
+    def iter_ids(self, page_size=1000, start_after=None):
+        if start_after is not None:
+            _check_file_id(start_after)
+        self._check_bucket()
+        yield from self._bucket_driver.iter_key_names(int(page_size), start_after)
+
+
+def _remaining_size(fileobj):
+    # Size of the content left to read, None when it can't be known without reading it.
+    try:
+        if not fileobj.seekable():
+            return None
+        position = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell() - position
+        fileobj.seek(position)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return None
+
 
 def _check_file_id(file_id):
     # Check that the given file id is valid, this also
@@ -0,0 +1,371 @@
+"""
+Provides FileStorage implementation that caches files of a slower storage.
+
+This is useful to avoid a round-trip to remote storages each time a file is served.
+
+"""
+import threading
+from collections import OrderedDict
+
+from .interfaces import FileStorage, StoredFile
+from . import utils
+
+
+class CachedStoredFile(StoredFile):
+    def __init__(self, file_id, open_content, metadata, stored_file=None, is_current=None):
+        self._open_content = open_content
+        self._file = stored_file
+        self._is_current = is_current
+        self._closed = False
+        super(CachedStoredFile, self).__init__(file_id=file_id, **metadata)
+
+    def _cached(self):
+        # Content is looked up when actually needed, so that
+        # files replaced in the meanwhile provide the new content.
+        if self._is_current is not None:
+            if self._file is not None and not self._is_current():
+                self._file.close()
+                self._file = None
+            # Once the content is being read, it's read until the end.
+            self._is_current = None
+        if self._file is None:
+            self._file = self._open_content(self.file_id)
+        return self._file
+
+    def read(self, n=-1):
+        if self._closed:
+            raise ValueError("cannot read from a closed file")
+        return self._cached().read(n)
+
+    def readinto(self, b):
+        if self._closed:
+            raise ValueError("cannot read from a closed file")
+        return self._cached().readinto(b)
+
+    def close(self):
+        self._closed = True
+        if self._file is not None:
+            self._file.close()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def public_url(self):
+        return self._cached().public_url
+
+
+class MetadataCachedStoredFile(CachedStoredFile):
+    def __init__(self, file_id, open_content, metadata, public_url, stored_file=None,
+                 is_current=None):
+        super(MetadataCachedStoredFile, self).__init__(file_id, open_content, metadata,
+                                                       stored_file, is_current)
+        self._public_url = public_url
+
+    @property
+    def public_url(self):
+        return self._public_url
+
+
+class CachedFileStorage(FileStorage):
+    """:class:`depot.io.interfaces.FileStorage` implementation that caches files on a faster storage.
+
+    Files are saved on the ``origin`` storage, while :meth:`get` serves them from the
+    ``cache`` storage, copying them there from the ``origin`` the first time they are
+    requested. Replacing or deleting a file removes it from the cache, so it's fetched
+    again from the ``origin`` when it's requested the next time. Changes made to the
+    ``origin`` without going through the ``CachedFileStorage`` are not detected.
+    When multiple threads request the same missing file at the same time, it's
+    downloaded from the ``origin`` only once.
+
+    When ``max_bytes`` is provided the least recently used files are removed from the
+    ``cache`` when the cached files exceed it. Storages that have their own limits,
+    like :class:`depot.io.memory.MemoryFileStorage` with ``max_bytes``, can be used
+    as ``cache`` too.
+
+    Both ``origin`` and ``cache`` can be a :class:`.FileStorage` or a dictionary of its
+    options (see :func:`depot.io.utils.storage_from_options`), so it can be configured as::
+
+        DepotManager.configure('default', {
+            'depot.backend': 'depot.io.cached.CachedFileStorage',
+            'depot.max_bytes': 512 * 1024 * 1024,
+            'depot.origin.backend': 'depot.io.boto3.S3Storage',
+            'depot.origin.bucket': 'mybucket',
+            'depot.cache.backend': 'depot.io.local.LocalFileStorage',
+            'depot.cache.storage_path': '/var/cache/depot',
+            ...
+        })
+
+    Files served from the cache keep the ``filename``, ``content_type`` and ``last_modified``
+    of the ``origin``, which are remembered for the files in the cache, while they
+    have the ``public_url`` of the ``cache`` storage,
+    so files cached on memory or local storages are served by the
+    :class:`depot.middleware.DepotMiddleware` instead of being redirected to the ``origin``.
+    Files already in the ``cache`` when the storage is created, like the ones cached
+    by other processes, have their metadata retrieved from the ``origin`` the first
+    time they are requested.
+    """
+    def __init__(self, origin, cache, max_bytes=None):
+        self.origin = utils.storage_from_options(origin)
+        self.cache = utils.storage_from_options(cache)
+        self.max_bytes = int(max_bytes) if max_bytes is not None else None
+        self._lock = threading.Lock()
+        self._cached = OrderedDict()
+        self._cached_bytes = 0
+        self._fills = utils._SingleFlight()
+        # Generation of the files being copied to the cache, bumped when they are invalidated.
+        self._generations = {}
+
+    def get(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        stored, metadata, cached = self.__open(fileid)
+        is_current = None
+        if cached:
+            # The content opened here is read unless the file is replaced
+            # or removed from the cache before reading starts.
+            is_current = lambda: self._cached.get(fileid) is metadata
+        return CachedStoredFile(fileid, self.__open_content, metadata, stored, is_current)
+
+    def __open_content(self, fileid):
+        stored, _, _ = self.__open(fileid)
+        return stored
+
+    def __open(self, fileid):
+        # Returns the file to read, the metadata of the origin file
+        # and whether the file is read from the cache.
+        try:
+            cached = self.cache.get(fileid)
+        except IOError:
+            pass
+        else:
+            metadata = self._cached.get(fileid)
+            if metadata is None:
+                # Cached by another process, or before a restart.
+                try:
+                    stored = self.origin.get(fileid)
+                except:
+                    cached.close()
+                    raise
+                stored.close()
+                metadata = _metadata(stored)
+            return cached, self.__track(fileid, metadata), True
+
+        # Concurrent requests for the same file share a single download.
+        metadata, _ = self._fills.do(fileid, lambda: self.__fill(fileid))
+        if metadata is not None:
+            try:
+                cached = self.cache.get(fileid)
+            except IOError:
+                metadata = None
+
+        if metadata is None:
+            # Cache is not available, files can still be served from origin.
+            stored = self.origin.get(fileid)
+            return stored, _metadata(stored), False
+
+        return cached, self.__track(fileid, metadata), True
+
+    def __fill(self, fileid):
+        with self._lock:
+            self._generations[fileid] = 0
+        try:
+            # Let origin report missing files and invalid ids.
+            stored = self.origin.get(fileid)
+            try:
+                self.cache.replace(stored, stored)
+            except IOError:
+                return None
+            finally:
+                stored.close()
+        finally:
+            with self._lock:
+                generation = self._generations.pop(fileid)
+
+        if generation:
+            # Replaced or deleted while it was being copied, what was
+            # copied might be outdated and must not be served.
+            self.cache.delete(fileid)
+            return None
+        return _metadata(stored)
+
+    def __track(self, file_id, metadata):
+        # Remembers the origin metadata of the cached files and keeps track of
+        # recently used ones, to remove the least recently used ones from the
+        # cache when max_bytes is exceeded. Returns the remembered metadata.
+        evicted = []
+        with self._lock:
+            if file_id in self._cached:
+                self._cached.move_to_end(file_id)
+                metadata = self._cached[file_id]
+            else:
+                self._cached[file_id] = metadata
+                self._cached_bytes += metadata['content_length'] or 0
+
+            while (self.max_bytes is not None and len(self._cached) > 1
+                   and self._cached_bytes > self.max_bytes):
+                evicted_id, evicted_metadata = self._cached.popitem(last=False)
+                self._cached_bytes -= evicted_metadata['content_length'] or 0
+                evicted.append(evicted_id)
+
+        for evicted_id in evicted:
+            self.cache.delete(evicted_id)
+        return metadata
+
+    def __invalidate(self, *file_ids):
+        with self._lock:
+            for file_id in file_ids:
+                if file_id in self._generations:
+                    self._generations[file_id] += 1
+                metadata = self._cached.pop(file_id, None)
+                if metadata is not None:
+                    self._cached_bytes -= metadata['content_length'] or 0
+        self.cache.delete_many(file_ids)
+
+    def create(self, content, filename=None, content_type=None):
+        return self.origin.create(content, filename, content_type)
+
+    def replace(self, file_or_id, content, filename=None, content_type=None):
+        fileid = self.origin.replace(file_or_id, content, filename, content_type)
+        self.__invalidate(fileid)
+        return fileid
+
+    def delete(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        self.origin.delete(fileid)
+        self.__invalidate(fileid)
+
+    def delete_many(self, files_or_ids):
+        fileids = [self.fileid(file_or_id) for file_or_id in files_or_ids]
+        self.origin.delete_many(fileids)
+        self.__invalidate(*fileids)
+
+    def copy(self, file_or_id, target_storage=None):
+        fileid = self.fileid(file_or_id)
+        if isinstance(target_storage, CachedFileStorage):
+            copy_id = self.origin.copy(fileid, target_storage.origin)
+            target_storage.__invalidate(copy_id)
+            return copy_id
+        # Copies are made by the origin, so that it can avoid downloading them.
+        return self.origin.copy(fileid, target_storage)
+
+    def exists(self, file_or_id):
+        return self.origin.exists(file_or_id)
+
+    def list(self):
+        return self.origin.list()
+
+    def iter_ids(self, page_size=1000, start_after=None):
+        return self.origin.iter_ids(page_size, start_after)
+
+
+class MetadataCachedFileStorage(FileStorage):
+    """:class:`depot.io.interfaces.FileStorage` implementation that caches metadata of files.
+
+    Getting a file from remote storages like S3 or GCS requires a request to retrieve
+    its metadata even when the content is not needed, like when serving a
+    ``304 Not Modified`` response or accessing attributes of an ``UploadedFile``.
+    This wraps the ``storage`` where files are saved and keeps metadata
+    and ``public_url`` of recently used files in memory, so that the content is
+    only requested to the ``storage`` when it's actually read.
+
+    Up to ``max_entries`` files are cached for ``ttl`` seconds. Replacing or deleting
+    a file through the storage removes it from the cache, while changes made by other
+    processes are only noticed once the cached metadata expires. Concurrent lookups
+    of the same file are coalesced into a single request to the ``storage``.
+
+    ``storage`` can be a :class:`.FileStorage` or a dictionary of its options
+    (see :func:`depot.io.utils.storage_from_options`), so it can be configured as::
+
+        DepotManager.configure('default', {
+            'depot.backend': 'depot.io.cached.MetadataCachedFileStorage',
+            'depot.ttl': 300,
+            'depot.storage.backend': 'depot.io.boto3.S3Storage',
+            'depot.storage.bucket': 'mybucket',
+            ...
+        })
+    """
+    def __init__(self, storage, max_entries=1024, ttl=60):
+        self.storage = utils.storage_from_options(storage)
+        self._metadata = utils._TTLCache(max_entries, ttl)
+        self._lookups = utils._SingleFlight()
+
+    def get(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+
+        stored = None
+        cached = self._metadata.get(fileid)
+        if cached is None:
+            # Concurrent lookups of the same file share a single request,
+            # only the first one can reuse the retrieved file to read it.
+            (cached, stored), shared = self._lookups.do(fileid, lambda: self.__lookup(fileid))
+            if shared:
+                stored = None
+
+        metadata, public_url = cached
+        # The retrieved file is only read if it wasn't replaced before reading starts.
+        return MetadataCachedStoredFile(fileid, self.storage.get, metadata, public_url, stored,
+                                        lambda: self._metadata.get(fileid) is cached)
+
+    def __lookup(self, fileid):
+        stored = self.storage.get(fileid)
+        cached = ({'filename': stored.filename,
+                   'content_type': stored.content_type,
+                   'content_length': stored.content_length,
+                   'last_modified': stored.last_modified},
+                  stored.public_url)
+        self._metadata.set(fileid, cached)
+        return cached, stored
+
+    def create(self, content, filename=None, content_type=None):
+        return self.storage.create(content, filename, content_type)
+
+    def replace(self, file_or_id, content, filename=None, content_type=None):
+        fileid = self.fileid(file_or_id)
+        try:
+            return self.storage.replace(file_or_id, content, filename, content_type)
+        finally:
+            self._metadata.discard(fileid)
+
+    def delete(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        try:
+            self.storage.delete(fileid)
+        finally:
+            self._metadata.discard(fileid)
+
+    def delete_many(self, files_or_ids):
+        fileids = [self.fileid(file_or_id) for file_or_id in files_or_ids]
+        try:
+            self.storage.delete_many(fileids)
+        finally:
+            for fileid in fileids:
+                self._metadata.discard(fileid)
+
+    def copy(self, file_or_id, target_storage=None):
+        fileid = self.fileid(file_or_id)
+        if isinstance(target_storage, MetadataCachedFileStorage):
+            try:
+                return self.storage.copy(fileid, target_storage.storage)
+            finally:
+                target_storage._metadata.discard(fileid)
+        return self.storage.copy(fileid, target_storage)
+
+    def exists(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        if self._metadata.get(fileid) is not None:
+            return True
+        return self.storage.exists(fileid)
+
+    def list(self):
+        return self.storage.list()
+
+    def iter_ids(self, page_size=1000, start_after=None):
+        return self.storage.iter_ids(page_size, start_after)
+
+
+def _metadata(stored_file):
+    return {'filename': stored_file.filename,
+            'content_type': stored_file.content_type,
+            'content_length': stored_file.content_length,
+            'last_modified': stored_file.last_modified}
@@ -0,0 +1,309 @@
+"""
+Provides FileStorage implementation that stores each content only once.
+
+This is useful when the same files get uploaded over and over.
+
+"""
+import uuid
+import hashlib
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+
+from .interfaces import FileStorage, StoredFile
+from . import utils
+
+
+class DeduplicatedStoredFile(StoredFile):
+    def __init__(self, file_id, open_content, metadata):
+        _check_file_id(file_id)
+        self._open_content = open_content
+        self._file = None
+        self._closed = False
+        super(DeduplicatedStoredFile, self).__init__(file_id=file_id, **metadata)
+
+    def _blob(self):
+        # The stored content is only retrieved when actually needed,
+        # metadata is already available from the index.
+        if self._file is None:
+            self._file = self._open_content(self.file_id)
+        return self._file
+
+    def read(self, n=-1):
+        if self._closed:
+            raise ValueError("cannot read from a closed file")
+        return self._blob().read(n)
+
+    def readinto(self, b):
+        if self._closed:
+            raise ValueError("cannot read from a closed file")
+        return self._blob().readinto(b)
+
+    def close(self):
+        self._closed = True
+        if self._file is not None:
+            self._file.close()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def public_url(self):
+        # Stored contents are shared, so they have the filename and content type
+        # of the first file that saved them. Files must be served with their own.
+        return None
+
+
+class DeduplicatingFileStorage(FileStorage):
+    """:class:`depot.io.interfaces.FileStorage` implementation that stores each content only once.
+
+    Contents are saved on the wrapped ``storage``, they are hashed while being received
+    and files with the same content share the same stored data. So storing a duplicate
+    only costs a metadata write, and the shared content is deleted when the
+    last file referring to it is deleted.
+
+    Metadata of the files and reference counts of the stored contents are kept in a
+    SQLite database at ``index_path``, all the processes using the storage must
+    have access to the same index.
+
+    ``storage`` can be a :class:`.FileStorage` or a dictionary of its options
+    (see :func:`depot.io.utils.storage_from_options`), so it can be configured as::
+
+        DepotManager.configure('default', {
+            'depot.backend': 'depot.io.dedup.DeduplicatingFileStorage',
+            'depot.index_path': '/var/lib/depot/dedup.db',
+            'depot.storage.backend': 'depot.io.boto3.S3Storage',
+            'depot.storage.bucket': 'mybucket',
+            ...
+        })
+
+    The ``hash_algorithm`` used to detect duplicates can be any algorithm
+    supported by :mod:`hashlib`, by default it's ``sha256``.
+
+    Files have no ``public_url``, as the shared content has the filename and
+    content type of the first file that stored it, so they are served by
+    :class:`depot.middleware.DepotMiddleware` instead of being redirected.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS blobs (
+        digest TEXT PRIMARY KEY,
+        blob_id TEXT NOT NULL,
+        refcount INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS files (
+        file_id TEXT PRIMARY KEY,
+        digest TEXT NOT NULL,
+        filename TEXT,
+        content_type TEXT,
+        content_length INTEGER,
+        last_modified TEXT
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, storage, index_path, hash_algorithm='sha256'):
+        self._storage = utils.storage_from_options(storage)
+        self._hash_algorithm = hash_algorithm
+        hashlib.new(hash_algorithm)  # Fail early on unsupported algorithms
+        self._db = utils._SQLiteDatabase(index_path, self.SCHEMA)
+
+    def get(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        _check_file_id(fileid)
+
+        row = self._db.execute('SELECT filename, content_type, content_length, last_modified '
+                               'FROM files WHERE file_id = ?', (fileid, )).fetchone()
+        if row is None:
+            raise IOError('File %s not existing' % fileid)
+
+        filename, content_type, content_length, last_modified = row
+        if last_modified:
+            last_modified = datetime.fromisoformat(last_modified)
+
+        return DeduplicatedStoredFile(fileid, self.__open_content,
+                                      {'filename': filename,
+                                       'content_type': content_type,
+                                       'content_length': content_length,
+                                       'last_modified': last_modified})
+
+    def __open_content(self, file_id):
+        row = self._db.execute('SELECT blob_id FROM files JOIN blobs USING (digest) '
+                               'WHERE file_id = ?', (file_id, )).fetchone()
+        if row is None:
+            raise IOError('File %s not existing' % file_id)
+        return self._storage.get(row[0])
+
+    def __hash_content(self, content):
+        # Returns the content digest, length and the content itself to be stored.
+        hasher = hashlib.new(self._hash_algorithm)
+        if not hasattr(content, 'read'):
+            if isinstance(content, str):
+                raise TypeError('Only bytes can be stored, not unicode')
+            hasher.update(content)
+            return hasher.hexdigest(), len(content), content
+
+        # Spool the content while hashing it, so that the content
+        # is uploaded to the storage only when it's a new one.
+        spool = SpooledTemporaryFile(utils.INMEMORY_FILESIZE)
+        content_length = 0
+        while True:
+            chunk = content.read(utils.COPY_BUFSIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            spool.write(chunk)
+            content_length += len(chunk)
+        spool.seek(0)
+        return hasher.hexdigest(), content_length, spool
+
+    def __blob_id(self, conn, digest):
+        row = conn.execute('SELECT blob_id FROM blobs WHERE digest = ?', (digest, )).fetchone()
+        return row[0] if row is not None else None
+
+    def __link(self, conn, file_id, digest, filename, content_type, content_length):
+        # Points file_id to the content with the given digest,
+        # returns the stored contents that are not referenced anymore.
+        conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE digest = ?', (digest, ))
+        unreferenced = self.__unlink(conn, file_id)
+        conn.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                     (file_id, digest, filename, content_type, content_length,
+                      utils.timestamp()))
+        return unreferenced
+
+    def __unlink(self, conn, file_id):
+        row = conn.execute('SELECT digest FROM files WHERE file_id = ?', (file_id, )).fetchone()
+        if row is None:
+            return []
+
+        digest = row[0]
+        conn.execute('DELETE FROM files WHERE file_id = ?', (file_id, ))
+        conn.execute('UPDATE blobs SET refcount = refcount - 1 WHERE digest = ?', (digest, ))
+        row = conn.execute('SELECT blob_id FROM blobs WHERE digest = ? AND refcount <= 0',
+                           (digest, )).fetchone()
+        if row is None:
+            return []
+
+        conn.execute('DELETE FROM blobs WHERE digest = ?', (digest, ))
+        return [row[0]]
+
+    def __save_file(self, file_id, content, filename, content_type=None):
+        digest, content_length, data = self.__hash_content(content)
+        try:
+            with self._db.transaction() as conn:
+                known_content = self.__blob_id(conn, digest) is not None
+                if known_content:
+                    unreferenced = self.__link(conn, file_id, digest,
+                                               filename, content_type, content_length)
+
+            if not known_content:
+                # New content, upload it outside of the transaction
+                # to avoid blocking other writers during the upload.
+                blob_id = self._storage.create(utils.FileIntent(data, filename, content_type))
+                with self._db.transaction() as conn:
+                    unreferenced = []
+                    if self.__blob_id(conn, digest) is None:
+                        conn.execute('INSERT INTO blobs VALUES (?, ?, 0)', (digest, blob_id))
+                    else:
+                        # Same content was concurrently stored by someone else.
+                        unreferenced.append(blob_id)
+                    unreferenced += self.__link(conn, file_id, digest,
+                                                filename, content_type, content_length)
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+
+        self._storage.delete_many(unreferenced)
+
+    def create(self, content, filename=None, content_type=None):
+        new_file_id = str(uuid.uuid1())
+        content, filename, content_type = self.fileinfo(content, filename, content_type)
+        self.__save_file(new_file_id, content, filename, content_type)
+        return new_file_id
+
+    def replace(self, file_or_id, content, filename=None, content_type=None):
+        fileid = self.fileid(file_or_id)
+        _check_file_id(fileid)
+
+        if isinstance(file_or_id, StoredFile) and file_or_id is content:
+            # This is a backup, no need to check if file exists.
+            pass
+        elif not self.exists(fileid):
+            # Check file existed and we are not using replace
+            # as a way to force a specific file id on creation.
+            raise IOError('File %s not existing' % fileid)
+
+        content, filename, content_type = self.fileinfo(content, filename, content_type,
+                                                        lambda: self.get(fileid))
+
+        self.__save_file(fileid, content, filename, content_type)
+        return fileid
+
+    def delete(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        _check_file_id(fileid)
+
+        with self._db.transaction() as conn:
+            unreferenced = self.__unlink(conn, fileid)
+
+        self._storage.delete_many(unreferenced)
+
+    def delete_many(self, files_or_ids):
+        fileids = [self.fileid(file_or_id) for file_or_id in files_or_ids]
+        for fileid in fileids:
+            _check_file_id(fileid)
+
+        unreferenced = []
+        with self._db.transaction() as conn:
+            for fileid in fileids:
+                unreferenced += self.__unlink(conn, fileid)
+
+        self._storage.delete_many(unreferenced)
+
+    def copy(self, file_or_id, target_storage=None):
+        if target_storage is not None:
+            return super(DeduplicatingFileStorage, self).copy(file_or_id, target_storage)
+
+        fileid = self.fileid(file_or_id)
+        _check_file_id(fileid)
+
+        # Copies share the content of the original file, only metadata is saved.
+        new_file_id = str(uuid.uuid1())
+        with self._db.transaction() as conn:
+            row = conn.execute('SELECT digest, filename, content_type, content_length '
+                               'FROM files WHERE file_id = ?', (fileid, )).fetchone()
+            if row is None:
+                raise IOError('File %s not existing' % fileid)
+            self.__link(conn, new_file_id, *row)
+        return new_file_id
+
+    def exists(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        _check_file_id(fileid)
+
+        row = self._db.execute('SELECT 1 FROM files WHERE file_id = ?', (fileid, )).fetchone()
+        return row is not None
+
+    def list(self):
+        return [row[0] for row in self._db.execute('SELECT file_id FROM files')]
+
+    def iter_ids(self, page_size=1000, start_after=None):
+        if start_after is not None:
+            _check_file_id(start_after)
+
+        while True:
+            rows = self._db.execute('SELECT file_id FROM files WHERE file_id > ? '
+                                    'ORDER BY file_id LIMIT ?',
+                                    (start_after or '', int(page_size))).fetchall()
+            for row in rows:
+                yield row[0]
+            if len(rows) < int(page_size):
+                return
+            start_after = rows[-1][0]
+
+
+def _check_file_id(file_id):
+    # Check that the given file id is valid, this also
+    # prevents unsafe paths.
+    try:
+        uuid.UUID('{%s}' % file_id)
+    except:
+        raise ValueError('Invalid file id %s' % file_id)
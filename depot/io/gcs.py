@@ -1,24 +1,30 @@
 from typing import List
+import io
 import uuid
 from datetime import datetime
 from google.cloud import storage
 from depot.io import utils
 from depot.io.interfaces import FileStorage, StoredFile
 from urllib.parse import quote, unquote
-from google.cloud.exceptions import NotFound
+from google.cloud.exceptions import GoogleCloudError, NotFound, PreconditionFailed
 from google.oauth2 import service_account
 import os
 from depot.utils import make_content_disposition
 CANNED_ACL_PUBLIC_READ = 'public-read'
 CANNED_ACL_PRIVATE = 'private'
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_READ_AHEAD = 2
 
 class GCSStoredFile(StoredFile):
-    def __init__(self, file_id, blob):
+    def __init__(self, file_id, blob, chunk_size=DEFAULT_CHUNK_SIZE, read_ahead=DEFAULT_READ_AHEAD):
         _check_file_id(file_id)
 
         self.blob = blob
         self._fileid = file_id
         self._closed = False
+        self._chunk_size = chunk_size
+        self._read_ahead = read_ahead
+        self._reader = None
 
         metadata = blob.metadata or {}
         filename = metadata.get('x-depot-filename')
@@ -36,22 +42,56 @@ class GCSStoredFile(StoredFile):
             pass
 
         super(GCSStoredFile, self).__init__(file_id, filename, content_type, last_modified, content_length)
-        self._pos = 0
 
     def read(self, n=-1):
         if self.closed:
             raise ValueError("I/O operation on closed file")
 
-        if self._pos == 0:
+        if self._reader is None:
             # If we are starting a new read, we need to get the latest generation of the blob
-            self.blob = storage.Blob(self.blob.name, self.blob.bucket)
-        
-        data = self.blob.download_as_bytes(start=self._pos, end=self._pos + n - 1 if n != -1 else None)
-        self._pos += len(data)
-        return data
+            blob = storage.Blob(self.blob.name, self.blob.bucket)
+            if self.content_length <= self._chunk_size:
+                # Small files are downloaded with a single request.
+                self._reader = io.BytesIO(self._download(blob))
+            else:
+                # Bigger files are downloaded in windows of chunk_size bytes,
+                # requesting up to read_ahead windows while they are being read.
+                try:
+                    blob.reload()
+                except NotFound:
+                    raise IOError('File %s not existing' % self._fileid)
+                generation = blob.generation
+                self._reader = utils._RangedReader(
+                    lambda start, end: self._read_range(blob, generation, start, end),
+                    blob.size, self._chunk_size, self._read_ahead
+                )
+        return self._reader.read(n)
+
+    def _download(self, blob):
+        try:
+            return blob.download_as_bytes()
+        except NotFound:
+            raise IOError('File %s not existing' % self._fileid)
+
+    def _read_range(self, blob, generation, start, end):
+        if start >= end:
+            return b''
+
+        # All windows must come from the same generation of the file.
+        # Checksums are not verified as GCS can't provide them for ranges.
+        try:
+            return blob.download_as_bytes(start=start, end=end - 1,
+                                          if_generation_match=generation,
+                                          checksum=None)
+        except NotFound:
+            raise IOError('File %s not existing' % self._fileid)
+        except PreconditionFailed:
+            raise IOError('File %s was replaced while being read' % self._fileid)
 
     def close(self, *args, **kwargs):
         self._closed = True
+        if self._reader is not None:
+            self._reader.close()
 
     @property
     def closed(self):
@@ -63,7 +103,15 @@ class GCSStoredFile(StoredFile):
 
 
 class GCSStorage(FileStorage):
-    def __init__(self, project_id=None, credentials=None, bucket=None, policy=None, storage_class=None, prefix=''):
+    """:class:`depot.io.interfaces.FileStorage` implementation that stores files on Google Cloud Storage.
+
+    Files are read in windows of ``chunk_size`` bytes, each downloaded with a single
+    request, and up to ``read_ahead`` windows are downloaded in parallel while the
+    file is being read. So each file being read keeps up to ``chunk_size * read_ahead``
+    bytes in memory, by default 8MB windows with a read ahead of 2.
+    """
+    def __init__(self, project_id=None, credentials=None, bucket=None, policy=None, storage_class=None, prefix='',
+                 chunk_size=DEFAULT_CHUNK_SIZE, read_ahead=DEFAULT_READ_AHEAD):
         if not credentials:
             if not os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"):
                 raise ValueError("GOOGLE_APPLICATION_CREDENTIALS environment variable not set")
@@ -94,6 +142,8 @@ class GCSStorage(FileStorage):
         self._policy = policy or CANNED_ACL_PUBLIC_READ
         self._storage_class = storage_class or 'STANDARD'
         self._prefix = prefix
+        self._chunk_size = int(chunk_size)
+        self._read_ahead = int(read_ahead)
 
         if policy == CANNED_ACL_PUBLIC_READ:
             self.set_bucket_public_iam(self.bucket)
@@ -103,12 +153,12 @@ class GCSStorage(FileStorage):
         _check_file_id(file_id)
 
         blob = self.bucket.blob(self._prefix+file_id)
-        if not blob.exists():
-            # TODO: Can we get rid of this extra exists check?
+        try:
+            blob.reload()
+        except NotFound:
             raise IOError('File %s not existing' % file_id)
 
-        blob.reload()
-        return GCSStoredFile(file_id, blob)
+        return GCSStoredFile(file_id, blob, self._chunk_size, self._read_ahead)
     
     def set_bucket_public_iam(self, bucket, members=("allUsers", )):
         policy = bucket.get_iam_policy(requested_policy_version=3)
@@ -134,12 +184,20 @@ class GCSStorage(FileStorage):
 
         if hasattr(content, 'read'):
             try:
-                pos = content.tell()
-                content.seek(pos)
-                blob.upload_from_file(content, content_type=content_type)
-            except:
-                content = content.read()
-                blob.upload_from_string(content, content_type=content_type)
+                # Resumable uploads only need to know the position in the
+                # stream, so streams that are not seekable are sent in chunks.
+                start = content.tell()
+            except (AttributeError, OSError, ValueError):
+                blob.upload_from_string(content.read(), content_type=content_type)
+            else:
+                try:
+                    blob.upload_from_file(content, content_type=content_type)
+                except GoogleCloudError:
+                    # Part of the content might have been consumed already,
+                    # retrying with what's left would store a truncated file.
+                    if not _rewind(content, start):
+                        raise
+                    blob.upload_from_string(content.read(), content_type=content_type)
         else:
             if isinstance(content, str):
                 raise TypeError('Only bytes can be stored, not unicode')
@@ -160,15 +218,18 @@ class GCSStorage(FileStorage):
         
         if isinstance(file_or_id, StoredFile) and file_or_id is content:
             # This is a backup, no need to check if file exists.
-            pass
-        elif not self.exists(file_id):
+            existing = lambda: self.get(file_id)
+        else:
             # Check file existed and we are not using replace
             # as a way to force a specific file id on creation.
-            raise IOError('File %s not existing' % file_id)
+            # The same request also provides metadata of the existing file.
+            current = self.get(file_id)
+            existing = lambda: current
 
         content, filename, content_type = self.fileinfo(content, filename, content_type,
-                                                        lambda: self.get(file_id))
+                                                        existing)
         self.__save_file(file_id, content, filename, content_type)
+        return file_id
 
     def delete(self, file_or_id):
         file_id = self.fileid(file_or_id)
@@ -183,6 +244,40 @@ class GCSStorage(FileStorage):
         except NotFound:
             pass
 
+    def delete_many(self, files_or_ids):
+        file_ids = [self.fileid(file_or_id) for file_or_id in files_or_ids]
+        for file_id in file_ids:
+            _check_file_id(file_id)
+
+        # Missing files are ignored, like delete does.
+        self.bucket.delete_blobs([self.bucket.blob(self._prefix+file_id) for file_id in file_ids],
+                                 on_error=lambda blob: None)
+
+    def copy(self, file_or_id, target_storage=None):
+        file_id = self.fileid(file_or_id)
+        _check_file_id(file_id)
+
+        if target_storage is None:
+            target_storage, copy_id = self, str(uuid.uuid4())
+        elif isinstance(target_storage, GCSStorage):
+            copy_id = file_id
+        else:
+            return super(GCSStorage, self).copy(file_or_id, target_storage)
+
+        source = self.bucket.blob(self._prefix+file_id)
+        blob = target_storage.bucket.blob(target_storage._prefix+copy_id)
+        try:
+            # Data is copied within GCS, big files might take multiple rewrite requests.
+            token, _, _ = blob.rewrite(source)
+            while token is not None:
+                token, _, _ = blob.rewrite(source, token=token)
+        except NotFound:
+            raise IOError('File %s not existing' % file_id)
+
+        if target_storage._policy == CANNED_ACL_PUBLIC_READ:
+            blob.make_public()
+        return copy_id
+
     def exists(self, file_or_id):
         file_id = self.fileid(file_or_id)
         _check_file_id(file_id)
@@ -193,6 +288,19 @@ class GCSStorage(FileStorage):
     def list(self):
         return [blob.name for blob in self.bucket.list_blobs()]
 
+    def iter_ids(self, page_size=1000, start_after=None):
+        params = {}
+        if start_after is not None:
+            _check_file_id(start_after)
+            params['start_offset'] = self._prefix + start_after
+
+        blobs = self.bucket.list_blobs(prefix=self._prefix, page_size=int(page_size), **params)
+        for blob in blobs:
+            file_id = blob.name[len(self._prefix):]
+            # start_offset includes the blob it points to.
+            if file_id != start_after:
+                yield file_id
+
 
 def _check_file_id(file_id):
     # Check that the given file id is valid, this also
@@ -200,4 +308,12 @@ def _check_file_id(file_id):
     try:
         uuid.UUID('{%s}' % file_id)
     except:
-        raise ValueError('Invalid file id %s' % file_id)
\ No newline at end of file
+        raise ValueError('Invalid file id %s' % file_id)
+
+
+def _rewind(fileobj, position):
+    try:
+        fileobj.seek(position)
+    except (AttributeError, OSError, ValueError):
+        return False
+    return True
@@ -86,14 +86,16 @@ class GridFSStorage(FileStorage):
 
         if isinstance(file_or_id, StoredFile) and file_or_id is content:
             # This is a backup, no need to check if file exists.
-            pass
-        elif not self.exists(fileid):
+            existing = lambda: self.get(fileid)
+        else:
             # Check file existed and we are not using replace
             # as a way to force a specific file id on creation.
-            raise IOError('File %s not existing' % fileid)
+            # The same query also provides metadata of the existing file.
+            current = self.get(str(fileid))
+            existing = lambda: current
 
         content, filename, content_type = self.fileinfo(content, filename, content_type,
-                                                        lambda: self.get(fileid))
+                                                        existing)
 
         self._gridfs.delete(fileid)
         new_file_id = self._gridfs.put(content, _id=fileid,
@@ -118,6 +120,17 @@ class GridFSStorage(FileStorage):
             list_ids.append(str(self._gridfs.find_one({"filename": filename})._id))
         return list_ids
 
+    def iter_ids(self, page_size=1000, start_after=None):
+        query = {}
+        if start_after is not None:
+            query['_id'] = {'$gt': _check_file_id(start_after)}
+
+        files = self._db[self._collection].files
+        cursor = files.find(query, projection={'_id': True}, sort=[('_id', 1)],
+                            batch_size=int(page_size))
+        for document in cursor:
+            yield str(document['_id'])
+
 
 def _check_file_id(file_id):
     # Check that the given file id is valid, this also
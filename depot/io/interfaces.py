@@ -6,7 +6,7 @@ the abstractmethods.
 """
 from abc import ABCMeta, abstractmethod
 from io import IOBase
-from depot.io.utils import FileIntent, _FileInfo
+from depot.io.utils import FileIntent, _FileInfo, _PipedReader, COPY_BUFSIZE
 
 
 class StoredFile(IOBase):
@@ -74,6 +74,19 @@ class StoredFile(IOBase):
         """
         return
 
+    def readinto(self, b):
+        """Reads up to ``len(b)`` bytes into the writable buffer ``b``.
+
+        Returns the number of bytes read, ``0`` at the end of the file.
+        This permits reusing the same buffer for all reads, storages that
+        can read directly into the buffer override it to avoid allocating
+        a new ``bytes`` object on each call.
+        """
+        buffer = memoryview(b).cast('B')
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
     @abstractmethod
     def close(self, *args, **kwargs):  # pragma: no cover
         """Closes the file.
@@ -114,6 +127,35 @@ class StoredFile(IOBase):
                                                                          self.last_modified)
 
 
+class _PipedStoredFile(StoredFile):
+    # Provides the content of stored_file while it's read by a background
+    # thread, so that saving it elsewhere overlaps with downloading it.
+    def __init__(self, stored_file, chunk_size=COPY_BUFSIZE, buffers=4):
+        self._reader = _PipedReader(stored_file, chunk_size, buffers)
+        self._closed = False
+        super(_PipedStoredFile, self).__init__(stored_file.file_id, stored_file.filename,
+                                               stored_file.content_type,
+                                               stored_file.last_modified,
+                                               stored_file.content_length)
+
+    def read(self, n=-1):
+        if self._closed:
+            raise ValueError("cannot read from a closed file")
+        return self._reader.read(n)
+
+    def tell(self):
+        return self._reader.tell()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._reader.close()
+
+    @property
+    def closed(self):
+        return self._closed
+
+
 class FileStorage(object, metaclass=ABCMeta):
     """Interface for storage providers.
 
@@ -178,6 +220,38 @@ class FileStorage(object, metaclass=ABCMeta):
         """Deletes a file. If the file didn't exist it will just do nothing."""
         return
 
+    def delete_many(self, files_or_ids):
+        """Deletes multiple files. Files that didn't exist are just ignored.
+
+        Storages able to delete multiple files with a single request
+        override this, by default files are deleted one by one.
+        """
+        for file_or_id in files_or_ids:
+            self.delete(file_or_id)
+
+    def copy(self, file_or_id, target_storage=None):
+        """Copies a file to ``target_storage`` and returns the ID of the copy.
+
+        The copy keeps the same ID of the original file, like a backup performed through
+        ``target_storage.replace(stored_file, stored_file)``. When ``target_storage`` is
+        not provided the file is copied within this storage, with a new ID.
+
+        Storages able to copy files without downloading them, like S3 or GCS when the
+        target storage is on the same service, override this. By default the file
+        content is read by a background thread while it's saved to ``target_storage``,
+        so that reading and saving it overlap and only a few chunks of the file
+        are kept in memory.
+        """
+        stored_file = self.get(file_or_id)
+        piped_file = _PipedStoredFile(stored_file)
+        try:
+            if target_storage is None:
+                return self.create(piped_file)
+            return target_storage.replace(piped_file, piped_file)
+        finally:
+            piped_file.close()
+            stored_file.close()
+
     @abstractmethod
     def exists(self, file_or_id):  # pragma: no cover
         """Returns if a file or its ID still exist."""
@@ -190,3 +264,19 @@ class FileStorage(object, metaclass=ABCMeta):
         Depending on the implementation there is the possibility that this returns more IDs
         than there have been created. Therefore this method is NOT guaranteed to be RELIABLE."""
         return []
+
+    def iter_ids(self, page_size=1000, start_after=None):
+        """Iterates over the IDs of files that exist in the Storage, in ascending order.
+
+        Unlike :meth:`list` IDs are retrieved ``page_size`` at a time while iterating,
+        so storages with a lot of files can be walked without loading all of them.
+        Only IDs greater than ``start_after`` are provided, so an interrupted iteration
+        can be resumed passing the last ID it got.
+
+        By default IDs are provided by :meth:`list`, storages able to retrieve them
+        in pages override this.
+        """
+        for file_id in sorted(self.list()):
+            if start_after is None or file_id > start_after:
+                yield file_id
+
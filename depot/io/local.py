@@ -5,36 +5,68 @@ This is usefull for storing files inside a local path.
 
 """
 import os
+import heapq
+import itertools
+import mmap
 import uuid
 import shutil
 import json
 from io import BytesIO
 from datetime import datetime
 
+from depot.utils import asbool
 from .interfaces import FileStorage, StoredFile
 from . import utils
 
+FSYNC_NONE = 'none'
+FSYNC_DATA = 'data'
+FSYNC_FULL = 'full'
+
 
 class LocalStoredFile(StoredFile):
-    def __init__(self, file_id, local_path):
+    def __init__(self, file_id, local_path, metadata=None):
         _check_file_id(file_id)
 
         self._metadata_path = _metadata_path(local_path)
         self._file_path = _file_path(local_path)
         self._file = None
+        self._mmap = None
+
+        metadata_info = {'filename': 'unnamed',
+                         'content_type': 'application/octet-stream',
+                         'last_modified': None}
+        if metadata is not None:
+            # Metadata already known, usually from the storage index.
+            metadata_info.update(metadata)
+        else:
+            metadata_info.update(self._load_metadata(file_id))
 
+        super(LocalStoredFile, self).__init__(file_id=file_id, **metadata_info)
+
+    @property
+    def content_length(self):
+        # The size of the content being read is reported, as replacing a file renames
+        # its metadata and content in place one after the other, so metadata might
+        # refer to another content for a moment.
+        try:
+            return os.fstat(self._fileobj().fileno()).st_size
+        except (OSError, ValueError):
+            return self._content_length
+
+    @content_length.setter
+    def content_length(self, value):
+        self._content_length = value
+
+    def _load_metadata(self, file_id):
         try:
             metadata = open(self._metadata_path, 'r')
         except:
             raise IOError('File %s not existing' % file_id)
 
-        metadata_info = {'filename': 'unnamed',
-                         'content_type': 'application/octet-stream',
-                         'last_modified': None}
         with metadata:
             try:
                 metadata_content = metadata.read()
-                metadata_info.update(json.loads(metadata_content))
+                metadata_info = json.loads(metadata_content)
 
                 last_modified = metadata_info['last_modified']
                 if last_modified:
@@ -43,18 +75,58 @@ class LocalStoredFile(StoredFile):
             except Exception:
                 raise ValueError('Invalid file metadata for %s' % file_id)
 
-        super(LocalStoredFile, self).__init__(file_id=file_id, **metadata_info)
+        return metadata_info
 
-    def read(self, n=-1):
+    def _fileobj(self):
         if self._file is None:
             self._file = open(self._file_path, 'rb')
-        return self._file.read(n)
+        return self._file
+
+    def read(self, n=-1):
+        return self._fileobj().read(n)
+
+    def readinto(self, b):
+        return self._fileobj().readinto(b)
+
+    def getbuffer(self):
+        """Returns a read-only ``memoryview`` over the whole file content.
+
+        The file is memory mapped, so the content is not copied in memory
+        and is loaded by the operating system only as it gets accessed.
+        """
+        fileobj = self._fileobj()
+        if self._mmap is None:
+            if os.fstat(fileobj.fileno()).st_size == 0:
+                # Empty files cannot be mapped
+                return memoryview(b'')
+            self._mmap = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+
+    def fileno(self):
+        """Returns the file descriptor of the underlying file.
+
+        This permits WSGI servers to send the file with ``sendfile()``
+        when it's served through ``wsgi.file_wrapper``.
+        """
+        return self._fileobj().fileno()
+
+    def tell(self):
+        return self._fileobj().tell()
 
     def close(self):
         if self._file is None:
             self._file = _ClosedLocalFile(self._file_path)
             return
 
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Buffers returned by getbuffer are still in use,
+                # the mapping will be released with them.
+                pass
+            self._mmap = None
+
         if not self._file.closed:
             self._file.close()
 
@@ -77,41 +149,151 @@ class LocalFileStorage(FileStorage):
 
     All the files are stored inside a directory specified by the ``storage_path`` parameter.
 
+    By default each file gets its own directory right inside ``storage_path``, when
+    a lot of files are stored the ``shard_depth`` option can be used to spread them
+    across nested directories named after the first characters of the file id
+    (``ab/cd/<fileid>/`` for a ``shard_depth`` of 2).
+    Files saved with the flat layout keep resolving after enabling sharding,
+    :meth:`reshard` can be used to move them to the configured layout.
+
+    When ``metadata_index`` is enabled the metadata of the stored files is also kept in
+    a SQLite database inside ``storage_path``, so that retrieving files, checking
+    if they exist and listing them doesn't require to scan the filesystem.
+    When enabling it on an existing storage :meth:`rebuild_index` must be called
+    to index the files that were already stored.
+
+    Files are always written to a staging path and then renamed in place, so readers
+    never see partially written or missing files. When a file is replaced its metadata
+    and content are renamed in place one after the other, so for a moment readers can
+    get the new metadata together with the previous content, but ``content_length``
+    always reports the size of the content that is read.
+    The ``fsync`` option controls the durability of writes:
+
+        * ``none`` (default) leaves to the operating system when to flush data to disk.
+        * ``data`` flushes file content and metadata to disk before they are renamed in place.
+        * ``full`` also flushes the directories, so that renames survive a crash too.
+
     """
-    def __init__(self, storage_path):
+    def __init__(self, storage_path, shard_depth=0, metadata_index=False, fsync=None):
         self.storage_path = storage_path
+        self.shard_depth = int(shard_depth)
+        if not 0 <= self.shard_depth <= _MAX_SHARD_DEPTH:
+            raise ValueError('shard_depth must be between 0 and %s' % _MAX_SHARD_DEPTH)
+
+        self._fsync = fsync or FSYNC_NONE
+        if self._fsync not in (FSYNC_NONE, FSYNC_DATA, FSYNC_FULL):
+            raise ValueError('fsync must be one of %s, %s or %s' % (FSYNC_NONE, FSYNC_DATA,
+                                                                     FSYNC_FULL))
+
+        self._index = None
+        if asbool(metadata_index):
+            self._index = _MetadataIndex(os.path.join(storage_path, _INDEX_FILENAME))
 
     def __local_path(self, fileid):
-        return os.path.join(self.storage_path, fileid)
+        return os.path.join(self.storage_path, *_shards(fileid, self.shard_depth), fileid)
 
-    def get(self, file_or_id):
-        fileid = self.fileid(file_or_id)
+    def __existing_path(self, fileid):
         local_file_path = self.__local_path(fileid)
-        return LocalStoredFile(fileid, local_file_path)
+        if self.shard_depth and not os.path.isdir(local_file_path):
+            # Files stored before sharding was enabled.
+            flat_file_path = os.path.join(self.storage_path, fileid)
+            if os.path.isdir(flat_file_path):
+                return flat_file_path
+        return local_file_path
 
-    def __save_file(self, file_id, content, filename, content_type=None):
-        local_file_path = self.__local_path(file_id)
-        os.makedirs(local_file_path)
-        saved_file_path = _file_path(local_file_path)
+    def get(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        _check_file_id(fileid)
 
-        if hasattr(content, 'read'):
-            with open(saved_file_path, 'wb') as fileobj:
-                shutil.copyfileobj(content, fileobj)
+        metadata = None
+        if self._index is not None:
+            metadata = self._index.get(fileid)
+            if metadata is None:
+                raise IOError('File %s not existing' % fileid)
+
+        local_file_path = self.__existing_path(fileid)
+        return LocalStoredFile(fileid, local_file_path, metadata)
+
+    def __staging_path(self):
+        # Staging paths are on the same filesystem of the storage, so that
+        # they can be moved in place with a rename. They are never listed
+        # as they are not valid file ids.
+        return os.path.join(self.storage_path, '.%s.tmp' % uuid.uuid4().hex)
+
+    def __write_file(self, local_file_path, suffix, content, filename, content_type,
+                     link_from=None):
+        saved_file_path = _file_path(local_file_path) + suffix
+        if link_from is not None:
+            _link_file(link_from, saved_file_path)
         else:
-            if isinstance(content, str):
-                raise TypeError('Only bytes can be stored, not unicode')
-
             with open(saved_file_path, 'wb') as fileobj:
-                fileobj.write(content)
+                if hasattr(content, 'read'):
+                    utils.copyfileobj(content, fileobj)
+                else:
+                    fileobj.write(content)
                 fileobj.flush()
+                if self._fsync != FSYNC_NONE:
+                    os.fsync(fileobj.fileno())
 
         metadata = {'filename': filename,
                     'content_type': content_type,
                     'content_length': os.path.getsize(saved_file_path),
                     'last_modified': utils.timestamp()}
 
-        with open(_metadata_path(local_file_path), 'w') as metadatafile:
+        with open(_metadata_path(local_file_path) + suffix, 'w') as metadatafile:
             metadatafile.write(json.dumps(metadata))
+            metadatafile.flush()
+            if self._fsync != FSYNC_NONE:
+                os.fsync(metadatafile.fileno())
+
+        return metadata
+
+    def __save_file(self, file_id, content, filename, content_type=None, link_from=None):
+        if not hasattr(content, 'read') and isinstance(content, str):
+            raise TypeError('Only bytes can be stored, not unicode')
+
+        local_file_path = self.__existing_path(file_id)
+        if os.path.isdir(local_file_path):
+            # Replacing an existing file, stage the new content next to the
+            # current one and swap them, so readers never see missing files.
+            # Metadata and content are swapped with two renames, as the directory
+            # can't be atomically replaced, stored files report the size
+            # of the content they read to make up for it.
+            suffix = '.%s.tmp' % uuid.uuid4().hex
+            try:
+                metadata = self.__write_file(local_file_path, suffix,
+                                             content, filename, content_type, link_from)
+                os.replace(_metadata_path(local_file_path) + suffix,
+                           _metadata_path(local_file_path))
+                os.replace(_file_path(local_file_path) + suffix,
+                           _file_path(local_file_path))
+            except:
+                for staged_path in (_file_path(local_file_path) + suffix,
+                                    _metadata_path(local_file_path) + suffix):
+                    try:
+                        os.unlink(staged_path)
+                    except OSError:
+                        pass
+                raise
+        else:
+            # New file, stage the whole directory and move it in place.
+            staging_path = self.__staging_path()
+            os.makedirs(staging_path)
+            try:
+                metadata = self.__write_file(staging_path, '', content, filename, content_type,
+                                             link_from)
+                os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+                os.rename(staging_path, local_file_path)
+            except:
+                shutil.rmtree(staging_path, ignore_errors=True)
+                raise
+
+        if self._fsync == FSYNC_FULL:
+            _fsync_dir(local_file_path)
+            _fsync_dir(os.path.dirname(local_file_path))
+
+        if self._index is not None:
+            self._index.store(file_id, metadata)
 
     def create(self, content, filename=None, content_type=None):
         new_file_id = str(uuid.uuid1())
@@ -134,29 +316,274 @@ class LocalFileStorage(FileStorage):
         content, filename, content_type = self.fileinfo(content, filename, content_type,
                                                         lambda: self.get(fileid))
 
-        self.delete(fileid)
         self.__save_file(fileid, content, filename, content_type)
         return fileid
 
+    def copy(self, file_or_id, target_storage=None):
+        if target_storage is not None and not isinstance(target_storage, LocalFileStorage):
+            return super(LocalFileStorage, self).copy(file_or_id, target_storage)
+
+        fileid = self.fileid(file_or_id)
+        source = self.get(fileid)
+        source.close()
+        source_path = _file_path(self.__existing_path(fileid))
+
+        if target_storage is None:
+            target_storage, copy_id = self, str(uuid.uuid1())
+        else:
+            copy_id = fileid
+
+        target_storage.__save_file(copy_id, None, source.filename, source.content_type,
+                                   link_from=source_path)
+        return copy_id
+
     def delete(self, file_or_id):
         fileid = self.fileid(file_or_id)
         _check_file_id(fileid)
 
-        local_file_path = self.__local_path(fileid)
+        if self._index is not None:
+            # Forget the file before removing it, so it's never
+            # reported as existing when its data is not there.
+            self._index.remove(fileid)
+
+        # Move the file away before removing it, so that
+        # it is never seen partially deleted.
+        local_file_path = self.__existing_path(fileid)
+        trash_path = self.__staging_path()
         try:
-            shutil.rmtree(local_file_path)
-        except:
-            pass
+            os.rename(local_file_path, trash_path)
+        except OSError:
+            return
+
+        shutil.rmtree(trash_path, ignore_errors=True)
 
     def exists(self, file_or_id):
         fileid = self.fileid(file_or_id)
         _check_file_id(fileid)
 
-        local_file_path = self.__local_path(fileid)
+        if self._index is not None:
+            return self._index.exists(fileid)
+
+        local_file_path = self.__existing_path(fileid)
         return os.path.exists(local_file_path)
 
     def list(self):
-        return [os.path.basename(fileid) for fileid in os.listdir(self.storage_path)]
+        if self._index is not None:
+            return self._index.list()
+        return [fileid for fileid, _ in _walk_files(self.storage_path)]
+
+    def iter_ids(self, page_size=1000, start_after=None):
+        if start_after is not None:
+            _check_file_id(start_after)
+
+        if self._index is not None:
+            yield from self._index.iter_ids(int(page_size), start_after)
+        else:
+            yield from _walk_sorted_ids(self.storage_path, start_after)
+
+    def rebuild_index(self):
+        """Rebuilds the ``metadata_index`` from the files available in the storage.
+
+        This is required when enabling the index on an already existing storage
+        or after files have been changed without going through the storage.
+
+        Returns the number of indexed files.
+        """
+        if self._index is None:
+            raise RuntimeError('metadata_index is not enabled for this storage')
+
+        files = []
+        if os.path.isdir(self.storage_path):
+            for fileid, local_file_path in _walk_files(self.storage_path):
+                try:
+                    stored_file = LocalStoredFile(fileid, local_file_path)
+                except (IOError, ValueError):
+                    # Incomplete or corrupted files are not indexed.
+                    continue
+                files.append((fileid, {'filename': stored_file.filename,
+                                       'content_type': stored_file.content_type,
+                                       'content_length': stored_file.content_length,
+                                       'last_modified': stored_file.last_modified}))
+
+        self._index.rebuild(files)
+        return len(files)
+
+    def reshard(self):
+        """Moves all the stored files to the layout configured by ``shard_depth``.
+
+        This can be used to migrate an existing store to a sharded layout (or back to
+        the flat one) in place. Each file is moved with a single rename, so files
+        keep resolving while the migration is in progress.
+
+        Returns the number of files that have been moved.
+        """
+        moved = 0
+        for fileid, local_file_path in list(_walk_files(self.storage_path)):
+            target_path = self.__local_path(fileid)
+            if local_file_path == target_path:
+                continue
+
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            os.rename(local_file_path, target_path)
+            moved += 1
+
+        # Shard directories deeper than the configured layout are not used anymore.
+        for dirpath, dirnames, filenames in os.walk(self.storage_path, topdown=False):
+            relpath = os.path.relpath(dirpath, self.storage_path)
+            shards = relpath.split(os.sep)
+            if len(shards) > self.shard_depth and all(map(_is_shard, shards)):
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+
+        return moved
+
+
+class _MetadataIndex(object):
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        file_id TEXT PRIMARY KEY,
+        filename TEXT,
+        content_type TEXT,
+        content_length INTEGER,
+        last_modified TEXT
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self._db = utils._SQLiteDatabase(path, self.SCHEMA)
+
+    def get(self, file_id):
+        row = self._db.execute('SELECT filename, content_type, content_length, last_modified '
+                               'FROM files WHERE file_id = ?', (file_id, )).fetchone()
+        if row is None:
+            return None
+
+        filename, content_type, content_length, last_modified = row
+        if last_modified:
+            last_modified = datetime.fromisoformat(last_modified)
+        return {'filename': filename,
+                'content_type': content_type,
+                'content_length': content_length,
+                'last_modified': last_modified}
+
+    def exists(self, file_id):
+        row = self._db.execute('SELECT 1 FROM files WHERE file_id = ?', (file_id, )).fetchone()
+        return row is not None
+
+    def list(self):
+        return [row[0] for row in self._db.execute('SELECT file_id FROM files')]
+
+    def iter_ids(self, page_size, start_after=None):
+        while True:
+            rows = self._db.execute('SELECT file_id FROM files WHERE file_id > ? '
+                                    'ORDER BY file_id LIMIT ?',
+                                    (start_after or '', page_size)).fetchall()
+            for row in rows:
+                yield row[0]
+            if len(rows) < page_size:
+                return
+            start_after = rows[-1][0]
+
+    def store(self, file_id, metadata):
+        self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                         self._row(file_id, metadata))
+
+    def remove(self, file_id):
+        self._db.execute('DELETE FROM files WHERE file_id = ?', (file_id, ))
+
+    def rebuild(self, files):
+        with self._db.transaction() as conn:
+            conn.execute('DELETE FROM files')
+            conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)',
+                             (self._row(file_id, metadata) for file_id, metadata in files))
+
+    def _row(self, file_id, metadata):
+        last_modified = metadata['last_modified']
+        if isinstance(last_modified, datetime):
+            last_modified = last_modified.strftime('%Y-%m-%d %H:%M:%S')
+        return (file_id, metadata['filename'], metadata['content_type'],
+                metadata['content_length'], last_modified)
+
+
+_INDEX_FILENAME = 'metadata.db'
+_MAX_SHARD_DEPTH = 8
+
+
+def _shards(file_id, depth):
+    hexid = file_id.replace('-', '')
+    return [hexid[i*2:i*2+2] for i in range(depth)]
+
+
+def _is_shard(name):
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+
+def _is_file_id(name):
+    try:
+        _check_file_id(name)
+    except ValueError:
+        return False
+    return True
+
+
+def _walk_files(path):
+    # Yields (fileid, path) for all files stored at any shard depth.
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            if _is_shard(entry.name):
+                yield from _walk_files(entry.path)
+            elif _is_file_id(entry.name):
+                yield entry.name, entry.path
+
+
+def _walk_sorted_ids(path, start_after=None, shard=''):
+    # Yields ids of all files stored at any shard depth in ascending order.
+    # Shards are prefixes of the ids, so they can be walked in order, while
+    # files stored before sharding was enabled must be merged with them.
+    start_hexid = start_after.replace('-', '') if start_after else ''
+    shards = []
+    file_ids = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            if _is_shard(entry.name):
+                entry_shard = shard + entry.name
+                if entry_shard >= start_hexid[:len(entry_shard)]:
+                    shards.append((entry_shard, entry.path))
+            elif _is_file_id(entry.name):
+                if start_after is None or entry.name > start_after:
+                    file_ids.append(entry.name)
+
+    shards.sort()
+    file_ids.sort()
+    sharded_ids = itertools.chain.from_iterable(
+        _walk_sorted_ids(shard_path, start_after, entry_shard)
+        for entry_shard, shard_path in shards
+    )
+    yield from heapq.merge(file_ids, sharded_ids)
+
+
+def _link_file(source_path, target_path):
+    # Stored files are never changed in place, they are replaced
+    # by new ones, so copies can share the data of the original file.
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        # Storages on different filesystems, or links not supported.
+        shutil.copyfile(source_path, target_path)
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def _check_file_id(file_id):
@@ -5,7 +5,8 @@ This is useful for caches or tests.
 
 """
 import uuid
-import io
+import threading
+from collections import OrderedDict
 from datetime import datetime
 
 from .interfaces import FileStorage, StoredFile
@@ -13,58 +14,146 @@ from . import utils
 
 
 class MemoryStoredFile(StoredFile):
-    def __init__(self, files, file_id, file_data):
+    def __init__(self, file_id, file_data, lookup):
         _check_file_id(file_id)
-        self._files = files
-        self._files_key = file_id
-        self._file = None
+        self._file_data = file_data
+        self._lookup = lookup
+        self._buffer = None
+        self._pos = 0
+        self._closed = False
         super(MemoryStoredFile, self).__init__(file_id=file_id, **file_data['metadata'])
 
+    def _view(self):
+        if self._closed:
+            raise ValueError('I/O operation on closed file.')
+
+        if self._buffer is None:
+            # Files evicted from the storage can still be read
+            data = (self._lookup(self.file_id) or self._file_data)['data']
+            self._buffer = memoryview(data)
+        return self._buffer
+
     def read(self, n=-1):
-        if self._file is None:
-            self._file = io.BytesIO(self._files[self._files_key]['data'])
-        return self._file.read(n)
+        view = self._view()
+        start = self._pos
+        end = len(view) if n is None or n < 0 else min(start + n, len(view))
+        self._pos = end
+        if start == 0 and end == len(view):
+            # Reading the whole content, stored bytes are immutable so they can be shared.
+            return view.obj
+        return view[start:end].tobytes()
+
+    def readinto(self, b):
+        view = self._view()
+        target = memoryview(b).cast('B')
+        end = min(self._pos + len(target), len(view))
+        read = end - self._pos
+        target[:read] = view[self._pos:end]
+        self._pos = end
+        return read
+
+    def getbuffer(self):
+        """Returns a read-only ``memoryview`` over the whole file content without copying it."""
+        return self._view()[:]
 
     def close(self):
-        if self._file is None:
-            self._file = io.BytesIO(self._files[self._files_key]['data'])
-        self._file.close()
+        self._closed = True
+        self._buffer = None
 
     @property
     def closed(self):
-        if self._file is None:
-            return False
-        return self._file.closed
+        return self._closed
 
 
 class MemoryFileStorage(FileStorage):
     """:class:`depot.io.interfaces.FileStorage` implementation that keeps files in memory.
 
     This is generally useful for caches and tests.
+
+    Stored contents are kept as immutable ``bytes``, ``bytearray`` and ``memoryview``
+    contents are accepted too and are copied only when they are mutable. Reading a
+    whole file returns the stored ``bytes`` without copying them, while
+    :meth:`MemoryStoredFile.getbuffer` and ``readinto`` give access to portions of it.
+
+    When used as a cache ``max_bytes`` and ``max_files`` can be provided to
+    limit the memory it uses, when one of the limits is exceeded the least
+    recently used files are evicted. The file that was just stored is never
+    evicted, so a single file bigger than ``max_bytes`` is kept until
+    another file is stored.
+
+    Hits, misses, evictions and resident bytes are tracked in :attr:`stats`.
+
+    The storage can be safely used by multiple threads, but each process has its
+    own files. To share the same files between multiple processes on the same host
+    see :class:`depot.io.sharedmemory.SharedMemoryFileStorage`.
     """
-    def __init__(self, **kwargs):
-        self.files = {}
+    def __init__(self, max_bytes=None, max_files=None, **kwargs):
+        self.files = OrderedDict()
+        self._lock = threading.RLock()
+        self.max_bytes = int(max_bytes) if max_bytes is not None else None
+        self.max_files = int(max_files) if max_files is not None else None
+        self._resident_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def stats(self):
+        """Usage statistics of the storage."""
+        return {'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'files': len(self.files),
+                'resident_bytes': self._resident_bytes}
 
     def get(self, file_or_id):
         fileid = self.fileid(file_or_id)
         _check_file_id(fileid)
 
-        try:
-            file_data = self.files[fileid]
-        except KeyError:
-            raise IOError('File %s not existing' % fileid)
-
-        return MemoryStoredFile(self.files, fileid, file_data)
+        with self._lock:
+            try:
+                file_data = self.files[fileid]
+            except KeyError:
+                self._misses += 1
+                raise IOError('File %s not existing' % fileid)
+
+            self._hits += 1
+            self.files.move_to_end(fileid)
+        return MemoryStoredFile(fileid, file_data, self.__lookup)
+
+    def __lookup(self, file_id):
+        # Doesn't count as a hit and doesn't change the order of eviction.
+        return self.files.get(file_id)
+
+    def __open(self, file_id):
+        file_data = self.__lookup(file_id)
+        if file_data is None:
+            raise IOError('File %s not existing' % file_id)
+        return MemoryStoredFile(file_id, file_data, self.__lookup)
+
+    def __remove(self, file_id):
+        file_data = self.files.pop(file_id, None)
+        if file_data is not None:
+            self._resident_bytes -= len(file_data['data'])
+
+    def __evict(self):
+        while len(self.files) > 1 and (
+            (self.max_files is not None and len(self.files) > self.max_files) or
+            (self.max_bytes is not None and self._resident_bytes > self.max_bytes)
+        ):
+            # Least recently used files are at the beginning
+            self.__remove(next(iter(self.files)))
+            self._evictions += 1
 
     def __save_file(self, file_id, content, filename, content_type=None):
         if hasattr(content, 'read'):
-            data = content.read()
+            data = _immutable_bytes(content.read())
         else:
             if isinstance(content, str):
                 raise TypeError('Only bytes can be stored, not unicode')
-            data = content
+            data = _immutable_bytes(content)
 
-        self.files[file_id] = {
+        file_data = {
             'data': data,
             'metadata': {
                 'filename': filename or 'unknown',
@@ -73,6 +162,11 @@ class MemoryFileStorage(FileStorage):
                 'last_modified': datetime.strptime(utils.timestamp(), '%Y-%m-%d %H:%M:%S')
             }
         }
+        with self._lock:
+            self.__remove(file_id)
+            self.files[file_id] = file_data
+            self._resident_bytes += len(data)
+            self.__evict()
 
     def create(self, content, filename=None, content_type=None):
         new_file_id = str(uuid.uuid1())
@@ -93,16 +187,16 @@ class MemoryFileStorage(FileStorage):
             raise IOError('File %s not existing' % fileid)
 
         content, filename, content_type = self.fileinfo(content, filename, content_type,
-                                                        lambda: self.get(fileid))
+                                                        lambda: self.__open(fileid))
 
-        self.delete(fileid)
         self.__save_file(fileid, content, filename, content_type)
         return fileid
 
     def delete(self, file_or_id):
         fileid = self.fileid(file_or_id)
         _check_file_id(fileid)
-        self.files.pop(fileid, None)
+        with self._lock:
+            self.__remove(fileid)
 
     def exists(self, file_or_id):
         fileid = self.fileid(file_or_id)
@@ -110,7 +204,19 @@ class MemoryFileStorage(FileStorage):
         return fileid in self.files
 
     def list(self):
-        return list(self.files.keys())
+        with self._lock:
+            return list(self.files.keys())
+
+
+def _immutable_bytes(data):
+    # Stored data is shared with readers, so it must not change after
+    # it has been stored. Avoids copies when data is already immutable.
+    if isinstance(data, bytes):
+        return data
+    if (isinstance(data, memoryview) and isinstance(data.obj, bytes)
+            and data.contiguous and data.nbytes == len(data.obj)):
+        return data.obj
+    return bytes(data)
 
 
 def _check_file_id(file_id):
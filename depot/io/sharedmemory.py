@@ -0,0 +1,404 @@
+"""
+Provides FileStorage implementation to keep files in shared memory.
+
+This is useful for caches shared by all the processes of an application
+running on the same host. It relies on POSIX shared memory and file locks.
+
+"""
+import os
+import sys
+import json
+import uuid
+import fcntl
+import hashlib
+import struct
+import secrets
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from multiprocessing import shared_memory, resource_tracker
+
+from .interfaces import FileStorage, StoredFile
+from . import utils
+
+_HEADER = struct.Struct('<8sI4x')
+_MAGIC = b'DEPOTSHM'
+_SLOT_HEADER = struct.Struct('<B16sIH')
+_METADATA_SIZE = 1024
+_SLOT_SIZE = _SLOT_HEADER.size + _METADATA_SIZE
+
+_EMPTY, _USED, _DELETED = 0, 1, 2
+
+
+class SharedMemoryStoredFile(StoredFile):
+    def __init__(self, file_id, open_segment, metadata):
+        _check_file_id(file_id)
+        self._open_segment = open_segment
+        self._segment = None
+        self._buffer = None
+        self._pos = 0
+        self._closed = False
+        super(SharedMemoryStoredFile, self).__init__(file_id=file_id, **metadata)
+
+    def _view(self):
+        if self._closed:
+            raise ValueError('I/O operation on closed file.')
+
+        if self._buffer is None:
+            # The segment is only attached when content is actually needed,
+            # segments can be bigger than the content they store.
+            self._segment, content_length = self._open_segment(self.file_id)
+            self._buffer = self._segment.buf[:content_length].toreadonly()
+        return self._buffer
+
+    def read(self, n=-1):
+        view = self._view()
+        start = self._pos
+        end = len(view) if n is None or n < 0 else min(start + n, len(view))
+        self._pos = end
+        return view[start:end].tobytes()
+
+    def readinto(self, b):
+        view = self._view()
+        target = memoryview(b).cast('B')
+        end = min(self._pos + len(target), len(view))
+        read = end - self._pos
+        target[:read] = view[self._pos:end]
+        self._pos = end
+        return read
+
+    def getbuffer(self):
+        """Returns a read-only ``memoryview`` over the file content in shared memory."""
+        return self._view()[:]
+
+    def close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        if self._segment is None:
+            return
+
+        segment, self._segment = self._segment, None
+        self._buffer.release()
+        self._buffer = None
+        try:
+            segment.close()
+        except BufferError:
+            # Buffers returned by getbuffer are still in use, the segment
+            # is unmapped when they are released.
+            pass
+        finally:
+            _release_segment(segment)
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+class SharedMemoryFileStorage(FileStorage):
+    """:class:`depot.io.interfaces.FileStorage` implementation that keeps files in shared memory.
+
+    All the storages created with the same ``name`` on the same host share the same
+    files, so multiple worker processes can use a single in memory cache instead
+    of keeping a copy of it each.
+
+    Each file is saved in its own shared memory segment, while an index segment
+    maps file ids to their segment and metadata. The index has room for
+    ``max_files`` files, which is decided by the first process creating it.
+    Changes to the index are protected by a lock on the ``lock_path`` file,
+    by default in the system temporary directory, so they are safe across
+    threads and processes.
+
+    Shared memory is not released when processes terminate, use :meth:`destroy`
+    to remove the storage and all its files.
+
+    ``name`` is used as the name of the index segment, on macOS it can't be
+    longer than 30 characters.
+    """
+    def __init__(self, name='depot', max_files=1024, lock_path=None):
+        self.name = name
+        self._lock_path = lock_path or os.path.join(tempfile.gettempdir(), '%s.lock' % name)
+        self._pid = None
+        self._ensure_process()
+
+        with self._locked():
+            try:
+                self._index = _open_segment(name, create=True,
+                                            size=_HEADER.size + int(max_files) * _SLOT_SIZE)
+                _HEADER.pack_into(self._index.buf, 0, _MAGIC, int(max_files))
+            except FileExistsError:
+                self._index = _open_segment(name)
+
+        magic, self.max_files = _HEADER.unpack_from(self._index.buf, 0)
+        if magic != _MAGIC:
+            raise ValueError('Shared memory %s is not a depot storage' % name)
+
+    def _ensure_process(self):
+        # Locks cannot be shared with forked processes, as flock locks
+        # are bound to the open file they were acquired through.
+        if self._pid != os.getpid():
+            self._thread_lock = threading.Lock()
+            self._lock_file = open(self._lock_path, 'a+b')
+            self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self):
+        self._ensure_process()
+        with self._thread_lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _segment_name(self, key, token):
+        # Names are hashed to keep them short, as macOS
+        # doesn't allow names longer than 31 characters.
+        digest = hashlib.blake2b(key + token.to_bytes(4, 'little'), digest_size=12,
+                                 key=self.name.encode('utf-8')[:64])
+        return 'depot-%s' % digest.hexdigest()
+
+    def _read_slot(self, slot):
+        return _SLOT_HEADER.unpack_from(self._index.buf, _HEADER.size + slot * _SLOT_SIZE)
+
+    def _write_slot(self, slot, state, key, token, metadata=b''):
+        offset = _HEADER.size + slot * _SLOT_SIZE
+        _SLOT_HEADER.pack_into(self._index.buf, offset, state, key, token, len(metadata))
+        metadata_offset = offset + _SLOT_HEADER.size
+        self._index.buf[metadata_offset:metadata_offset + len(metadata)] = metadata
+
+    def _raw_metadata(self, slot, length):
+        offset = _HEADER.size + slot * _SLOT_SIZE + _SLOT_HEADER.size
+        return bytes(self._index.buf[offset:offset + length])
+
+    def _read_metadata(self, slot, length):
+        return json.loads(self._raw_metadata(slot, length))
+
+    def _find(self, key):
+        # Open addressing with linear probing, returns the slot
+        # holding key (or None) and the first slot available to store it.
+        start = int.from_bytes(key, 'little') % self.max_files
+        available = None
+        for probe in range(self.max_files):
+            slot = (start + probe) % self.max_files
+            state, slot_key, _, _ = self._read_slot(slot)
+            if state == _EMPTY:
+                return None, available if available is not None else slot
+            if state == _DELETED:
+                if available is None:
+                    available = slot
+            elif slot_key == key:
+                return slot, slot
+        return None, available
+
+    def _used_slots(self):
+        for slot in range(self.max_files):
+            state, key, token, length = self._read_slot(slot)
+            if state == _USED:
+                yield slot, key, token, length
+
+    def _compact(self):
+        # Removes deleted slots, so that lookups don't have to go through them.
+        used = [(key, token, self._raw_metadata(slot, length))
+                for slot, key, token, length in self._used_slots()]
+        for slot in range(self.max_files):
+            self._write_slot(slot, _EMPTY, bytes(16), 0)
+        for key, token, metadata in used:
+            _, slot = self._find(key)
+            self._write_slot(slot, _USED, key, token, metadata)
+
+    def get(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        _check_file_id(fileid)
+        key = uuid.UUID(fileid).bytes
+
+        with self._locked():
+            slot, _ = self._find(key)
+            if slot is None:
+                raise IOError('File %s not existing' % fileid)
+
+            _, _, _, length = self._read_slot(slot)
+            metadata = self._read_metadata(slot, length)
+
+        if metadata['last_modified']:
+            metadata['last_modified'] = datetime.fromisoformat(metadata['last_modified'])
+        return SharedMemoryStoredFile(fileid, self.__open_segment, metadata)
+
+    def __open_segment(self, file_id):
+        key = uuid.UUID(file_id).bytes
+        with self._locked():
+            slot, _ = self._find(key)
+            if slot is None:
+                raise IOError('File %s not existing' % file_id)
+
+            _, _, token, length = self._read_slot(slot)
+            content_length = self._read_metadata(slot, length)['content_length']
+            # Attach while holding the lock, so the segment can't be removed meanwhile.
+            return _open_segment(self._segment_name(key, token)), content_length
+
+    def __save_file(self, file_id, content, filename, content_type=None):
+        if hasattr(content, 'read'):
+            data = content.read()
+        else:
+            if isinstance(content, str):
+                raise TypeError('Only bytes can be stored, not unicode')
+            data = content
+
+        metadata = json.dumps({'filename': filename,
+                               'content_type': content_type,
+                               'content_length': len(data),
+                               'last_modified': utils.timestamp()}).encode('utf-8')
+        if len(metadata) > _METADATA_SIZE:
+            raise ValueError('Metadata of file %s is too big' % file_id)
+
+        # Copy data to shared memory before locking the index.
+        key = uuid.UUID(file_id).bytes
+        token = secrets.randbits(32)
+        segment_name = self._segment_name(key, token)
+        segment = _open_segment(segment_name, create=True, size=max(len(data), 1))
+        try:
+            segment.buf[:len(data)] = data
+        finally:
+            segment.close()
+
+        previous_segment = None
+        try:
+            with self._locked():
+                slot, available = self._find(key)
+                if slot is not None:
+                    _, _, previous_token, _ = self._read_slot(slot)
+                    previous_segment = self._segment_name(key, previous_token)
+                elif available is None:
+                    self._compact()
+                    slot, available = self._find(key)
+                    if available is None:
+                        raise IOError('Storage %s is full' % self.name)
+                self._write_slot(available, _USED, key, token, metadata)
+        except:
+            _unlink_segment(segment_name)
+            raise
+
+        if previous_segment is not None:
+            _unlink_segment(previous_segment)
+
+    def create(self, content, filename=None, content_type=None):
+        new_file_id = str(uuid.uuid1())
+        content, filename, content_type = self.fileinfo(content, filename, content_type)
+        self.__save_file(new_file_id, content, filename, content_type)
+        return new_file_id
+
+    def replace(self, file_or_id, content, filename=None, content_type=None):
+        fileid = self.fileid(file_or_id)
+        _check_file_id(fileid)
+
+        if isinstance(file_or_id, StoredFile) and file_or_id is content:
+            # This is a backup, no need to check if file exists.
+            pass
+        elif not self.exists(fileid):
+            # Check file existed and we are not using replace
+            # as a way to force a specific file id on creation.
+            raise IOError('File %s not existing' % fileid)
+
+        content, filename, content_type = self.fileinfo(content, filename, content_type,
+                                                        lambda: self.get(fileid))
+
+        self.__save_file(fileid, content, filename, content_type)
+        return fileid
+
+    def delete(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        _check_file_id(fileid)
+        key = uuid.UUID(fileid).bytes
+
+        with self._locked():
+            slot, _ = self._find(key)
+            if slot is None:
+                return
+            _, _, token, _ = self._read_slot(slot)
+            self._write_slot(slot, _DELETED, key, token)
+
+        _unlink_segment(self._segment_name(key, token))
+
+    def exists(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        _check_file_id(fileid)
+        key = uuid.UUID(fileid).bytes
+
+        with self._locked():
+            slot, _ = self._find(key)
+        return slot is not None
+
+    def list(self):
+        with self._locked():
+            return [str(uuid.UUID(bytes=key)) for _, key, _, _ in self._used_slots()]
+
+    def destroy(self):
+        """Removes the storage and all its files from shared memory.
+
+        The storage cannot be used anymore after it has been destroyed
+        by any of the processes sharing it.
+        """
+        with self._locked():
+            for _, key, token, _ in self._used_slots():
+                _unlink_segment(self._segment_name(key, token))
+            self._index.close()
+            _unlink_segment(self.name)
+
+        self._lock_file.close()
+        try:
+            os.unlink(self._lock_path)
+        except OSError:
+            pass
+
+
+def _open_segment(name, create=False, size=0):
+    # Segments must outlive the process that created them, while
+    # the resource tracker would remove them when the process exits.
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, create=create, size=size, track=False)
+
+    segment = shared_memory.SharedMemory(name, create=create, size=size)
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def _release_segment(segment):
+    # SharedMemory.close doesn't get to close the file descriptor when the
+    # mapping is still in use, the mapping itself doesn't need it.
+    if segment._fd >= 0:
+        os.close(segment._fd)
+        segment._fd = -1
+    # Leave the mapping to the buffers using it, so that it's not closed again
+    # when the segment is garbage collected.
+    segment._mmap = None
+
+
+def _unlink_segment(name):
+    try:
+        if sys.version_info >= (3, 13):
+            segment = shared_memory.SharedMemory(name, track=False)
+        else:
+            # Attaching registers the segment with the resource tracker,
+            # unlinking it unregisters it.
+            segment = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return
+
+    segment.close()
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        # Removed by another process meanwhile.
+        if sys.version_info < (3, 13):
+            resource_tracker.unregister(segment._name, 'shared_memory')
+
+
+def _check_file_id(file_id):
+    # Check that the given file id is valid, this also
+    # prevents unsafe paths.
+    try:
+        uuid.UUID('{%s}' % file_id)
+    except:
+        raise ValueError('Invalid file id %s' % file_id)
@@ -1,17 +1,46 @@
 import mimetypes
 import os
+import queue
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from tempfile import SpooledTemporaryFile
 
 from depot.utils import utcnow_naive
 
 
 INMEMORY_FILESIZE = 1024*1024
+COPY_BUFSIZE = 1024*1024
+
+
+_kept_timestamp = threading.local()
 
 
 def timestamp():
+    kept = getattr(_kept_timestamp, 'value', None)
+    if kept is not None:
+        return kept
     return utcnow_naive().strftime('%Y-%m-%d %H:%M:%S')
 
 
+@contextmanager
+def _keep_timestamp(last_modified):
+    # Files saved by the current thread get ``last_modified`` instead of the current time,
+    # so that files moved between storages keep reporting when they were saved.
+    previous = getattr(_kept_timestamp, 'value', None)
+    if last_modified is not None:
+        _kept_timestamp.value = last_modified.strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        yield
+    finally:
+        _kept_timestamp.value = previous
+
+
 def file_from_content(content):
     """Provides a real file object from file content
 
@@ -32,6 +61,40 @@ def file_from_content(content):
     return must_close, f
 
 
+def copyfileobj(fsrc, fdst, length=COPY_BUFSIZE):
+    """Copies the content of file ``fsrc`` to file ``fdst``.
+
+    Behaves like :func:`shutil.copyfileobj` but when ``fsrc`` supports
+    ``readinto`` the same buffer is reused for the whole copy instead of
+    allocating a new one for each chunk.
+    """
+    readinto = getattr(fsrc, 'readinto', None)
+    if readinto is None:
+        return shutil.copyfileobj(fsrc, fdst, length)
+
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    while True:
+        read = readinto(buffer)
+        if not read:
+            break
+        fdst.write(view[:read])
+
+
+def storage_from_options(storage):
+    """Provides a storage from a :class:`.FileStorage` or its configuration options.
+
+    This is used by storages that wrap other storages, so that the wrapped storage
+    can be configured through :meth:`.DepotManager.configure` too.
+    When a ``dict`` is provided it is expected to contain the storage options
+    without any prefix, like ``{'backend': 'depot.io.memory.MemoryFileStorage'}``.
+    """
+    if isinstance(storage, dict):
+        from depot.manager import DepotManager
+        return DepotManager.from_config(storage, prefix='')
+    return storage
+
+
 class FileIntent(object):
     """Represents the intention to upload a file
 
@@ -112,3 +175,278 @@ def _is_fieldstorage_like(obj):
     # Detect cgi.FieldStorage and multipart modules
     return (getattr(obj, 'filename', None) is not None and \
             getattr(obj, 'file', None) not in (None, False))
+
+
+class _SQLiteDatabase(object):
+    """SQLite database that can be used from multiple threads and processes.
+
+    SQLite connections cannot be shared, so each thread (and each forked process)
+    lazily opens its own connection. ``schema`` is executed on every new connection
+    so it is expected to only contain ``CREATE ... IF NOT EXISTS`` statements.
+    """
+    def __init__(self, path, schema):
+        self.path = path
+        self._schema = schema
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None or self._local.pid != os.getpid():
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(self._schema)
+            self._local.connection = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def execute(self, query, params=()):
+        return self.connection.execute(query, params)
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+
+
+class _TTLCache(object):
+    """Thread safe mapping that forgets its entries after ``ttl`` seconds.
+
+    At most ``max_entries`` are kept, when more are stored
+    the least recently used ones are discarded.
+    """
+    def __init__(self, max_entries, ttl):
+        self.max_entries = int(max_entries)
+        self.ttl = float(ttl)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                return default
+
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _SingleFlight(object):
+    """Coalesces concurrent calls for the same key into a single one.
+
+    The first thread calling :meth:`do` for a key runs the function,
+    the other threads calling it for the same key in the meanwhile
+    wait for it and share its result or exception.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """Returns the result of ``func`` and if it was shared with another caller."""
+        with self._lock:
+            call = self._calls.get(key)
+            shared = call is not None
+            if not shared:
+                call = self._calls[key] = _SingleFlightCall()
+
+        if shared:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class _SingleFlightCall(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _RangedReader(object):
+    """Reads a remote content of ``size`` bytes through parallel range requests.
+
+    ``read_range(start, end)`` must return the bytes from ``start`` to ``end``
+    (excluded). Up to ``concurrency`` ranges of ``chunk_size`` bytes are requested
+    ahead of the current read position, so the memory used is bounded by
+    ``chunk_size * concurrency``, and data is returned in order.
+    """
+    def __init__(self, read_range, size, chunk_size, concurrency):
+        self._read_range = read_range
+        self._size = size
+        self._chunk_size = int(chunk_size)
+        self._concurrency = int(concurrency)
+        self._executor = None
+        self._pending = deque()
+        self._next_offset = 0
+        self._buffer = memoryview(b'')
+
+    def __fetch(self, start, end):
+        data = self._read_range(start, end)
+        if len(data) != end - start:
+            raise IOError('Expected %d bytes at offset %d, got %d' % (end - start, start,
+                                                                       len(data)))
+        return data
+
+    def __schedule(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._concurrency)
+
+        while len(self._pending) < self._concurrency and self._next_offset < self._size:
+            start = self._next_offset
+            end = min(start + self._chunk_size, self._size)
+            self._pending.append(self._executor.submit(self.__fetch, start, end))
+            self._next_offset = end
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self._size
+
+        chunks = []
+        while n > 0:
+            if not self._buffer:
+                self.__schedule()
+                if not self._pending:
+                    break
+                self._buffer = memoryview(self._pending.popleft().result())
+                # Keep requesting ahead while the current chunk is consumed.
+                self.__schedule()
+
+            chunk = self._buffer[:n]
+            self._buffer = self._buffer[len(chunk):]
+            chunks.append(chunk)
+            n -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._buffer = memoryview(b'')
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+class _PipedReader(object):
+    """Reads ``fileobj`` in a background thread, ahead of the current read position.
+
+    Up to ``buffers`` chunks of ``chunk_size`` bytes are read ahead, so the memory
+    used is bounded by ``chunk_size * buffers`` whatever the size of the content,
+    while the content can be consumed as it's being read from ``fileobj``.
+    Errors reading ``fileobj`` are raised by :meth:`read`.
+    """
+    def __init__(self, fileobj, chunk_size, buffers):
+        self._chunks = queue.Queue(maxsize=int(buffers))
+        self._closing = threading.Event()
+        self._buffer = memoryview(b'')
+        self._eof = False
+        self._position = 0
+        self._thread = threading.Thread(target=self.__fill, args=(fileobj, int(chunk_size)),
+                                        name='depot-pipe', daemon=True)
+        self._thread.start()
+
+    def __fill(self, fileobj, chunk_size):
+        try:
+            while not self._closing.is_set():
+                chunk = fileobj.read(chunk_size)
+                if not chunk:
+                    break
+                self.__put(chunk)
+        except Exception as exc:
+            self.__put(exc)
+        else:
+            self.__put(b'')
+
+    def __put(self, item):
+        # Waits for a free buffer, unless the reader is closed in the meanwhile.
+        while not self._closing.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return
+
+    def __next_chunk(self):
+        if self._eof:
+            return b''
+
+        chunk = self._chunks.get()
+        if isinstance(chunk, Exception):
+            self._eof = True
+            raise chunk
+        if not chunk:
+            self._eof = True
+        return chunk
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = sys.maxsize
+
+        chunks = []
+        while n > 0:
+            if not self._buffer:
+                self._buffer = memoryview(self.__next_chunk())
+                if not self._buffer:
+                    break
+
+            chunk = self._buffer[:n]
+            self._buffer = self._buffer[len(chunk):]
+            chunks.append(chunk)
+            n -= len(chunk)
+
+        data = b''.join(chunks)
+        self._position += len(data)
+        return data
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._closing.set()
+        self._thread.join()
+        self._buffer = memoryview(b'')
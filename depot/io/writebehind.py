@@ -0,0 +1,274 @@
+"""
+Provides FileStorage implementation that uploads files in background.
+
+This is useful to avoid waiting for uploads to remote storages while serving requests.
+
+"""
+import os
+import time
+import fcntl
+import heapq
+import atexit
+import weakref
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .interfaces import FileStorage
+from .cached import CachedStoredFile
+from .local import LocalFileStorage
+from . import utils
+
+
+class WriteBehindFileStorage(FileStorage):
+    """:class:`depot.io.interfaces.FileStorage` implementation that uploads files in background.
+
+    New files are saved on local disk in ``staging_path`` and their id is returned
+    immediately, while they are uploaded to the ``remote`` storage by a pool of
+    ``workers`` threads. Files are served from the staging area until they
+    have been uploaded, then they are removed from it.
+
+    Uploaded files keep the ``last_modified`` of when they were staged.
+
+    Failed uploads are retried up to ``retries`` times, waiting ``retry_delay``
+    seconds before the first retry and doubling it at every retry. Files that
+    could not be uploaded are kept in the staging area and are uploaded
+    again when the storage is created the next time, like files left there by
+    a process that terminated before uploading them. Their ids are available
+    in :attr:`failed`, mapped to the error of the last attempt.
+
+    Multiple processes can share the same ``staging_path``, each staged file
+    is claimed with a lock before being uploaded so that only one of them
+    uploads and removes it, the others keep serving it from the staging area.
+
+    Replacing or deleting a file waits for its pending upload, files that were
+    already uploaded are replaced directly on the ``remote`` storage.
+    Use :meth:`flush` to wait for all the pending uploads, it's automatically
+    done when the interpreter exits unless the storage was :meth:`shutdown`.
+
+    ``remote`` can be a :class:`.FileStorage` or a dictionary of its options
+    (see :func:`depot.io.utils.storage_from_options`), so it can be configured as::
+
+        DepotManager.configure('default', {
+            'depot.backend': 'depot.io.writebehind.WriteBehindFileStorage',
+            'depot.staging_path': '/var/spool/depot',
+            'depot.remote.backend': 'depot.io.boto3.S3Storage',
+            'depot.remote.bucket': 'mybucket',
+            ...
+        })
+
+    ``fsync`` is passed to the :class:`depot.io.local.LocalFileStorage` used for the
+    staging area, use ``data`` or ``full`` to ensure staged files survive a crash.
+
+    Files are uploaded keeping the id they got in the staging area, so the ``remote``
+    storage must accept the uuid ids of :class:`depot.io.local.LocalFileStorage`.
+    :class:`depot.io.gridfs.GridFSStorage` only accepts ObjectIds and can't be used.
+    """
+    def __init__(self, remote, staging_path, workers=4, retries=3, retry_delay=1, fsync=None):
+        self.remote = utils.storage_from_options(remote)
+        os.makedirs(staging_path, exist_ok=True)
+        self.staging = LocalFileStorage(staging_path, fsync=fsync)
+        self._claims_path = os.path.join(staging_path, '.claims')
+        os.makedirs(self._claims_path, exist_ok=True)
+        self.retries = int(retries)
+        self.retry_delay = float(retry_delay)
+
+        self.failed = {}
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(max_workers=int(workers),
+                                            thread_name_prefix='depot-writebehind')
+        # Only a weak reference is kept, so that registering doesn't keep the storage alive.
+        self._flush_at_exit = functools.partial(_flush_at_exit, weakref.ref(self))
+        atexit.register(self._flush_at_exit)
+
+        # Upload files left behind by previous runs.
+        for fileid in self.staging.list():
+            self.__enqueue(fileid)
+
+    def __enqueue(self, fileid):
+        with self._lock:
+            future = self._executor.submit(self.__upload, fileid)
+            self._pending[fileid] = future
+        future.add_done_callback(lambda f: self.__uploaded(fileid, f))
+
+    def __uploaded(self, fileid, future):
+        with self._lock:
+            if self._pending.get(fileid) is future:
+                del self._pending[fileid]
+
+    def __wait(self, fileid):
+        # Waits for the pending upload of a file, if any.
+        with self._lock:
+            future = self._pending.get(fileid)
+        if future is not None:
+            wait([future])
+
+    def __claim(self, fileid):
+        # Locks the file for upload, returns None when another process already claimed it.
+        claim_path = os.path.join(self._claims_path, fileid)
+        while True:
+            claim = open(claim_path, 'a')
+            try:
+                fcntl.flock(claim, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                claim.close()
+                return None
+
+            try:
+                claimed = os.fstat(claim.fileno()).st_ino == os.stat(claim_path).st_ino
+            except FileNotFoundError:
+                claimed = False
+            if claimed:
+                return claim
+            # Released and removed by the process that uploaded it, try again.
+            claim.close()
+
+    def __release(self, fileid, claim):
+        try:
+            os.unlink(os.path.join(self._claims_path, fileid))
+        except FileNotFoundError:
+            pass
+        claim.close()
+
+    def __upload(self, fileid):
+        claim = self.__claim(fileid)
+        if claim is None:
+            # Being uploaded by another process sharing the staging area.
+            return
+
+        try:
+            self.__upload_claimed(fileid)
+        finally:
+            self.__release(fileid, claim)
+
+    def __upload_claimed(self, fileid):
+        attempt = 0
+        while True:
+            try:
+                staged = self.staging.get(fileid)
+            except IOError:
+                # Deleted while waiting to be uploaded.
+                return
+
+            try:
+                with utils._keep_timestamp(staged.last_modified):
+                    self.remote.replace(staged, staged)
+            except Exception as exc:
+                if attempt >= self.retries:
+                    # Nobody checks the result of the upload, so keep track of the failure.
+                    with self._lock:
+                        self.failed[fileid] = exc
+                    return
+                time.sleep(self.retry_delay * 2 ** attempt)
+                attempt += 1
+            else:
+                break
+            finally:
+                staged.close()
+
+        self.staging.delete(fileid)
+        with self._lock:
+            self.failed.pop(fileid, None)
+
+    def __open_content(self, fileid):
+        try:
+            staged = self.staging.get(fileid)
+            # Open the staged file right away, so that it can still
+            # be read when its upload completes and it's removed.
+            staged.fileno()
+            return staged
+        except (IOError, ValueError):
+            return self.remote.get(fileid)
+
+    def get(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        stored = self.__open_content(fileid)
+        stored.close()
+        return CachedStoredFile(fileid, self.__open_content,
+                                {'filename': stored.filename,
+                                 'content_type': stored.content_type,
+                                 'content_length': stored.content_length,
+                                 'last_modified': stored.last_modified})
+
+    def create(self, content, filename=None, content_type=None):
+        new_file_id = self.staging.create(content, filename, content_type)
+        self.__enqueue(new_file_id)
+        return new_file_id
+
+    def replace(self, file_or_id, content, filename=None, content_type=None):
+        fileid = self.fileid(file_or_id)
+        self.__wait(fileid)
+
+        if self.staging.exists(fileid):
+            # Upload failed, replace the staged file and try again.
+            self.staging.replace(fileid, content, filename, content_type)
+            self.__enqueue(fileid)
+            return fileid
+
+        return self.remote.replace(file_or_id, content, filename, content_type)
+
+    def delete(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        self.__wait(fileid)
+        self.staging.delete(fileid)
+        self.remote.delete(fileid)
+        with self._lock:
+            self.failed.pop(fileid, None)
+
+    def delete_many(self, files_or_ids):
+        fileids = [self.fileid(file_or_id) for file_or_id in files_or_ids]
+        for fileid in fileids:
+            self.__wait(fileid)
+        self.staging.delete_many(fileids)
+        self.remote.delete_many(fileids)
+        with self._lock:
+            for fileid in fileids:
+                self.failed.pop(fileid, None)
+
+    def copy(self, file_or_id, target_storage=None):
+        fileid = self.fileid(file_or_id)
+        self.__wait(fileid)
+
+        if self.staging.exists(fileid):
+            # Upload failed, the file is only available in the staging area.
+            return super(WriteBehindFileStorage, self).copy(fileid, target_storage)
+
+        return self.remote.copy(fileid, target_storage)
+
+    def exists(self, file_or_id):
+        fileid = self.fileid(file_or_id)
+        return self.staging.exists(fileid) or self.remote.exists(fileid)
+
+    def list(self):
+        # Staged files must be listed first, as they are moved to remote in the meanwhile.
+        staged_ids = self.staging.list()
+        remote_ids = self.remote.list()
+        return remote_ids + list(set(staged_ids) - set(remote_ids))
+
+    def iter_ids(self, page_size=1000, start_after=None):
+        # Staged files must be listed first, as they are moved to remote in the meanwhile.
+        staged_ids = list(self.staging.iter_ids(page_size, start_after))
+        previous_id = None
+        for fileid in heapq.merge(staged_ids, self.remote.iter_ids(page_size, start_after)):
+            if fileid != previous_id:
+                yield fileid
+            previous_id = fileid
+
+    def flush(self):
+        """Waits for all the pending uploads to complete."""
+        with self._lock:
+            pending = list(self._pending.values())
+        wait(pending)
+
+    def shutdown(self):
+        """Waits for pending uploads and stops the upload workers."""
+        atexit.unregister(self._flush_at_exit)
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+
+def _flush_at_exit(storage_ref):
+    storage = storage_ref()
+    if storage is not None:
+        storage.flush()
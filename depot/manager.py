@@ -14,6 +14,7 @@ class DepotManager(object):
     keeping compatibility with previously stored file simply change the default depot
     through :meth:`set_default` all previously stored file will continue to work
     on the old depot while new files will be uploaded to the new default one.
+    To move the previously stored files to the new depot see :mod:`depot.migrate`.
 
     """
     _default_depot = None
@@ -71,6 +72,17 @@ class DepotManager(object):
         depot = cls.get(depot_name)
         return depot.get(file_id)
 
+    @classmethod
+    def _delete_files(cls, paths):
+        # Files are deleted in bulk, with a single call for each depot.
+        file_ids = {}
+        for path in paths:
+            depot_name, file_id = path.split('/', 1)
+            file_ids.setdefault(depot_name, []).append(file_id)
+
+        for depot_name, depot_file_ids in file_ids.items():
+            cls.get(depot_name).delete_many(depot_file_ids)
+
     @classmethod
     def url_for(cls, path):
         """Given path of a file uploaded on depot returns the url that serves it
@@ -145,6 +157,11 @@ class DepotManager(object):
 
         Behaves like the :meth:`configure` method but instead of configuring the application
         depot it creates a new one each time.
+
+        Options with a dotted name are grouped in a dictionary, this is used by storages
+        that wrap other storages. For example ``depot.storage.backend`` and
+        ``depot.storage.storage_path`` are provided to the storage as a ``storage``
+        option with value ``{'backend': ..., 'storage_path': ...}``.
         """
         config = config or {}
 
@@ -157,6 +174,12 @@ class DepotManager(object):
 
         # Backend is already passed as a positional argument
         options.pop('backend', None)
+
+        # Group options of nested storages
+        for key in [k for k in options if '.' in k]:
+            name, suboption = key.split('.', 1)
+            options.setdefault(name, {})[suboption] = options.pop(key)
+
         return cls._new(backend, **options)
 
     @classmethod
@@ -3,6 +3,7 @@ from email.utils import parsedate_tz, mktime_tz
 from time import gmtime, time
 from .manager import DepotManager
 from .utils import make_content_disposition, utcfromtimestamp_naive
+from .io.utils import _TTLCache
 
 _BLOCK_SIZE = 4096 * 64 # 256K
 
@@ -130,10 +131,21 @@ class DepotMiddleware(object):
     In case you have issues serving files with your WSGI server your can try
     to set ``replace_wsgi_filewrapper=True`` which forces DEPOT to use its own
     internal FileWrapper instead of the one provided by your WSGI server.
+    Keep in mind that files stored on :class:`depot.io.local.LocalFileStorage`
+    provide a ``fileno()``, so WSGI servers whose FileWrapper supports ``sendfile()``
+    (like gunicorn and uWSGI) are able to serve them without copying their content
+    through Python, replacing the FileWrapper prevents this.
+
+    To avoid asking the storage again and again for files that do not exist, like
+    when crawlers request stale urls, not found files can be remembered for
+    ``not_found_cache_ttl`` seconds. Up to ``not_found_cache_size`` files are
+    remembered. Keep in mind that a file uploaded while it's remembered as not found
+    will be served only once ``not_found_cache_ttl`` expired, so this is disabled by default.
 
     """
     def __init__(self, app, mountpoint='/depot', cache_max_age=3600*24*7,
-                 replace_wsgi_filewrapper=False):
+                 replace_wsgi_filewrapper=False, not_found_cache_ttl=0,
+                 not_found_cache_size=1024):
         if not mountpoint.startswith('/'):
             raise ValueError('DepotMiddleware mountpoint must be an absolute path')
 
@@ -142,6 +154,11 @@ class DepotMiddleware(object):
         self.cache_max_age = cache_max_age
         self.replace_wsgi_filewrapper = replace_wsgi_filewrapper
 
+        self._not_found = None
+        if not_found_cache_ttl:
+            # Keyed by (depot_name, fileid) of the files that were not found.
+            self._not_found = _TTLCache(not_found_cache_size, not_found_cache_ttl)
+
     def url_for(self, path):
         return '/'.join((self.mountpoint, path))
 
@@ -191,19 +208,26 @@ class DepotMiddleware(object):
         if len(path) < 3:
             return self._404_response(start_response)
 
-        __, depot, fileid = path[:3]
-        depot = DepotManager.get(depot)
+        __, depot_name, fileid = path[:3]
+        depot = DepotManager.get(depot_name)
         if not depot:
             return self._404_response(start_response)
 
+        if self._not_found is not None and self._not_found.get((depot_name, fileid)):
+            return self._404_response(start_response)
+
         try:
             f = depot.get(fileid)
+            public_url = f.public_url
+            if public_url is None:
+                # Storages that load metadata lazily report missing files here.
+                fileapp = FileServeApp(f, self.cache_max_age, self.replace_wsgi_filewrapper)
         except (IOError, ValueError):
+            if self._not_found is not None:
+                self._not_found.set((depot_name, fileid), True)
             return self._404_response(start_response)
 
-        public_url = f.public_url
         if public_url is not None:
             return self._301_response(start_response, public_url)
 
-        fileapp = FileServeApp(f, self.cache_max_age, self.replace_wsgi_filewrapper)
         return fileapp(environ, start_response)
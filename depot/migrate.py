@@ -0,0 +1,288 @@
+"""
+Copies all the files of a storage to another one, keeping their ids.
+
+This can be used to move the files of an application to a new storage,
+as files keep their ids the application can then switch to the new storage
+by just changing its configuration (or an alias, see :meth:`.DepotManager.alias`).
+
+Files are copied concurrently and progress is saved to a checkpoint file,
+so that an interrupted migration can be resumed. It can be used from the
+command line with the storages configured in an ini file::
+
+    python -m depot.migrate development.ini --source depot.old. --target depot.new.
+
+As options with a dotted name are grouped for nested storages (see
+:meth:`.DepotManager.from_config`) the prefix of a storage must not be
+the beginning of the prefix of the other one.
+
+As files keep their ids, the target storage must accept the ids of the
+source one: storages using uuids as ids, like the local, S3 and GCS ones,
+can't be migrated to :class:`depot.io.gridfs.GridFSStorage` or from it.
+
+"""
+import argparse
+import configparser
+import hashlib
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from depot.io.utils import COPY_BUFSIZE
+from depot.manager import DepotManager
+
+
+VERIFY_NONE = 'none'
+VERIFY_LENGTH = 'length'
+VERIFY_CHECKSUM = 'checksum'
+
+
+class MigrationStats(object):
+    """Progress of a migration, as provided to the ``report`` callback of :func:`migrate`.
+
+    ``failed`` is a list of ``(file_id, exception)`` for files that couldn't
+    be copied or didn't pass verification.
+    """
+    def __init__(self):
+        self.copied = 0
+        self.bytes = 0
+        self.failed = []
+        self.last_checkpoint = None
+        self._started = time.monotonic()
+        self._finished = None
+
+    @property
+    def elapsed(self):
+        return (self._finished or time.monotonic()) - self._started
+
+    @property
+    def files_per_second(self):
+        return self.copied / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return '<%s copied=%s failed=%s bytes=%s elapsed=%.1fs>' % (self.__class__.__name__,
+                                                                   self.copied,
+                                                                   len(self.failed),
+                                                                   self.bytes,
+                                                                   self.elapsed)
+
+
+def read_checkpoint(path):
+    """Returns the file id saved in the checkpoint file at ``path``, ``None`` if there isn't one."""
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path, file_id):
+    """Saves ``file_id`` to the checkpoint file at ``path``.
+
+    The file is replaced atomically, so a crash never leaves a partial checkpoint.
+    """
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+        f.write(file_id)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def migrate(source, target, workers=4, checkpoint=None, verify=VERIFY_LENGTH,
+            page_size=1000, report=None, report_interval=5):
+    """Copies all the files of the ``source`` storage to the ``target`` storage.
+
+    Files are retrieved through :meth:`.FileStorage.iter_ids` and copied by ``workers``
+    threads through :meth:`.FileStorage.copy`, so they keep the same id.
+
+    When ``checkpoint`` is the path of a file, the id of the last file that was copied
+    together with all the ones before it is saved there. When the migration
+    is started again with the same checkpoint it resumes after that file.
+    Files that fail to be copied are not retried, but they stop the checkpoint from
+    moving forward, so that they are copied again when the migration is resumed.
+
+    Copied files are verified according to ``verify``: ``'length'`` compares the
+    size of the two files, ``'checksum'`` also compares their content and
+    ``'none'`` disables verification.
+
+    ``report`` is called with the :class:`MigrationStats` every ``report_interval``
+    seconds and when the migration completes. The stats are also returned.
+
+    The ``target`` must accept the ids of the files of the ``source``,
+    otherwise a ``ValueError`` is raised before any file is copied.
+    """
+    assert verify in (VERIFY_NONE, VERIFY_LENGTH, VERIFY_CHECKSUM), \
+        'verify must be one of none, length or checksum'
+
+    stats = MigrationStats()
+    start_after = read_checkpoint(checkpoint) if checkpoint else None
+    file_ids = iter(source.iter_ids(page_size=page_size, start_after=start_after))
+    first_id = next(file_ids, None)
+    if first_id is not None:
+        _check_target_accepts(target, first_id)
+        file_ids = itertools.chain([first_id], file_ids)
+    stats.last_checkpoint = saved_checkpoint = start_after
+    lock = threading.Lock()
+
+    def _copy(file_id):
+        size = _copy_file(source, target, file_id, verify)
+        with lock:
+            stats.copied += 1
+            stats.bytes += size or 0
+
+    # Copies are tracked in the order they were started, so that the checkpoint
+    # only moves past files when all the ones before them were copied.
+    pending = deque()
+    blocked = False
+    last_report = time.monotonic()
+
+    def _complete(future_file_id, future):
+        nonlocal blocked
+        try:
+            future.result()
+        except Exception as exc:
+            stats.failed.append((future_file_id, exc))
+            blocked = True
+        else:
+            if not blocked:
+                stats.last_checkpoint = future_file_id
+
+    with ThreadPoolExecutor(max_workers=int(workers), thread_name_prefix='depot-migrate') as ex:
+        for file_id in file_ids:
+            # Don't schedule more copies than the workers can take, so that ids
+            # are consumed only as fast as they are copied. The oldest copy is
+            # waited for as it's the one the checkpoint depends on.
+            while len(pending) >= int(workers) * 2:
+                _complete(*pending.popleft())
+
+            pending.append((file_id, ex.submit(_copy, file_id)))
+            while pending and pending[0][1].done():
+                _complete(*pending.popleft())
+
+            if checkpoint and stats.last_checkpoint != saved_checkpoint:
+                write_checkpoint(checkpoint, stats.last_checkpoint)
+                saved_checkpoint = stats.last_checkpoint
+
+            if report is not None and time.monotonic() - last_report >= report_interval:
+                report(stats)
+                last_report = time.monotonic()
+
+        while pending:
+            _complete(*pending.popleft())
+        if checkpoint and stats.last_checkpoint != saved_checkpoint:
+            write_checkpoint(checkpoint, stats.last_checkpoint)
+
+    stats._finished = time.monotonic()
+    if report is not None:
+        report(stats)
+    return stats
+
+
+def _check_target_accepts(target, file_id):
+    # Storages validate ids when checking if files exist, so this detects
+    # storages with incompatible ids without failing every single copy.
+    try:
+        target.exists(file_id)
+    except ValueError:
+        raise ValueError('Target storage %s does not accept ids like %s of the source storage, '
+                         'files cannot be migrated keeping their ids' % (
+                             target.__class__.__name__, file_id))
+
+
+def _copy_file(source, target, file_id, verify):
+    # Copies a single file and returns its size.
+    stored_file = source.get(file_id)
+    try:
+        size = stored_file.content_length
+    finally:
+        stored_file.close()
+
+    source.copy(file_id, target)
+    if verify == VERIFY_NONE:
+        return size
+
+    copied_file = target.get(file_id)
+    try:
+        if size is not None and copied_file.content_length != size:
+            raise IOError('File %s copied with %s bytes instead of %s' % (
+                file_id, copied_file.content_length, size
+            ))
+        if verify == VERIFY_CHECKSUM:
+            source_digest = _checksum(source.get(file_id))
+            if _checksum(copied_file) != source_digest:
+                raise IOError('File %s copied with a different content' % file_id)
+    finally:
+        copied_file.close()
+    return size
+
+
+def _checksum(stored_file):
+    hasher = hashlib.sha256()
+    try:
+        while True:
+            chunk = stored_file.read(COPY_BUFSIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    finally:
+        stored_file.close()
+    return hasher.hexdigest()
+
+
+def _print_report(stats):
+    sys.stderr.write('%d files copied, %d failed, %.1f files/s, %.1f MB/s\n' % (
+        stats.copied, len(stats.failed), stats.files_per_second,
+        stats.bytes_per_second / (1024 * 1024)
+    ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m depot.migrate',
+                                     description='Copies all files from a storage to another one.')
+    parser.add_argument('config', help='ini file with the configuration of the storages')
+    parser.add_argument('--section', default='app:main',
+                        help='section of the ini file with the storages options')
+    parser.add_argument('--source', required=True,
+                        help='prefix of the source storage options')
+    parser.add_argument('--target', required=True,
+                        help='prefix of the target storage options')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of files copied concurrently')
+    parser.add_argument('--checkpoint',
+                        help='file where progress is saved, to resume interrupted migrations')
+    parser.add_argument('--verify', default=VERIFY_LENGTH,
+                        choices=(VERIFY_NONE, VERIFY_LENGTH, VERIFY_CHECKSUM),
+                        help='how copied files are verified')
+    options = parser.parse_args(argv)
+
+    parser_config = configparser.ConfigParser(interpolation=None)
+    if not parser_config.read(options.config):
+        parser.error('cannot read %s' % options.config)
+    if not parser_config.has_section(options.section):
+        parser.error('%s has no [%s] section' % (options.config, options.section))
+    config = dict(parser_config.items(options.section))
+
+    source = DepotManager.from_config(config, prefix=options.source)
+    target = DepotManager.from_config(config, prefix=options.target)
+    try:
+        stats = migrate(source, target, workers=options.workers, checkpoint=options.checkpoint,
+                        verify=options.verify, report=_print_report)
+    except ValueError as exc:
+        sys.stderr.write('%s\n' % exc)
+        return 1
+
+    for file_id, exc in stats.failed:
+        sys.stderr.write('%s: %s\n' % (file_id, exc))
+    return 1 if stats.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
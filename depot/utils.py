@@ -12,6 +12,13 @@ def utcfromtimestamp_naive(ts):
     return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None)
 
 
+def asbool(value):
+    """Converts boolean options that might come from configuration files as strings."""
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'yes', 'on', 'y', 't', '1')
+    return bool(value)
+
+
 def make_content_disposition(disposition, fname):
     rfc6266_part = "filename*=utf-8''%s" % (quote(fname, safe='!#$&+-.^_`|~', encoding='utf-8', errors='strict'), )
     ascii_part = 'filename="%s"' % (anyascii(fname), )
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
+import io
+import shutil
+import tempfile
 import os
 import uuid
+import threading
 import unittest
 import mock
+from contextlib import contextmanager
+from depot.io.utils import FileIntent
 import requests
 from flaky import flaky
 from unittest import SkipTest
@@ -39,6 +45,7 @@ class TestS3FileStorage(unittest.TestCase):
         self.cred = (access_key_id, secret_access_key)
         self.bucket = 'filedepot-testfs-%s' % self.run_id
         self.fs = S3Storage(*self.cred, bucket=self.bucket)
+        self.fs.list()  # Bucket is created on first use.
 
     @classmethod
     def tearDownClass(self):
@@ -59,6 +66,19 @@ class TestS3FileStorage(unittest.TestCase):
         else:
             self.fs._bucket_driver.bucket.wait_until_not_exists()
 
+    @contextmanager
+    def _count_api_calls(self, record=lambda operation_name, kwarg: operation_name):
+        """Records the S3 operations performed in the context, by name unless ``record`` is provided."""
+        from botocore.client import BaseClient
+        make_api_call = BaseClient._make_api_call
+        operations = []
+        def record_api_call(cli, operation_name, kwarg):
+            operations.append(record(operation_name, kwarg))
+            return make_api_call(cli, operation_name, kwarg)
+
+        with mock.patch('botocore.client.BaseClient._make_api_call', new=record_api_call):
+            yield operations
+
     def test_fileoutside_depot(self):
         fid = str(uuid.uuid1())
         key = self.fs._bucket_driver.new_key(fid)
@@ -68,41 +88,74 @@ class TestS3FileStorage(unittest.TestCase):
         assert f.read() == FILE_CONTENT
 
     def test_creates_bucket_when_missing(self):
+        from botocore.exceptions import ClientError
         created_buckets = []
         def mock_make_api_call(_, operation_name, kwarg):
-            if operation_name == 'ListBuckets':
-                return {'Buckets': []}
-            elif operation_name == 'CreateBucket':
+            if operation_name == 'CreateBucket':
                 created_buckets.append(kwarg['Bucket'])
                 return None
             elif operation_name == 'HeadBucket':
                 if kwarg['Bucket'] in created_buckets:
                     return {'ResponseMetadata': {'HTTPStatusCode': 200}}
                 else:
-                    return {}
+                    raise ClientError(error_response={'Error': {'Code': '404'}},
+                                      operation_name=operation_name)
+            elif operation_name == 'HeadObject':
+                raise ClientError(error_response={'Error': {'Code': '404'}},
+                                  operation_name=operation_name)
             else:
                 assert False, 'Unexpected Call'
 
         from depot.io.boto3 import CANNED_ACL_PRIVATE
         with mock.patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
-            S3Storage(*self.cred, policy=CANNED_ACL_PRIVATE)
+            fs = S3Storage(*self.cred, policy=CANNED_ACL_PRIVATE)
+            assert created_buckets == []
+            assert not fs.exists(str(uuid.uuid1()))
+            assert not fs.exists(str(uuid.uuid1()))
         assert created_buckets == [self.default_bucket_name]
 
     def test_bucket_failure(self):
         from botocore.exceptions import ClientError
         def mock_make_api_call(_, operation_name, kwarg):
-            if operation_name == 'ListBuckets':
+            if operation_name == 'HeadBucket':
                 raise ClientError(error_response={'Error': {'Code': 500}},
                                   operation_name=operation_name)
 
         try:
             with mock.patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
-                S3Storage(*self.cred)
+                fs = S3Storage(*self.cred)
+                fs.exists(str(uuid.uuid1()))
         except ClientError:
             pass
         else:
             assert False, 'Should have reraised ClientError'
 
+    def test_no_requests_on_creation(self):
+        def mock_make_api_call(_, operation_name, kwarg):
+            assert False, 'Unexpected Call %s' % operation_name
+
+        with mock.patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+            S3Storage(*self.cred, bucket=self.bucket)
+
+    def test_ensure_bucket_head(self):
+        fs = S3Storage(*self.cred, bucket='%s-missing' % self.bucket, ensure_bucket='head')
+        with self.assertRaises(IOError):
+            fs.create(FILE_CONTENT)
+
+        fs = S3Storage(*self.cred, bucket=self.bucket, ensure_bucket='head')
+        fid = fs.create(FILE_CONTENT)
+        assert fs.get(fid).read() == FILE_CONTENT
+
+    def test_ensure_bucket_off(self):
+        fs = S3Storage(*self.cred, bucket=self.bucket, ensure_bucket='off')
+        with self._count_api_calls() as operations:
+            fid = fs.create(FILE_CONTENT)
+        assert operations == ['PutObject'], operations
+
+    def test_invalid_ensure_bucket(self):
+        with self.assertRaises(AssertionError):
+            S3Storage(*self.cred, ensure_bucket='always')
+
     def test_client_receives_extra_args(self):
         with mock.patch('boto3.session.Session.client'), mock.patch('boto3.session.Session.resource') as mockresource:
             S3Storage(*self.cred, endpoint_url='http://somehwere.it', region_name='worlwide')
@@ -158,3 +211,332 @@ class TestS3FileStorage(unittest.TestCase):
 
         key = self.fs._bucket_driver.get_key(fid)
         assert key.storage_class == 'STANDARD_IA'
+
+    def test_multipart_upload(self):
+        class NonSeekableStream(io.RawIOBase):
+            def __init__(self, data):
+                self._data = io.BytesIO(data)
+            def readable(self):
+                return True
+            def readinto(self, b):
+                return self._data.readinto(b)
+
+        content = os.urandom(11 * 1024 * 1024)
+        fs = S3Storage(*self.cred, bucket=self.bucket,
+                       multipart_threshold=5 * 1024 * 1024,
+                       multipart_chunksize=5 * 1024 * 1024)
+        with self._count_api_calls() as operations:
+            fid = fs.create(NonSeekableStream(content), 'big.bin', 'application/octet-stream')
+
+        assert operations.count('UploadPart') == 3, operations
+        assert 'CompleteMultipartUpload' in operations, operations
+
+        f = fs.get(fid)
+        assert f.filename == 'big.bin'
+        assert f.content_type == 'application/octet-stream'
+        assert f.read() == content
+
+    def test_small_bytes_single_request(self):
+        with self._count_api_calls() as operations:
+            self.fs.create(FILE_CONTENT, 'file.txt')
+        assert operations == ['PutObject'], operations
+
+    def test_parallel_download(self):
+        content = os.urandom(11 * 1024 * 1024)
+        fs = S3Storage(*self.cred, bucket=self.bucket,
+                       multipart_chunksize=5 * 1024 * 1024, parallel_download=True)
+        fid = fs.create(content)
+
+        with self._count_api_calls(lambda name, kwarg: kwarg.get('Range')) as ranges:
+            f = fs.get(fid)
+            assert f.read(1024) == content[:1024]
+            assert f.read() == content[1024:]
+        ranges = [r for r in ranges if r is not None]
+        assert sorted(ranges) == ['bytes=0-5242879', 'bytes=10485760-11534335',
+                                  'bytes=5242880-10485759'], ranges
+
+    def test_download_to(self):
+        content = os.urandom(11 * 1024 * 1024)
+        fs = S3Storage(*self.cred, bucket=self.bucket,
+                       multipart_threshold=5 * 1024 * 1024,
+                       multipart_chunksize=5 * 1024 * 1024)
+        fid = fs.create(content)
+
+        target = tempfile.mkdtemp()
+        try:
+            path = os.path.join(target, 'downloaded.bin')
+            fs.get(fid).download_to(path)
+            with open(path, 'rb') as downloaded:
+                assert downloaded.read() == content
+        finally:
+            shutil.rmtree(target)
+
+    def test_lazy_metadata(self):
+        fs = S3Storage(*self.cred, bucket=self.bucket, lazy_metadata=True)
+        fid = fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+
+        with self._count_api_calls() as operations:
+            f = fs.get(fid)
+            assert f.public_url.endswith('/%s' % fid), f.public_url
+            assert operations == [], operations
+
+            assert f.read() == FILE_CONTENT
+            assert f.filename == 'file.txt'
+            assert f.content_type == 'text/plain'
+            assert f.content_length == len(FILE_CONTENT)
+            assert f.last_modified is not None
+            assert operations == ['GetObject'], operations
+
+            del operations[:]
+            f = fs.get(fid)
+            assert f.filename == 'file.txt'
+            assert f.read() == FILE_CONTENT
+            assert operations == ['HeadObject', 'GetObject'], operations
+
+    def test_delete_single_request(self):
+        fid = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+        with self._count_api_calls() as operations:
+            self.fs.delete(fid)
+            self.fs.delete(fid)
+        assert operations == ['DeleteObject', 'DeleteObject'], operations
+        assert not self.fs.exists(fid)
+
+    def test_delete_many_batches(self):
+        fids = [self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain') for _ in range(3)]
+        missing_fids = [str(uuid.uuid1()) for _ in range(1000)]
+        with self._count_api_calls(lambda name, kwarg: (name, len(kwarg['Delete']['Objects']))) as operations:
+            self.fs.delete_many(fids + missing_fids)
+        assert operations == [('DeleteObjects', 1000), ('DeleteObjects', 3)], operations
+        for fid in fids:
+            assert not self.fs.exists(fid)
+
+    def test_delete_many_failure(self):
+        from botocore.client import BaseClient
+        make_api_call = BaseClient._make_api_call
+        def mock_make_api_call(cli, operation_name, kwarg):
+            if operation_name == 'DeleteObjects':
+                return {'Errors': [{'Key': kwarg['Delete']['Objects'][0]['Key'],
+                                    'Code': 'AccessDenied', 'Message': 'Access Denied'}]}
+            return make_api_call(cli, operation_name, kwarg)
+
+        fid = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+        with mock.patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+            with self.assertRaises(IOError):
+                self.fs.delete_many([fid])
+
+    def test_iter_ids_pages(self):
+        fs = S3Storage(*self.cred, bucket=self.bucket, prefix='iter-%s/' % uuid.uuid1().hex)
+        file_ids = sorted(fs.create(FILE_CONTENT) for _ in range(5))
+
+        with self._count_api_calls() as operations:
+            assert list(fs.iter_ids(page_size=2)) == file_ids
+            assert operations == ['ListObjectsV2'] * 3, operations
+
+            del operations[:]
+            assert list(fs.iter_ids(page_size=2, start_after=file_ids[2])) == file_ids[3:]
+            assert operations == ['ListObjectsV2'], operations
+
+    def test_copy_server_side(self):
+        fid = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+        other = S3Storage(*self.cred, bucket=self.bucket, prefix='copies/')
+        with self._count_api_calls() as operations:
+            copy_id = self.fs.copy(fid)
+            assert self.fs.copy(fid, other) == fid
+        assert 'CopyObject' in operations, operations
+        assert 'GetObject' not in operations, operations
+        assert 'PutObject' not in operations, operations
+
+        for f in (self.fs.get(copy_id), other.get(fid)):
+            assert f.filename == 'file.txt'
+            assert f.content_type == 'text/plain'
+            assert f.read() == FILE_CONTENT
+
+    def test_copy_to_other_service(self):
+        from depot.io.memory import MemoryFileStorage
+        fid = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+        other = MemoryFileStorage()
+        assert self.fs.copy(fid, other) == fid
+        assert other.get(fid).read() == FILE_CONTENT
+
+    def test_lazy_metadata_missing_file(self):
+        fs = S3Storage(*self.cred, bucket=self.bucket, lazy_metadata=True)
+
+        f = fs.get(str(uuid.uuid1()))
+        with self.assertRaises(IOError):
+            f.filename
+        f = fs.get(str(uuid.uuid1()))
+        with self.assertRaises(IOError):
+            f.read()
+
+
+class FakeS3(object):
+    """Answers S3 API calls for objects from memory, recording the called operations.
+
+    Parts of multipart uploads listed in ``failing_parts`` fail to upload.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.failing_parts = set()
+        self.operations = []
+        self._lock = threading.Lock()
+
+    def __call__(self, operation_name, kwarg):
+        from botocore.exceptions import ClientError
+        with self._lock:
+            self.operations.append(operation_name)
+
+        if operation_name == 'PutObject':
+            body = kwarg['Body']
+            if hasattr(body, 'read'):
+                body = body.read()
+            self.objects[kwarg['Key']] = {'Body': body,
+                                          'Metadata': kwarg.get('Metadata', {}),
+                                          'ContentType': kwarg.get('ContentType')}
+            return {'ETag': '"%s"' % uuid.uuid1().hex}
+        elif operation_name == 'CreateMultipartUpload':
+            upload_id = uuid.uuid1().hex
+            self.uploads[upload_id] = {'Key': kwarg['Key'], 'Parts': {},
+                                       'Metadata': kwarg.get('Metadata', {}),
+                                       'ContentType': kwarg.get('ContentType')}
+            return {'UploadId': upload_id}
+        elif operation_name == 'UploadPart':
+            if kwarg['PartNumber'] in self.failing_parts:
+                raise ClientError({'Error': {'Code': 'InternalError',
+                                             'Message': 'Part upload failed'}}, operation_name)
+            etag = '"%s"' % uuid.uuid1().hex
+            self.uploads[kwarg['UploadId']]['Parts'][kwarg['PartNumber']] = (
+                etag, kwarg['Body'].read()
+            )
+            return {'ETag': etag}
+        elif operation_name == 'CompleteMultipartUpload':
+            upload = self.uploads.pop(kwarg['UploadId'])
+            body = b''
+            for part in kwarg['MultipartUpload']['Parts']:
+                etag, data = upload['Parts'][part['PartNumber']]
+                assert etag == part['ETag']
+                body += data
+            self.objects[upload['Key']] = {'Body': body,
+                                           'Metadata': upload['Metadata'],
+                                           'ContentType': upload['ContentType']}
+            return {'ETag': '"%s-%d"' % (uuid.uuid1().hex, len(upload['Parts']))}
+        elif operation_name == 'AbortMultipartUpload':
+            self.uploads.pop(kwarg['UploadId'], None)
+            return {}
+
+        stored = self.objects.get(kwarg['Key'])
+        if stored is None:
+            code = 'NoSuchKey' if operation_name == 'GetObject' else '404'
+            raise ClientError({'Error': {'Code': code, 'Message': 'Not Found'}}, operation_name)
+
+        response = {'Metadata': stored['Metadata'], 'ContentType': stored['ContentType'],
+                    'ContentLength': len(stored['Body']), 'ETag': '"etag"'}
+        if operation_name == 'GetObject':
+            from botocore.response import StreamingBody
+            response['Body'] = StreamingBody(io.BytesIO(stored['Body']), len(stored['Body']))
+        return response
+
+
+class TestS3StorageRequests(unittest.TestCase):
+    def setUp(self):
+        try:
+            global S3Storage
+            from depot.io.boto3 import S3Storage
+        except ImportError:
+            raise SkipTest('Boto not installed')
+
+        self.s3 = FakeS3()
+        patcher = mock.patch('botocore.client.BaseClient._make_api_call', new=self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fs = S3Storage('access_key', 'secret_key', bucket='filedepot-test',
+                            ensure_bucket='off')
+
+    def test_get_single_request(self):
+        fid = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+
+        del self.s3.operations[:]
+        f = self.fs.get(fid)
+        assert f.filename == 'file.txt'
+        assert f.read() == FILE_CONTENT
+        assert self.s3.operations == ['HeadObject', 'GetObject'], self.s3.operations
+
+    def test_big_files_multipart_upload(self):
+        chunksize = 5 * 1024 * 1024
+        fs = S3Storage('access_key', 'secret_key', bucket='filedepot-test', ensure_bucket='off',
+                       multipart_threshold=chunksize, multipart_chunksize=chunksize)
+
+        content = b'a' * (chunksize - 1)
+        fid = fs.create(io.BytesIO(content), 'file.txt', 'text/plain')
+        assert self.s3.operations == ['PutObject'], self.s3.operations
+        assert self.s3.objects[fid]['Body'] == content
+
+        del self.s3.operations[:]
+        content = b'a' * chunksize + b'b' * chunksize + b'c'
+        fid = fs.create(io.BytesIO(content), 'file.txt', 'text/plain')
+        assert sorted(self.s3.operations) == ['CompleteMultipartUpload', 'CreateMultipartUpload',
+                                              'UploadPart', 'UploadPart', 'UploadPart'], \
+            self.s3.operations
+        assert self.s3.uploads == {}
+
+        f = fs.get(fid)
+        assert f.filename == 'file.txt'
+        assert f.content_type == 'text/plain'
+        assert f.read() == content
+
+    def test_failed_multipart_upload_is_aborted(self):
+        from botocore.exceptions import ClientError
+        chunksize = 5 * 1024 * 1024
+        fs = S3Storage('access_key', 'secret_key', bucket='filedepot-test', ensure_bucket='off',
+                       multipart_threshold=chunksize, multipart_chunksize=chunksize)
+
+        self.s3.failing_parts.add(2)
+        with self.assertRaises(ClientError):
+            fs.create(io.BytesIO(b'a' * chunksize * 2), 'file.txt', 'text/plain')
+        assert 'AbortMultipartUpload' in self.s3.operations, self.s3.operations
+        assert 'CompleteMultipartUpload' not in self.s3.operations, self.s3.operations
+        assert self.s3.uploads == {}
+        assert self.s3.objects == {}
+
+    def test_replace_single_metadata_request(self):
+        fid = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+
+        del self.s3.operations[:]
+        self.fs.replace(fid, io.BytesIO(b'NEW CONTENT'))
+        assert self.s3.operations == ['HeadObject', 'PutObject'], self.s3.operations
+
+        del self.s3.operations[:]
+        with self.assertRaises(IOError):
+            self.fs.replace(str(uuid.uuid1()), b'NEW CONTENT')
+        assert self.s3.operations == ['HeadObject'], self.s3.operations
+
+        f = self.fs.get(fid)
+        assert f.filename == 'file.txt'
+        assert f.content_type == 'text/plain'
+        assert f.read() == b'NEW CONTENT'
+
+    def test_backup_without_metadata_request(self):
+        fid = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+        f = self.fs.get(fid)
+
+        del self.s3.operations[:]
+        self.fs.replace(f, f)
+        assert self.s3.operations == ['GetObject', 'PutObject'], self.s3.operations
+
+        f = self.fs.get(fid)
+        assert f.filename == 'file.txt'
+        assert f.read() == FILE_CONTENT
+
+    def test_small_files_single_request(self):
+        with mock.patch('boto3.s3.inject.create_transfer_manager') as create_transfer_manager:
+            fid = self.fs.create(io.BytesIO(FILE_CONTENT), 'file.txt')
+            self.fs.replace(fid, FILE_CONTENT)
+        assert not create_transfer_manager.called
+        assert self.s3.operations == ['PutObject', 'HeadObject', 'PutObject'], self.s3.operations
+        assert self.fs.get(fid).read() == FILE_CONTENT
+
+    def test_small_file_uploaded_from_current_position(self):
+        content = io.BytesIO(b'IGNORED' + FILE_CONTENT)
+        content.seek(len(b'IGNORED'))
+        fid = self.fs.create(FileIntent(content, 'file.txt', 'text/plain'))
+        assert self.fs.get(fid).read() == FILE_CONTENT
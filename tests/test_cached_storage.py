@@ -0,0 +1,248 @@
+import time
+import threading
+import shutil
+import unittest
+import mock
+from depot.io.cached import CachedFileStorage, MetadataCachedFileStorage
+from depot.io.local import LocalFileStorage
+from depot.io.memory import MemoryFileStorage
+from depot.manager import DepotManager
+
+FILE_CONTENT = b'HELLO WORLD'
+
+
+def run_concurrently(threads, func):
+    results = [None] * threads
+
+    def run(i):
+        try:
+            results[i] = func()
+        except Exception as e:
+            results[i] = e
+
+    workers = [threading.Thread(target=run, args=(i, )) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+class TestCachedFileStorage(unittest.TestCase):
+    def setUp(self):
+        self.origin = MemoryFileStorage()
+        self.cache = MemoryFileStorage()
+        self.fs = CachedFileStorage(self.origin, self.cache)
+
+    def test_get_populates_cache(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+        assert not self.cache.exists(file_id)
+
+        f = self.fs.get(file_id)
+        assert self.cache.exists(file_id)
+        assert f.filename == 'file.txt'
+        assert f.content_type == 'text/plain'
+        assert f.read() == FILE_CONTENT
+
+    def test_origin_metadata_is_kept(self):
+        with mock.patch('depot.io.utils.timestamp', return_value='2001-01-01 00:00:01'):
+            file_id = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+        origin_file = self.origin.get(file_id)
+
+        f = self.fs.get(file_id)
+        assert f.last_modified == origin_file.last_modified
+        assert self.fs.get(file_id).last_modified == origin_file.last_modified
+
+        # Another process sharing the same cache.
+        other = CachedFileStorage(self.origin, self.cache)
+        f = other.get(file_id)
+        assert f.filename == 'file.txt'
+        assert f.content_type == 'text/plain'
+        assert f.last_modified == origin_file.last_modified
+        assert f.read() == FILE_CONTENT
+
+    def test_get_opens_cached_content_once(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        self.fs.get(file_id).read()
+
+        with mock.patch.object(self.cache, 'get', wraps=self.cache.get) as cache_get:
+            assert self.fs.get(file_id).read() == FILE_CONTENT
+        assert cache_get.call_count == 1
+
+    def test_read_replaced_file(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        f = self.fs.get(file_id)
+        self.fs.replace(file_id, b'NEW CONTENT')
+        assert f.read() == b'NEW CONTENT'
+
+    def test_hits_do_not_reach_origin(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        self.fs.get(file_id).read()
+
+        with mock.patch.object(self.origin, 'get') as origin_get:
+            assert self.fs.get(file_id).read() == FILE_CONTENT
+        assert origin_get.call_count == 0
+
+    def test_replace_invalidates_cache(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        self.fs.get(file_id).read()
+
+        self.fs.replace(file_id, b'NEW CONTENT')
+        assert not self.cache.exists(file_id)
+        assert self.fs.get(file_id).read() == b'NEW CONTENT'
+
+    def test_replace_while_caching_discards_copy(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        cache_replace = self.cache.replace
+
+        def replaced_while_copying(*args, **kwargs):
+            # The file is replaced after it was read from origin, but before it's cached.
+            self.fs.replace(file_id, b'NEW CONTENT')
+            return cache_replace(*args, **kwargs)
+
+        with mock.patch.object(self.cache, 'replace', side_effect=replaced_while_copying):
+            self.fs.get(file_id)
+        assert not self.cache.exists(file_id)
+        assert self.fs.get(file_id).read() == b'NEW CONTENT'
+        assert self.fs._generations == {}
+
+    def test_delete_invalidates_cache(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        self.fs.get(file_id).read()
+
+        self.fs.delete(file_id)
+        assert not self.cache.exists(file_id)
+        with self.assertRaises(IOError):
+            self.fs.get(file_id)
+
+    def test_max_bytes_evicts_least_recently_used(self):
+        fs = CachedFileStorage(self.origin, self.cache, max_bytes=len(FILE_CONTENT) * 2)
+        file_ids = [fs.create(FILE_CONTENT) for _ in range(3)]
+
+        fs.get(file_ids[0])
+        fs.get(file_ids[1])
+        fs.get(file_ids[0])
+        fs.get(file_ids[2])
+
+        assert self.cache.exists(file_ids[0])
+        assert not self.cache.exists(file_ids[1])
+        assert self.cache.exists(file_ids[2])
+
+    def test_serves_from_origin_when_cache_fails(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        with mock.patch.object(self.cache, 'replace', side_effect=IOError('disk full')):
+            assert self.fs.get(file_id).read() == FILE_CONTENT
+
+    def test_concurrent_misses_download_once(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        origin_get = self.origin.get
+
+        def slow_get(file_or_id):
+            time.sleep(0.2)
+            return origin_get(file_or_id)
+
+        with mock.patch.object(self.origin, 'get', side_effect=slow_get) as get:
+            results = run_concurrently(8, lambda: self.fs.get(file_id).read())
+        assert results == [FILE_CONTENT] * 8
+        assert get.call_count == 1
+
+    def test_configure(self):
+        fs = DepotManager.from_config({
+            'depot.backend': 'depot.io.cached.CachedFileStorage',
+            'depot.max_bytes': '1024',
+            'depot.origin.backend': 'depot.io.memory.MemoryFileStorage',
+            'depot.cache.backend': 'depot.io.local.LocalFileStorage',
+            'depot.cache.storage_path': './lfs'
+        })
+        try:
+            assert isinstance(fs.origin, MemoryFileStorage)
+            assert isinstance(fs.cache, LocalFileStorage)
+            assert fs.max_bytes == 1024
+
+            file_id = fs.create(FILE_CONTENT)
+            assert fs.get(file_id).read() == FILE_CONTENT
+            assert fs.cache.exists(file_id)
+        finally:
+            shutil.rmtree('./lfs', ignore_errors=True)
+
+
+class TestMetadataCachedFileStorage(unittest.TestCase):
+    def setUp(self):
+        self.storage = MemoryFileStorage()
+        self.fs = MetadataCachedFileStorage(self.storage, max_entries=2, ttl=60)
+
+    def test_metadata_served_from_cache(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+        self.fs.get(file_id)
+
+        with mock.patch.object(self.storage, 'get') as storage_get:
+            f = self.fs.get(file_id)
+            assert f.filename == 'file.txt'
+            assert f.content_type == 'text/plain'
+            assert f.content_length == len(FILE_CONTENT)
+            assert f.public_url is None
+            assert self.fs.exists(file_id)
+        assert storage_get.call_count == 0
+
+    def test_content_read_from_storage(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        self.fs.get(file_id)
+
+        with mock.patch.object(self.storage, 'get', wraps=self.storage.get) as storage_get:
+            assert self.fs.get(file_id).read() == FILE_CONTENT
+        assert storage_get.call_count == 1
+
+    def test_expired_metadata(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        self.fs.get(file_id)
+        self.storage.replace(file_id, FILE_CONTENT, 'other.txt')
+
+        assert self.fs.get(file_id).filename == 'file.txt'
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+            assert self.fs.get(file_id).filename == 'other.txt'
+
+    def test_max_entries(self):
+        file_ids = [self.fs.create(FILE_CONTENT) for _ in range(3)]
+        for file_id in file_ids:
+            self.fs.get(file_id)
+
+        with mock.patch.object(self.storage, 'get', wraps=self.storage.get) as storage_get:
+            self.fs.get(file_ids[0])
+            self.fs.get(file_ids[2])
+        assert storage_get.call_count == 1
+
+    def test_replace_invalidates_metadata(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        self.fs.get(file_id)
+
+        self.fs.replace(file_id, b'NEW CONTENT', 'new.txt')
+        f = self.fs.get(file_id)
+        assert f.filename == 'new.txt'
+        assert f.content_length == len(b'NEW CONTENT')
+
+    def test_concurrent_lookups_are_coalesced(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        storage_get = self.storage.get
+
+        def slow_get(file_or_id):
+            time.sleep(0.2)
+            return storage_get(file_or_id)
+
+        with mock.patch.object(self.storage, 'get', side_effect=slow_get) as get:
+            results = run_concurrently(8, lambda: self.fs.get(file_id).filename)
+        assert results == ['file.txt'] * 8
+        assert get.call_count == 1
+
+    def test_failed_lookups_are_shared(self):
+        with mock.patch.object(self.storage, 'get', side_effect=IOError('not found')):
+            results = run_concurrently(4, lambda: self.fs.get('4e2a5c42-2c88-11e4-8d66-28cfe9a3b4e5'))
+        assert all(isinstance(r, IOError) for r in results)
+
+    def test_delete_invalidates_metadata(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        self.fs.get(file_id)
+
+        self.fs.delete(file_id)
+        assert not self.fs.exists(file_id)
+        with self.assertRaises(IOError):
+            self.fs.get(file_id)
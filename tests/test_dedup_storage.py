@@ -0,0 +1,92 @@
+import io
+import shutil
+import unittest
+import mock
+from depot.manager import DepotManager
+from depot.io.memory import MemoryFileStorage
+from depot.io.dedup import DeduplicatingFileStorage
+
+FILE_CONTENT = b'HELLO WORLD'
+
+
+class TestDeduplicatingFileStorage(unittest.TestCase):
+    def setUp(self):
+        self.blobs = MemoryFileStorage()
+        self.fs = DeduplicatingFileStorage(self.blobs, './lfs/dedup.db')
+
+    def tearDown(self):
+        shutil.rmtree('./lfs', ignore_errors=True)
+
+    def test_duplicates_are_stored_once(self):
+        first_id = self.fs.create(FILE_CONTENT, 'first.txt')
+        second_id = self.fs.create(io.BytesIO(FILE_CONTENT), 'second.png')
+        assert first_id != second_id
+        assert len(self.blobs.list()) == 1
+
+        first, second = self.fs.get(first_id), self.fs.get(second_id)
+        assert (first.filename, first.content_type) == ('first.txt', 'text/plain')
+        assert (second.filename, second.content_type) == ('second.png', 'image/png')
+        assert first.read() == second.read() == FILE_CONTENT
+        assert second.content_length == len(FILE_CONTENT)
+
+    def test_duplicates_have_no_public_url(self):
+        self.fs.create(FILE_CONTENT, 'first.txt')
+        second = self.fs.get(self.fs.create(FILE_CONTENT, 'second.png'))
+
+        with mock.patch('depot.io.memory.MemoryStoredFile.public_url',
+                                 new_callable=mock.PropertyMock,
+                                 return_value='http://example.com/shared'):
+            assert second.public_url is None
+
+    def test_content_is_deleted_with_last_reference(self):
+        first_id = self.fs.create(FILE_CONTENT, 'first.txt')
+        second_id = self.fs.create(FILE_CONTENT, 'second.txt')
+
+        self.fs.delete(first_id)
+        assert len(self.blobs.list()) == 1
+        assert self.fs.get(second_id).read() == FILE_CONTENT
+
+        self.fs.delete(second_id)
+        assert self.blobs.list() == []
+
+    def test_copy_shares_content(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        copy_id = self.fs.copy(file_id)
+        assert len(self.blobs.list()) == 1
+        assert self.fs.get(copy_id).filename == 'file.txt'
+
+        self.fs.delete(file_id)
+        assert self.fs.get(copy_id).read() == FILE_CONTENT
+        self.fs.delete(copy_id)
+        assert self.blobs.list() == []
+
+    def test_replace_releases_previous_content(self):
+        first_id = self.fs.create(FILE_CONTENT, 'first.txt')
+        second_id = self.fs.create(b'OTHER CONTENT', 'second.txt')
+        assert len(self.blobs.list()) == 2
+
+        self.fs.replace(second_id, FILE_CONTENT)
+        assert len(self.blobs.list()) == 1
+        assert self.fs.get(second_id).filename == 'second.txt'
+        assert self.fs.get(second_id).read() == FILE_CONTENT
+
+        # Replacing with the same content keeps it around.
+        self.fs.replace(first_id, self.fs.get(first_id))
+        assert len(self.blobs.list()) == 1
+        assert self.fs.get(first_id).read() == FILE_CONTENT
+
+    def test_unsupported_hash_algorithm(self):
+        with self.assertRaises(ValueError):
+            DeduplicatingFileStorage(self.blobs, './lfs/dedup.db', hash_algorithm='nothing')
+
+    def test_configure_wrapped_storage(self):
+        fs = DepotManager.from_config({
+            'depot.backend': 'depot.io.dedup.DeduplicatingFileStorage',
+            'depot.index_path': './lfs/config.db',
+            'depot.storage.backend': 'depot.io.local.LocalFileStorage',
+            'depot.storage.storage_path': './lfs/blobs'
+        })
+        assert fs._storage.storage_path == './lfs/blobs'
+
+        file_id = fs.create(FILE_CONTENT, 'file.txt')
+        assert fs.get(file_id).read() == FILE_CONTENT
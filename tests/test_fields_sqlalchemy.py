@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import shutil
 import unittest
+import mock
 import tempfile, os, cgi, base64
 from PIL import Image
 from sqlalchemy.exc import StatementError
@@ -205,6 +206,30 @@ class TestSQLAAttachments(SQLATestCase):
 
         assert not self.file_exists(old_file)
 
+    def test_delete_existing_in_bulk(self):
+        for name in ('Foo4', 'Foo5'):
+            doc = Document(name=name)
+            doc.content = of.open(self.fake_file.name, 'rb')
+            DBSession.add(doc)
+        self._session_flush()
+        DBSession.commit()
+        DBSession.remove()
+
+        docs = DBSession.query(Document).filter(Document.name.in_(['Foo4', 'Foo5'])).all()
+        old_files = [d.content.path for d in docs]
+        for d in docs:
+            DBSession.delete(d)
+
+        depot = DepotManager.get()
+        with mock.patch.object(depot, 'delete_many', wraps=depot.delete_many) as delete_many:
+            self._session_flush()
+            DBSession.commit()
+            DBSession.remove()
+        assert delete_many.call_count == 1, delete_many.call_args_list
+
+        for old_file in old_files:
+            assert not self.file_exists(old_file)
+
     def test_delete_existing_from_query(self):
         doc = Document(name='Foo2')
         doc.content = of.open(self.fake_file.name, 'rb')
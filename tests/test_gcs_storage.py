@@ -3,9 +3,12 @@ import os
 import uuid
 import json
 import requests
+import urllib3
 from flaky import flaky
 import unittest
-from google.cloud.exceptions import NotFound
+import mock
+from urllib.parse import urlparse, unquote, parse_qs
+from google.cloud.exceptions import NotFound, ServiceUnavailable
 
 from depot.io.gcs import GCSStorage
 
@@ -76,3 +79,273 @@ class TestGCSStorage(unittest.TestCase):
         assert stored_file.filename == filename
         assert stored_file.content_type == 'application/pdf'
         assert stored_file.read() == FILE_CONTENT
+
+
+class FakeGCSSession(requests.Session):
+    """Answers Google Cloud Storage JSON API requests from memory, recording them."""
+    is_mtls = False
+
+    def __init__(self):
+        super(FakeGCSSession, self).__init__()
+        self.objects = {}
+        self.requests = []
+        self.downloads = []
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        request = requests.Request(method, url).prepare()
+        url = urlparse(url)
+        self.requests.append((method, url.path))
+
+        parts = url.path.split('/')
+        if 'rewriteTo' in parts:
+            return self._rewrite(request, parts)
+        elif url.path.startswith('/download/'):
+            return self._download(request, parts, parse_qs(url.query), headers or {})
+        elif url.path.startswith('/upload/'):
+            # Multipart upload, with the object resource followed by its content.
+            resource, content = data.split(b'\r\n\r\n', 2)[1:]
+            resource = json.loads(resource.split(b'\r\n--')[0])
+            content = content.rsplit(b'\r\n--', 1)[0]
+            resource.update(bucket=parts[5], size=str(len(content)),
+                            generation=str(len(self.requests)))
+            self.objects[resource['name']] = (resource, content)
+            return self._response(request, resource)
+        elif parts[-2] == 'b':
+            return self._response(request, {'name': parts[-1]})
+        elif parts[-1] == 'o':
+            return self._response(request, self._list(parse_qs(url.query)))
+
+        stored = self.objects.get(unquote(parts[-1]))
+        if stored is None:
+            return self._response(request, {'error': {'code': 404, 'message': 'Not Found'}}, 404)
+        elif method == 'DELETE':
+            del self.objects[unquote(parts[-1])]
+            return self._response(request, {}, 204)
+        return self._response(request, stored[0])
+
+    def _rewrite(self, request, parts):
+        stored = self.objects.get(unquote(parts[6]))
+        if stored is None:
+            return self._response(request, {'error': {'code': 404, 'message': 'Not Found'}}, 404)
+
+        resource, content = stored
+        resource = dict(resource, bucket=parts[9], name=unquote(parts[11]))
+        self.objects[resource['name']] = (resource, content)
+        return self._response(request, {'done': True, 'resource': resource,
+                                        'objectSize': resource['size'],
+                                        'totalBytesRewritten': resource['size']})
+
+    def _download(self, request, parts, query, headers):
+        stored = self.objects.get(unquote(parts[-1]))
+        if stored is None:
+            return self._response(request, {'error': {'code': 404, 'message': 'Not Found'}}, 404)
+
+        resource, content = stored
+        generation = query.get('ifGenerationMatch', [resource['generation']])[0]
+        if generation != resource['generation']:
+            return self._response(request, {'error': {'code': 412,
+                                                      'message': 'Precondition Failed'}}, 412)
+
+        status = 200
+        headers = dict((name.lower(), value) for name, value in headers.items())
+        if 'range' in headers:
+            start, end = headers['range'].split('=')[1].split('-')
+            content = content[int(start):int(end) + 1]
+            status = 206
+        self.downloads.append(len(content))
+
+        response = requests.Response()
+        response.request = request
+        response.status_code = status
+        response.raw = urllib3.HTTPResponse(body=io.BytesIO(content), status=status,
+                                            preload_content=False)
+        return response
+
+    def _list(self, query):
+        # Objects are listed in pages, the page token is the last listed name.
+        names = sorted(name for name in self.objects
+                       if name.startswith(query.get('prefix', [''])[0])
+                       and name >= query.get('startOffset', [''])[0]
+                       and name > query.get('pageToken', [''])[0])
+        page = names[:int(query.get('maxResults', [1000])[0])]
+        response = {'items': [self.objects[name][0] for name in page]}
+        if len(page) < len(names):
+            response['nextPageToken'] = page[-1]
+        return response
+
+    def _response(self, request, body, status=200):
+        response = requests.Response()
+        response.request = request
+        response.status_code = status
+        response._content = json.dumps(body).encode('utf-8')
+        response.headers['content-type'] = 'application/json'
+        return response
+
+
+class TestGCSStorageRequests(unittest.TestCase):
+    def setUp(self):
+        from google.auth.credentials import AnonymousCredentials
+        from google.cloud.storage import Client
+
+        self.session = FakeGCSSession()
+        client = lambda **kw: Client(_http=self.session, **kw)
+        with mock.patch('depot.io.gcs.storage.Client', new=client):
+            self.fs = GCSStorage(project_id='test', credentials=AnonymousCredentials(),
+                                 bucket='filedepot-test', policy='private',
+                                 chunk_size='1024', read_ahead='2')
+
+    def test_get_single_request(self):
+        fid = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+
+        del self.session.requests[:]
+        f = self.fs.get(fid)
+        assert f.filename == 'file.txt'
+        assert f.content_length == len(FILE_CONTENT)
+        assert self.session.requests == [
+            ('GET', '/storage/v1/b/filedepot-test/o/%s' % fid)
+        ], self.session.requests
+
+    def test_read_small_file_single_request(self):
+        fid = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+
+        f = self.fs.get(fid)
+        assert b''.join(iter(lambda: f.read(4), b'')) == FILE_CONTENT
+        assert self.session.downloads == [len(FILE_CONTENT)]
+
+    def test_read_in_windows(self):
+        content = os.urandom(5000)
+        fid = self.fs.create(content, 'file.bin')
+
+        f = self.fs.get(fid)
+        assert b''.join(iter(lambda: f.read(256), b'')) == content
+        # Windows are downloaded in parallel, so they can complete in any order.
+        assert sorted(self.session.downloads) == [904, 1024, 1024, 1024, 1024]
+
+    def test_read_empty_file(self):
+        fid = self.fs.create(b'', 'file.txt')
+
+        assert self.fs.get(fid).read() == b''
+        assert self.session.downloads == [0]
+
+    def test_read_replaced_file(self):
+        fid = self.fs.create(FILE_CONTENT, 'file.txt')
+
+        f = self.fs.get(fid)
+        self.fs.replace(fid, b'NEW CONTENT')
+        assert f.read() == b'NEW CONTENT'
+
+    def test_read_big_replaced_file(self):
+        fid = self.fs.create(os.urandom(5000), 'file.bin')
+
+        f = self.fs.get(fid)
+        content = os.urandom(3000)
+        self.fs.replace(fid, content)
+        assert b''.join(iter(lambda: f.read(256), b'')) == content
+
+    def test_replaced_while_reading_in_windows(self):
+        fid = self.fs.create(os.urandom(5000), 'file.bin')
+
+        f = self.fs.get(fid)
+        f.read(256)
+        self.fs.replace(fid, os.urandom(5000))
+        with self.assertRaises(IOError):
+            while f.read(256):
+                pass
+
+    def test_replace_single_metadata_request(self):
+        fid = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+
+        del self.session.requests[:]
+        self.fs.replace(fid, b'NEW CONTENT')
+        assert self.session.requests == [
+            ('GET', '/storage/v1/b/filedepot-test/o/%s' % fid),
+            ('POST', '/upload/storage/v1/b/filedepot-test/o')
+        ], self.session.requests
+
+        f = self.fs.get(fid)
+        assert f.filename == 'file.txt'
+        assert f.content_type == 'text/plain'
+        assert self.session.objects[fid][1] == b'NEW CONTENT'
+
+    def _failing_upload(self):
+        # The first upload consumes part of the content before failing, like an interrupted one.
+        from google.cloud.storage import Blob
+        original_upload = Blob.upload_from_file
+        calls = []
+
+        def upload_from_file(blob, file_obj, **kwargs):
+            calls.append(file_obj)
+            if len(calls) == 1:
+                file_obj.read(5)
+                raise ServiceUnavailable('unavailable')
+            return original_upload(blob, file_obj, **kwargs)
+        return mock.patch.object(Blob, 'upload_from_file', autospec=True,
+                                 side_effect=upload_from_file)
+
+    def test_failed_upload_retried_from_start(self):
+        with self._failing_upload():
+            fid = self.fs.create(io.BytesIO(FILE_CONTENT), 'file.txt')
+        assert self.session.objects[fid][1] == FILE_CONTENT
+
+    def test_failed_upload_of_stream_that_cannot_rewind(self):
+        stream = mock.Mock(wraps=io.BytesIO(FILE_CONTENT), spec=['read', 'tell'])
+        with self._failing_upload():
+            with self.assertRaises(ServiceUnavailable):
+                self.fs.create(stream, 'file.txt')
+        assert self.session.objects == {}
+
+    def test_upload_stream_without_position(self):
+        stream = mock.Mock(wraps=io.BytesIO(FILE_CONTENT), spec=['read'])
+        fid = self.fs.create(stream, 'file.txt')
+        assert self.session.objects[fid][1] == FILE_CONTENT
+
+    def test_replace_missing_file(self):
+        fid = str(uuid.uuid1())
+        with self.assertRaises(IOError):
+            self.fs.replace(fid, b'NEW CONTENT')
+        assert self.session.requests[-1] == (
+            'GET', '/storage/v1/b/filedepot-test/o/%s' % fid
+        ), self.session.requests
+        assert self.session.objects == {}
+
+    def test_delete_many(self):
+        fids = [self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain') for _ in range(2)]
+        missing_fid = str(uuid.uuid1())
+
+        del self.session.requests[:]
+        self.fs.delete_many(fids + [missing_fid])
+        assert self.session.requests == [
+            ('DELETE', '/storage/v1/b/filedepot-test/o/%s' % fid)
+            for fid in fids + [missing_fid]
+        ], self.session.requests
+        assert self.session.objects == {}
+
+    def test_iter_ids_pages(self):
+        file_ids = sorted(self.fs.create(FILE_CONTENT) for _ in range(5))
+
+        del self.session.requests[:]
+        assert list(self.fs.iter_ids(page_size=2)) == file_ids
+        assert self.session.requests == [
+            ('GET', '/storage/v1/b/filedepot-test/o')
+        ] * 3, self.session.requests
+
+        assert list(self.fs.iter_ids(page_size=2, start_after=file_ids[2])) == file_ids[3:]
+
+    def test_copy_server_side(self):
+        fid = self.fs.create(FILE_CONTENT, 'file.txt', 'text/plain')
+
+        del self.session.requests[:]
+        copy_id = self.fs.copy(fid)
+        assert self.session.requests == [
+            ('POST', '/storage/v1/b/filedepot-test/o/%s/rewriteTo/b/filedepot-test/o/%s' % (
+                fid, copy_id))
+        ], self.session.requests
+
+        f = self.fs.get(copy_id)
+        assert f.filename == 'file.txt'
+        assert f.content_type == 'text/plain'
+        assert self.session.objects[copy_id][1] == FILE_CONTENT
+
+    def test_copy_missing_file(self):
+        with self.assertRaises(IOError):
+            self.fs.copy(str(uuid.uuid1()))
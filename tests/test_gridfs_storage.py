@@ -1,4 +1,7 @@
 import unittest
+import mock
+import gridfs
+from bson import ObjectId
 from depot.io.gridfs import GridFSStorage
 
 FILE_CONTENT = b'HELLO WORLD'
@@ -26,3 +29,38 @@ class TestGridFSFileStorage(unittest.TestCase):
 
         f = self.fs.get(str(fileid))
         assert f.read() == FILE_CONTENT
+
+
+class TestGridFSStorageRequests(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('depot.io.gridfs.MongoClient'), mock.patch('gridfs.GridFS') as GridFS:
+            self.fs = GridFSStorage('mongodb://localhost/gridfs_example', 'testfs')
+
+        self.gridfs = GridFS.return_value
+        self.gridfs.get.return_value = mock.Mock(filename='file.txt', content_type='text/plain',
+                                                 length=len(FILE_CONTENT), last_modified=None)
+        self.gridfs.put.side_effect = lambda content, _id, **kwargs: _id
+        self.fileid = '5f0c9b4b1d41c8a1b2c3d4e5'
+
+    def test_replace_single_metadata_query(self):
+        self.fs.replace(self.fileid, b'NEW CONTENT')
+        self.gridfs.get.assert_called_once_with(ObjectId(self.fileid))
+
+        put_options = self.gridfs.put.call_args.kwargs
+        assert put_options['filename'] == 'file.txt', put_options
+        assert put_options['content_type'] == 'text/plain', put_options
+
+    def test_replace_missing_file(self):
+        self.gridfs.get.side_effect = gridfs.errors.NoFile
+        with self.assertRaises(IOError):
+            self.fs.replace(self.fileid, b'NEW CONTENT')
+        assert self.gridfs.get.call_count == 1
+        assert not self.gridfs.put.called
+
+    def test_backup_without_metadata_query(self):
+        f = self.fs.get(self.fileid)
+        self.gridfs.get.reset_mock()
+
+        self.fs.replace(f, f)
+        assert not self.gridfs.get.called
+        assert self.gridfs.put.call_args.kwargs['_id'] == ObjectId(self.fileid)
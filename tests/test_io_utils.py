@@ -0,0 +1,122 @@
+import io
+import threading
+import unittest
+from depot.io.utils import _RangedReader, _PipedReader
+
+CONTENT = bytes(range(256)) * 40
+
+
+class TestRangedReader(unittest.TestCase):
+    def setUp(self):
+        self.requested = []
+        self.lock = threading.Lock()
+
+    def read_range(self, start, end):
+        with self.lock:
+            self.requested.append((start, end))
+        return CONTENT[start:end]
+
+    def test_read_all(self):
+        reader = _RangedReader(self.read_range, len(CONTENT), 1000, 4)
+        assert reader.read() == CONTENT
+        assert sorted(self.requested) == [(i, min(i + 1000, len(CONTENT)))
+                                          for i in range(0, len(CONTENT), 1000)]
+        assert reader.read() == b''
+        reader.close()
+
+    def test_read_in_chunks(self):
+        reader = _RangedReader(self.read_range, len(CONTENT), 1000, 2)
+        data = []
+        while True:
+            chunk = reader.read(333)
+            if not chunk:
+                break
+            assert len(chunk) <= 333
+            data.append(chunk)
+        assert b''.join(data) == CONTENT
+        reader.close()
+
+    def test_bounded_read_ahead(self):
+        reader = _RangedReader(self.read_range, len(CONTENT), 1000, 2)
+        reader.read(10)
+        reader.close()
+        assert len(self.requested) <= 3
+
+    def test_truncated_range(self):
+        reader = _RangedReader(lambda start, end: b'x', len(CONTENT), 1000, 2)
+        with self.assertRaises(IOError):
+            reader.read()
+        reader.close()
+
+    def test_empty(self):
+        reader = _RangedReader(self.read_range, 0, 1000, 2)
+        assert reader.read() == b''
+        assert self.requested == []
+
+
+class RecordingFile(io.BytesIO):
+    """BytesIO that records how much content has been read from it."""
+    def __init__(self, content, fail_at=None):
+        super(RecordingFile, self).__init__(content)
+        self.fail_at = fail_at
+        self.reads = 0
+
+    def read(self, n=-1):
+        if self.fail_at is not None and self.tell() >= self.fail_at:
+            raise IOError('Connection lost')
+        self.reads += 1
+        return super(RecordingFile, self).read(n)
+
+
+class TestPipedReader(unittest.TestCase):
+    def test_read_all(self):
+        reader = _PipedReader(RecordingFile(CONTENT), 1000, 2)
+        assert reader.read() == CONTENT
+        assert reader.tell() == len(CONTENT)
+        assert reader.read() == b''
+        reader.close()
+
+    def test_read_in_chunks(self):
+        reader = _PipedReader(RecordingFile(CONTENT), 1000, 2)
+        data = []
+        while True:
+            chunk = reader.read(333)
+            if not chunk:
+                break
+            assert len(chunk) <= 333
+            data.append(chunk)
+            assert reader.tell() == sum(map(len, data))
+        assert b''.join(data) == CONTENT
+        reader.close()
+
+    def test_bounded_read_ahead(self):
+        source = RecordingFile(CONTENT)
+        reader = _PipedReader(source, 1000, 2)
+        reader.read(10)
+        # Wait for the reader to fill all the buffers.
+        for _ in range(100):
+            if reader._chunks.full():
+                break
+            threading.Event().wait(0.01)
+        # One chunk being consumed, two buffered and one waiting for a free buffer.
+        assert source.reads <= 4, source.reads
+        reader.close()
+
+    def test_read_failure(self):
+        reader = _PipedReader(RecordingFile(CONTENT, fail_at=2000), 1000, 2)
+        assert reader.read(2000) == CONTENT[:2000]
+        with self.assertRaises(IOError):
+            reader.read()
+        reader.close()
+
+    def test_close_while_reading_ahead(self):
+        reader = _PipedReader(RecordingFile(CONTENT), 10, 1)
+        reader.read(5)
+        reader.close()
+        assert not reader._thread.is_alive()
+
+    def test_empty(self):
+        reader = _PipedReader(RecordingFile(b''), 1000, 2)
+        assert reader.read() == b''
+        assert reader.read(10) == b''
+        reader.close()
@@ -18,6 +18,26 @@ class TestLocalFileStorage(unittest.TestCase):
         with open(os.path.join('./lfs', file_id, 'file'), 'rb') as f:
             assert FILE_CONTENT == f.read()
 
+    def test_content_length_of_content_being_read(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        f = self.fs.get(file_id)
+        assert f.content_length == len(FILE_CONTENT)
+
+        # Replacing metadata before content leaves a moment where they don't match.
+        with open(os.path.join('./lfs', file_id, 'metadata.json')) as metadata:
+            assert '"content_length": %d' % len(FILE_CONTENT) in metadata.read()
+        self.fs.replace(file_id, b'NEW CONTENT WITH ANOTHER LENGTH')
+        assert f.content_length == len(FILE_CONTENT)
+        assert f.read() == FILE_CONTENT
+        f.close()
+
+        f = self.fs.get(file_id)
+        with open(os.path.join('./lfs', file_id, 'file'), 'wb') as content:
+            content.write(b'STALE')
+        assert f.content_length == len(b'STALE')
+        assert f.read() == b'STALE'
+        f.close()
+
     def test_corrupted_metadata(self):
         file_id = self.fs.create(FILE_CONTENT, 'file.txt')
         f = self.fs.get(file_id)
@@ -33,3 +53,202 @@ class TestLocalFileStorage(unittest.TestCase):
 
         assert did_detect_corrupted_metadata
 
+    def test_sharded_creation(self):
+        fs = LocalFileStorage('./lfs', shard_depth=2)
+        file_id = fs.create(FILE_CONTENT, 'file.txt')
+
+        hexid = file_id.replace('-', '')
+        file_path = os.path.join('./lfs', hexid[:2], hexid[2:4], file_id, 'file')
+        with open(file_path, 'rb') as f:
+            assert FILE_CONTENT == f.read()
+
+        assert fs.list() == [file_id]
+
+    def test_invalid_shard_depth(self):
+        with self.assertRaises(ValueError):
+            LocalFileStorage('./lfs', shard_depth=-1)
+
+    def test_flat_files_resolve_when_sharded(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+
+        fs = LocalFileStorage('./lfs', shard_depth=2)
+        assert fs.exists(file_id)
+        assert fs.get(file_id).read() == FILE_CONTENT
+        assert fs.list() == [file_id]
+
+        # Replacing happens in place, reshard moves the files.
+        fs.replace(file_id, b'NEW CONTENT')
+        assert fs.get(file_id).read() == b'NEW CONTENT'
+        assert os.path.exists(os.path.join('./lfs', file_id))
+
+        fs.delete(file_id)
+        assert not fs.exists(file_id)
+
+    def test_reshard(self):
+        flat_ids = [self.fs.create(FILE_CONTENT, 'file.txt') for _ in range(3)]
+
+        fs = LocalFileStorage('./lfs', shard_depth=2)
+        sharded_id = fs.create(FILE_CONTENT, 'file.txt')
+
+        assert fs.reshard() == 3
+        assert fs.reshard() == 0
+        assert sorted(fs.list()) == sorted(flat_ids + [sharded_id])
+        for file_id in flat_ids:
+            assert not os.path.exists(os.path.join('./lfs', file_id))
+            assert fs.get(file_id).read() == FILE_CONTENT
+
+        # Going back to flat layout removes the shard directories
+        assert self.fs.reshard() == 4
+        assert sorted(os.listdir('./lfs')) == sorted(flat_ids + [sharded_id])
+
+    def test_iter_ids_mixed_layout(self):
+        flat_ids = [self.fs.create(FILE_CONTENT, 'file.txt') for _ in range(10)]
+        fs = LocalFileStorage('./lfs', shard_depth=2)
+        sharded_ids = [fs.create(FILE_CONTENT, 'file.txt') for _ in range(10)]
+        file_ids = sorted(flat_ids + sharded_ids)
+
+        assert list(fs.iter_ids()) == file_ids
+        assert list(fs.iter_ids(start_after=file_ids[9])) == file_ids[10:]
+        assert list(fs.iter_ids(start_after=file_ids[-1])) == []
+
+    def test_iter_ids_invalid_start_after(self):
+        with self.assertRaises(ValueError):
+            list(self.fs.iter_ids(start_after='../INVALIDID'))
+
+    def test_iter_ids_metadata_index(self):
+        fs = LocalFileStorage('./lfs', metadata_index=True)
+        file_ids = sorted(fs.create(FILE_CONTENT, 'file.txt') for _ in range(5))
+
+        assert list(fs.iter_ids(page_size=2)) == file_ids
+        assert list(fs.iter_ids(page_size=2, start_after=file_ids[1])) == file_ids[2:]
+
+    def test_copy_links_data(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        copy_id = self.fs.copy(file_id)
+
+        file_path = os.path.join('./lfs', file_id, 'file')
+        copy_path = os.path.join('./lfs', copy_id, 'file')
+        assert os.path.samefile(file_path, copy_path)
+
+        # Replacing a file doesn't change its copies.
+        self.fs.replace(file_id, b'NEW CONTENT')
+        assert self.fs.get(copy_id).read() == FILE_CONTENT
+
+    def test_copy_to_other_storage(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        other = LocalFileStorage('./lfs/other', shard_depth=1, metadata_index=True)
+        assert self.fs.copy(file_id, other) == file_id
+
+        f = other.get(file_id)
+        assert f.filename == 'file.txt'
+        assert f.read() == FILE_CONTENT
+
+    def test_metadata_index(self):
+        fs = LocalFileStorage('./lfs', metadata_index=True)
+        file_id = fs.create(FILE_CONTENT, 'file.txt')
+        assert os.path.exists(os.path.join('./lfs', 'metadata.db'))
+
+        # Metadata is served by the index, not by the metadata file.
+        os.unlink(os.path.join('./lfs', file_id, 'metadata.json'))
+        f = fs.get(file_id)
+        assert f.filename == 'file.txt'
+        assert f.content_type == 'text/plain'
+        assert f.content_length == len(FILE_CONTENT)
+        assert f.last_modified is not None
+        assert f.read() == FILE_CONTENT
+
+        assert fs.exists(file_id)
+        assert fs.list() == [file_id]
+
+        fs.delete(file_id)
+        assert not fs.exists(file_id)
+        assert fs.list() == []
+
+    def test_metadata_index_option_from_config(self):
+        assert LocalFileStorage('./lfs', metadata_index='false')._index is None
+        assert LocalFileStorage('./lfs', metadata_index='true')._index is not None
+
+    def test_rebuild_metadata_index(self):
+        file_ids = [self.fs.create(FILE_CONTENT, 'file-%s.txt' % i) for i in range(3)]
+
+        fs = LocalFileStorage('./lfs', metadata_index=True)
+        assert fs.list() == []
+        assert not fs.exists(file_ids[0])
+
+        assert fs.rebuild_index() == 3
+        assert sorted(fs.list()) == sorted(file_ids)
+        f = fs.get(file_ids[1])
+        assert f.filename == 'file-1.txt'
+        assert f.last_modified == self.fs.get(file_ids[1]).last_modified
+
+    def test_rebuild_without_metadata_index(self):
+        with self.assertRaises(RuntimeError):
+            self.fs.rebuild_index()
+
+    def test_fileno(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        f = self.fs.get(file_id)
+
+        fd = f.fileno()
+        assert os.fstat(fd).st_size == len(FILE_CONTENT)
+        assert f.tell() == 0
+        assert f.read(5) == b'HELLO'
+        assert f.tell() == 5
+
+        f.close()
+        with self.assertRaises(ValueError):
+            f.fileno()
+
+    def test_getbuffer(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        f = self.fs.get(file_id)
+
+        buffer = f.getbuffer()
+        assert buffer.readonly
+        assert buffer[6:] == b'WORLD'
+        buffer.release()
+        f.close()
+
+    def test_getbuffer_empty_file(self):
+        file_id = self.fs.create(b'', 'file.txt')
+        assert self.fs.get(file_id).getbuffer() == b''
+
+    def test_copy_from_stored_file(self):
+        file_id = self.fs.create(FILE_CONTENT * 1024, 'file.txt')
+        copy_id = self.fs.create(self.fs.get(file_id))
+        assert self.fs.get(copy_id).read() == FILE_CONTENT * 1024
+
+    def test_replace_keeps_open_files_readable(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        f = self.fs.get(file_id)
+        assert f.read(5) == b'HELLO'
+
+        self.fs.replace(file_id, b'NEW CONTENT')
+        assert f.read() == b' WORLD'
+        assert self.fs.get(file_id).read() == b'NEW CONTENT'
+
+    def test_replace_with_own_content(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        self.fs.replace(file_id, self.fs.get(file_id))
+        assert self.fs.get(file_id).read() == FILE_CONTENT
+
+    def test_no_staging_leftovers(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        self.fs.replace(file_id, b'NEW CONTENT')
+        with self.assertRaises(TypeError):
+            self.fs.replace(file_id, u'unicode')
+        assert os.listdir('./lfs') == [file_id]
+        assert sorted(os.listdir(os.path.join('./lfs', file_id))) == ['file', 'metadata.json']
+
+        self.fs.delete(file_id)
+        assert os.listdir('./lfs') == []
+
+    def test_fsync_policies(self):
+        for policy in ('none', 'data', 'full'):
+            fs = LocalFileStorage('./lfs', fsync=policy)
+            file_id = fs.create(FILE_CONTENT, 'file.txt')
+            fs.replace(file_id, b'NEW CONTENT')
+            assert fs.get(file_id).read() == b'NEW CONTENT'
+
+        with self.assertRaises(ValueError):
+            LocalFileStorage('./lfs', fsync='always')
@@ -0,0 +1,136 @@
+import unittest
+from depot.io.memory import MemoryFileStorage
+
+FILE_CONTENT = b'HELLO WORLD'
+
+
+class TestMemoryFileStorage(unittest.TestCase):
+    def test_unbounded_by_default(self):
+        fs = MemoryFileStorage()
+        for _ in range(100):
+            fs.create(FILE_CONTENT)
+        assert fs.stats['files'] == 100
+        assert fs.stats['resident_bytes'] == 100 * len(FILE_CONTENT)
+        assert fs.stats['evictions'] == 0
+
+    def test_max_files_evicts_least_recently_used(self):
+        fs = MemoryFileStorage(max_files='2')
+        first_id = fs.create(FILE_CONTENT)
+        second_id = fs.create(FILE_CONTENT)
+
+        fs.get(first_id)
+        third_id = fs.create(FILE_CONTENT)
+
+        assert fs.exists(first_id)
+        assert not fs.exists(second_id)
+        assert fs.exists(third_id)
+        assert fs.stats['evictions'] == 1
+
+    def test_max_bytes(self):
+        fs = MemoryFileStorage(max_bytes=len(FILE_CONTENT) * 2)
+        file_ids = [fs.create(FILE_CONTENT) for _ in range(3)]
+
+        assert fs.list() == file_ids[1:]
+        assert fs.stats['resident_bytes'] == len(FILE_CONTENT) * 2
+
+        fs.replace(file_ids[1], b'X')
+        assert fs.stats['resident_bytes'] == len(FILE_CONTENT) + 1
+
+        fs.delete(file_ids[1])
+        assert fs.stats['resident_bytes'] == len(FILE_CONTENT)
+
+    def test_oversized_file_is_kept_until_next_store(self):
+        fs = MemoryFileStorage(max_bytes=5)
+        big_id = fs.create(FILE_CONTENT)
+        assert fs.get(big_id).read() == FILE_CONTENT
+
+        fs.create(b'SMALL')
+        assert not fs.exists(big_id)
+
+    def test_hits_and_misses(self):
+        fs = MemoryFileStorage(max_files=1)
+        first_id = fs.create(FILE_CONTENT)
+        f = fs.get(first_id)
+        fs.create(FILE_CONTENT)
+
+        with self.assertRaises(IOError):
+            fs.get(first_id)
+
+        assert fs.stats['hits'] == 1
+        assert fs.stats['misses'] == 1
+
+        # Evicted files that were already retrieved can still be read.
+        assert f.read() == FILE_CONTENT
+
+    def test_replace_is_not_a_hit(self):
+        fs = MemoryFileStorage()
+        file_id = fs.create(FILE_CONTENT, 'file.txt')
+        fs.replace(file_id, b'NEW CONTENT')
+
+        assert fs.stats['hits'] == 0
+        assert fs.stats['misses'] == 0
+        f = fs.get(file_id)
+        assert f.filename == 'file.txt'
+        assert f.read() == b'NEW CONTENT'
+        assert fs.stats['hits'] == 1
+
+    def test_whole_reads_share_stored_bytes(self):
+        fs = MemoryFileStorage()
+        content = FILE_CONTENT * 10
+        file_id = fs.create(content)
+        assert fs.get(file_id).read() is content
+
+        f = fs.get(file_id)
+        assert f.read(5) == b'HELLO'
+        assert f.read() == content[5:]
+        assert f.read() == b''
+
+    def test_mutable_content_is_copied(self):
+        fs = MemoryFileStorage()
+        content = bytearray(FILE_CONTENT)
+        file_id = fs.create(content)
+        content[:5] = b'HOLA!'
+        assert fs.get(file_id).read() == FILE_CONTENT
+
+    def test_memoryview_content(self):
+        fs = MemoryFileStorage()
+        content = FILE_CONTENT * 10
+        file_id = fs.create(memoryview(content))
+        assert fs.get(file_id).read() is content
+
+        file_id = fs.create(memoryview(content)[:5])
+        assert fs.get(file_id).read() == b'HELLO'
+
+    def test_evicted_files_can_be_read(self):
+        fs = MemoryFileStorage(max_files=1)
+        f = fs.get(fs.create(FILE_CONTENT))
+        fs.create(b'OTHER CONTENT')
+        assert f.read() == FILE_CONTENT
+
+    def test_getbuffer_is_readonly(self):
+        fs = MemoryFileStorage()
+        f = fs.get(fs.create(FILE_CONTENT))
+        buffer = f.getbuffer()
+        assert buffer.readonly
+        assert buffer[6:] == b'WORLD'
+        f.close()
+        with self.assertRaises(ValueError):
+            f.getbuffer()
+
+    def test_concurrent_writers(self):
+        import threading
+        fs = MemoryFileStorage(max_files=50)
+
+        def write():
+            for _ in range(200):
+                fs.create(FILE_CONTENT)
+
+        threads = [threading.Thread(target=write) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert fs.stats['files'] == 50
+        assert fs.stats['resident_bytes'] == 50 * len(FILE_CONTENT)
+        assert fs.stats['evictions'] == 750
@@ -0,0 +1,150 @@
+import os
+import shutil
+import unittest
+from unittest import mock
+
+from depot.io.memory import MemoryFileStorage
+from depot.migrate import migrate, main, read_checkpoint, write_checkpoint
+
+FILE_CONTENT = b'HELLO WORLD'
+
+
+class TestMigrate(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('./lfs', exist_ok=True)
+        self.checkpoint = './lfs/migrate.checkpoint'
+        self.source = MemoryFileStorage()
+        self.target = MemoryFileStorage()
+        self.file_ids = sorted(self.source.create(FILE_CONTENT * (i + 1), 'file%s.txt' % i)
+                               for i in range(10))
+
+    def tearDown(self):
+        shutil.rmtree('./lfs', ignore_errors=True)
+
+    def test_copies_all_files(self):
+        stats = migrate(self.source, self.target, workers=3, page_size=4)
+        assert sorted(self.target.list()) == self.file_ids
+        assert stats.copied == 10
+        assert stats.bytes == len(FILE_CONTENT) * 55
+        assert stats.failed == []
+
+        copied = self.target.get(self.file_ids[0])
+        assert copied.filename == 'file0.txt'
+        assert copied.read() == FILE_CONTENT
+
+    def test_reports_progress(self):
+        reports = []
+        stats = migrate(self.source, self.target, report=reports.append, report_interval=0)
+        assert reports[-1] is stats
+        assert stats.files_per_second > 0
+        assert stats.bytes_per_second > 0
+
+    def test_resumes_from_checkpoint(self):
+        stats = migrate(self.source, self.target, checkpoint=self.checkpoint)
+        assert read_checkpoint(self.checkpoint) == self.file_ids[-1]
+        assert stats.last_checkpoint == self.file_ids[-1]
+
+        write_checkpoint(self.checkpoint, self.file_ids[6])
+        with mock.patch.object(self.source, 'copy', wraps=self.source.copy) as copy:
+            stats = migrate(self.source, self.target, checkpoint=self.checkpoint)
+
+        assert sorted(call.args[0] for call in copy.call_args_list) == self.file_ids[7:]
+        assert stats.copied == 3
+        assert read_checkpoint(self.checkpoint) == self.file_ids[-1]
+
+    def test_failures_stop_checkpoint(self):
+        failing_id = self.file_ids[3]
+        original_copy = self.source.copy
+
+        def _copy(file_or_id, target_storage=None):
+            if file_or_id == failing_id:
+                raise IOError('Unable to copy %s' % file_or_id)
+            return original_copy(file_or_id, target_storage)
+
+        with mock.patch.object(self.source, 'copy', side_effect=_copy):
+            stats = migrate(self.source, self.target, workers=2, checkpoint=self.checkpoint)
+
+        assert [fid for fid, exc in stats.failed] == [failing_id]
+        assert stats.copied == 9
+        assert read_checkpoint(self.checkpoint) == self.file_ids[2]
+
+        stats = migrate(self.source, self.target, checkpoint=self.checkpoint)
+        assert stats.copied == 7
+        assert sorted(self.target.list()) == self.file_ids
+
+    def test_verify(self):
+        stats = migrate(self.source, self.target, verify='checksum')
+        assert stats.failed == []
+
+        def _corrupted_copy(file_or_id, target_storage=None):
+            content = b'X' * self.source.get(file_or_id).content_length
+            if file_or_id == self.file_ids[0]:
+                content = content[:-1]
+            target_storage.replace(file_or_id, content)
+            return file_or_id
+
+        with mock.patch.object(self.source, 'copy', side_effect=_corrupted_copy):
+            stats = migrate(self.source, self.target, verify='none')
+        assert stats.failed == []
+
+        with mock.patch.object(self.source, 'copy', side_effect=_corrupted_copy):
+            stats = migrate(self.source, self.target, verify='length')
+        assert [fid for fid, exc in stats.failed] == self.file_ids[:1]
+
+        with mock.patch.object(self.source, 'copy', side_effect=_corrupted_copy):
+            stats = migrate(self.source, self.target, verify='checksum')
+        assert len(stats.failed) == 10
+
+    def test_target_with_incompatible_ids(self):
+        with mock.patch.object(self.target, 'exists', side_effect=ValueError('Invalid file id')):
+            with mock.patch.object(self.target, 'replace') as replace:
+                with self.assertRaises(ValueError):
+                    migrate(self.source, self.target)
+        assert replace.call_count == 0
+
+    def test_empty_source(self):
+        stats = migrate(MemoryFileStorage(), self.target)
+        assert stats.copied == 0
+
+    def test_invalid_verify(self):
+        with self.assertRaises(AssertionError):
+            migrate(self.source, self.target, verify='nope')
+
+
+class TestMigrateCommand(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('./lfs', exist_ok=True)
+        self.config = './lfs/migrate.ini'
+        with open(self.config, 'w') as f:
+            f.write('[app:main]\n'
+                    'depot.old.storage_path = ./lfs/old\n'
+                    'depot.new.storage_path = ./lfs/new\n'
+                    'depot.new.metadata_index = true\n')
+
+    def tearDown(self):
+        shutil.rmtree('./lfs', ignore_errors=True)
+
+    def test_migrates_storages_from_config(self):
+        from depot.io.local import LocalFileStorage
+        source = LocalFileStorage('./lfs/old')
+        file_id = source.create(FILE_CONTENT, 'file.txt')
+
+        status = main([self.config, '--source', 'depot.old.', '--target', 'depot.new.', '--workers', '2',
+                       '--checkpoint', './lfs/checkpoint'])
+        assert status == 0
+        assert LocalFileStorage('./lfs/new').get(file_id).read() == FILE_CONTENT
+        assert read_checkpoint('./lfs/checkpoint') == file_id
+
+    def test_target_with_incompatible_ids(self):
+        from depot.io.local import LocalFileStorage
+        file_id = LocalFileStorage('./lfs/old').create(FILE_CONTENT, 'file.txt')
+
+        with mock.patch('depot.io.local.LocalFileStorage.exists',
+                        side_effect=ValueError('Invalid file id')):
+            status = main([self.config, '--source', 'depot.old.', '--target', 'depot.new.'])
+        assert status == 1
+        assert not os.path.exists(os.path.join('./lfs/new', file_id))
+
+    def test_missing_section(self):
+        with self.assertRaises(SystemExit):
+            main([self.config, '--section', 'app:other', '--source', 'depot.old.', '--target', 'depot.new.'])
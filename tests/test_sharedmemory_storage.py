@@ -0,0 +1,104 @@
+import os
+import sys
+import uuid
+import unittest
+import subprocess
+from depot.io.sharedmemory import SharedMemoryFileStorage
+
+FILE_CONTENT = b'HELLO WORLD'
+
+
+class TestSharedMemoryFileStorage(unittest.TestCase):
+    def setUp(self):
+        self.name = 'depot-test-%s' % os.getpid()
+        self.fs = SharedMemoryFileStorage(self.name, max_files=4)
+
+    def tearDown(self):
+        self.fs.destroy()
+
+    def test_files_outlive_writer_process(self):
+        code = ('from depot.io.sharedmemory import SharedMemoryFileStorage;'
+                'fs = SharedMemoryFileStorage(%r);'
+                'print(fs.create(%r, "file.txt"))' % (self.name, FILE_CONTENT))
+        output = subprocess.check_output([sys.executable, '-c', code])
+        file_id = output.decode('ascii').strip()
+
+        f = self.fs.get(file_id)
+        assert f.filename == 'file.txt'
+        assert f.read() == FILE_CONTENT
+
+    def test_storages_with_same_name_share_files(self):
+        other = SharedMemoryFileStorage(self.name)
+        assert other.max_files == 4
+
+        file_id = self.fs.create(FILE_CONTENT)
+        assert other.get(file_id).read() == FILE_CONTENT
+
+        other.replace(file_id, b'NEW CONTENT')
+        assert self.fs.get(file_id).read() == b'NEW CONTENT'
+
+        other.delete(file_id)
+        assert not self.fs.exists(file_id)
+
+    def test_full_storage(self):
+        for _ in range(4):
+            self.fs.create(FILE_CONTENT)
+        with self.assertRaises(IOError):
+            self.fs.create(FILE_CONTENT)
+        assert len(self.fs.list()) == 4
+
+    def test_deleted_slots_are_reused(self):
+        for _ in range(10):
+            file_id = self.fs.create(FILE_CONTENT)
+            self.fs.delete(file_id)
+
+        file_ids = [self.fs.create(FILE_CONTENT) for _ in range(4)]
+        assert sorted(self.fs.list()) == sorted(file_ids)
+        for file_id in file_ids:
+            assert self.fs.get(file_id).read() == FILE_CONTENT
+
+    def test_read_after_delete(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        f = self.fs.get(file_id)
+        assert f.read(5) == FILE_CONTENT[:5]
+
+        self.fs.delete(file_id)
+        assert f.read() == FILE_CONTENT[5:]
+        f.close()
+
+    def test_segment_names_are_short(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        key = uuid.UUID(file_id).bytes
+        token = 0xffffffff
+        # The name is prefixed with a slash, macOS allows at most 31 characters.
+        assert len('/' + self.fs._segment_name(key, token)) <= 31
+        assert self.fs._segment_name(key, token) != self.fs._segment_name(key, token - 1)
+
+        other = SharedMemoryFileStorage('%s-other' % self.name)
+        self.addCleanup(other.destroy)
+        assert self.fs._segment_name(key, token) != other._segment_name(key, token)
+
+    def test_destroy_closes_lock_file(self):
+        other = SharedMemoryFileStorage(self.name)
+        other.destroy()
+        assert other._lock_file.closed
+
+    def test_read_replaced_file(self):
+        file_id = self.fs.create(FILE_CONTENT)
+        f = self.fs.get(file_id)
+        self.fs.replace(file_id, b'NEW CONTENT WITH ANOTHER LENGTH')
+        assert f.read() == b'NEW CONTENT WITH ANOTHER LENGTH'
+
+    def test_close_with_buffers_in_use(self):
+        f = self.fs.get(self.fs.create(FILE_CONTENT))
+        buffer = f.getbuffer()
+        segment = f._segment
+
+        f.close()
+        assert segment._fd == -1
+        assert buffer == FILE_CONTENT
+        buffer.release()
+
+    def test_too_big_metadata(self):
+        with self.assertRaises(ValueError):
+            self.fs.create(FILE_CONTENT, 'x' * 2048)
@@ -138,6 +138,39 @@ class BaseStorageTestFixture(object):
         finally:
             self.delete_storage(other_storage)
 
+    def test_copy(self):
+        file_id = self.fs.create(FILE_CONTENT, filename='file.txt', content_type='text/plain')
+
+        copy_id = self.fs.copy(file_id)
+        assert copy_id != file_id
+        self.fs.replace(file_id, b'NEW CONTENT')
+
+        f = self.fs.get(copy_id)
+        assert f.read() == FILE_CONTENT
+        assert f.filename == 'file.txt'
+        assert f.content_type == 'text/plain'
+        assert self.fs.get(file_id).read() == b'NEW CONTENT'
+
+    def test_copy_to_other_storage_keeps_id(self):
+        file_id = self.fs.create(FILE_CONTENT, filename='file.txt', content_type='text/plain')
+
+        other_storage = self.get_storage("otherbucket-%s" % uuid.uuid1().hex)
+        try:
+            assert self.fs.copy(self.fs.get(file_id), other_storage) == file_id
+
+            f = other_storage.get(file_id)
+            assert f.read() == FILE_CONTENT
+            assert f.filename == 'file.txt'
+            assert f.content_type == 'text/plain'
+        finally:
+            self.delete_storage(other_storage)
+
+    def test_copy_missing_file(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        self.fs.delete(file_id)
+        with self.assertRaises(IOError):
+            self.fs.copy(file_id)
+
     def test_backup(self):
         file_ids = set()
         for i in range(10):
@@ -219,6 +252,19 @@ class BaseStorageTestFixture(object):
         for _id in file_ids:
             assert _id in existing_files, ("{0} not in {1}".format(_id, file_ids))
 
+    def test_iter_ids(self):
+        file_ids = [self.fs.create(FILE_CONTENT, 'file_for_iter-{0}.txt'.format(i))
+                    for i in range(3)]
+
+        existing_ids = list(self.fs.iter_ids(page_size=2))
+        assert existing_ids == sorted(existing_ids), existing_ids
+        assert len(existing_ids) == len(set(existing_ids)), existing_ids
+        for _id in file_ids:
+            assert _id in existing_ids, ("{0} not in {1}".format(_id, existing_ids))
+
+        resumed_ids = list(self.fs.iter_ids(page_size=2, start_after=existing_ids[0]))
+        assert resumed_ids == existing_ids[1:], resumed_ids
+
     def test_exists_invalidid(self):
         with self.assertRaises(ValueError):
             self.fs.exists('INVALIDID')
@@ -242,6 +288,22 @@ class BaseStorageTestFixture(object):
         with self.assertRaises(ValueError):
             self.fs.delete('INVALIDID')
 
+    def test_delete_many(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        other_file = self.fs.get(self.fs.create(FILE_CONTENT, 'other.txt'))
+        kept_id = self.fs.create(FILE_CONTENT, 'kept.txt')
+
+        self.fs.delete(file_id)
+        self.fs.delete_many([file_id, other_file])
+        assert not self.fs.exists(file_id)
+        assert not self.fs.exists(other_file.file_id)
+        assert self.fs.exists(kept_id)
+
+    def test_delete_many_invalidid(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        with self.assertRaises(ValueError):
+            self.fs.delete_many(['INVALIDID', file_id])
+
     def test_stored_files_are_only_readable(self):
         file_id = self.fs.create(FILE_CONTENT, 'file.txt')
         f = self.fs.get(file_id)
@@ -277,6 +339,19 @@ class BaseStorageTestFixture(object):
         with self.assertRaises(ValueError):
             f.read()
 
+    def test_readinto(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        f = self.fs.get(file_id)
+
+        buffer = bytearray(6)
+        chunks = []
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            chunks.append(bytes(buffer[:read]))
+        assert chunks == [b'HELLO ', b'WORLD'], chunks
+
     def test_name_is_an_alias_for_filename(self):
         file_id = self.fs.create(FILE_CONTENT, 'file.txt')
         f = self.fs.get(file_id)
@@ -305,6 +380,96 @@ class TestLocalFileStorage(unittest.TestCase, BaseStorageTestFixture):
         self.delete_storage(self.fs)
 
 
+class TestShardedLocalFileStorage(TestLocalFileStorage):
+    @classmethod
+    def get_storage(cls, bucket_name):
+        from depot.io.local import LocalFileStorage
+        return LocalFileStorage('./lfs/%s' % bucket_name, shard_depth=2)
+
+
+class TestIndexedLocalFileStorage(TestLocalFileStorage):
+    @classmethod
+    def get_storage(cls, bucket_name):
+        from depot.io.local import LocalFileStorage
+        return LocalFileStorage('./lfs/%s' % bucket_name, metadata_index=True)
+
+
+class TestDeduplicatingFileStorage(unittest.TestCase, BaseStorageTestFixture):
+    @classmethod
+    def get_storage(cls, bucket_name):
+        from depot.io.memory import MemoryFileStorage
+        from depot.io.dedup import DeduplicatingFileStorage
+        return DeduplicatingFileStorage(MemoryFileStorage(), './lfs/%s/dedup.db' % bucket_name)
+
+    @classmethod
+    def delete_storage(cls, storage):
+        shutil.rmtree('./lfs', ignore_errors=True)
+
+    def setUp(self):
+        self.fs = self.get_storage("default_bucket")
+
+    def tearDown(self):
+        self.delete_storage(self.fs)
+
+
+class TestCachedFileStorage(unittest.TestCase, BaseStorageTestFixture):
+    @classmethod
+    def get_storage(cls, bucket_name):
+        from depot.io.memory import MemoryFileStorage
+        from depot.io.local import LocalFileStorage
+        from depot.io.cached import CachedFileStorage
+        return CachedFileStorage(MemoryFileStorage(),
+                                 LocalFileStorage('./lfs/%s' % bucket_name),
+                                 max_bytes=1024)
+
+    @classmethod
+    def delete_storage(cls, storage):
+        shutil.rmtree('./lfs', ignore_errors=True)
+
+    def setUp(self):
+        self.fs = self.get_storage("default_bucket")
+
+    def tearDown(self):
+        self.delete_storage(self.fs)
+
+
+class TestMetadataCachedFileStorage(unittest.TestCase, BaseStorageTestFixture):
+    @classmethod
+    def get_storage(cls, bucket_name):
+        from depot.io.local import LocalFileStorage
+        from depot.io.cached import MetadataCachedFileStorage
+        return MetadataCachedFileStorage(LocalFileStorage('./lfs/%s' % bucket_name))
+
+    @classmethod
+    def delete_storage(cls, storage):
+        shutil.rmtree('./lfs', ignore_errors=True)
+
+    def setUp(self):
+        self.fs = self.get_storage("default_bucket")
+
+    def tearDown(self):
+        self.delete_storage(self.fs)
+
+
+class TestWriteBehindFileStorage(unittest.TestCase, BaseStorageTestFixture):
+    @classmethod
+    def get_storage(cls, bucket_name):
+        from depot.io.memory import MemoryFileStorage
+        from depot.io.writebehind import WriteBehindFileStorage
+        return WriteBehindFileStorage(MemoryFileStorage(), './lfs/%s' % bucket_name)
+
+    @classmethod
+    def delete_storage(cls, storage):
+        storage.shutdown()
+        shutil.rmtree('./lfs', ignore_errors=True)
+
+    def setUp(self):
+        self.fs = self.get_storage("default_bucket")
+
+    def tearDown(self):
+        self.delete_storage(self.fs)
+
+
 class TestGridFSFileStorage(unittest.TestCase, BaseStorageTestFixture):
     @classmethod
     def get_storage(cls, collection_name):
@@ -420,6 +585,33 @@ class TestMemoryFileStorage(unittest.TestCase, BaseStorageTestFixture):
     def setUp(self):
         self.fs = self.get_storage(None)
 
+    def test_getbuffer(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        f = self.fs.get(file_id)
+        assert f.getbuffer() == FILE_CONTENT
+
+    def tearDown(self):
+        self.delete_storage(self.fs)
+
+
+class TestSharedMemoryFileStorage(unittest.TestCase, BaseStorageTestFixture):
+    @classmethod
+    def get_storage(cls, bucket_name):
+        from depot.io.sharedmemory import SharedMemoryFileStorage
+        return SharedMemoryFileStorage('depot-test-%s-%s' % (os.getpid(), bucket_name))
+
+    @classmethod
+    def delete_storage(cls, storage):
+        storage.destroy()
+
+    def setUp(self):
+        self.fs = self.get_storage("default_bucket")
+
+    def test_getbuffer(self):
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+        f = self.fs.get(file_id)
+        assert f.getbuffer() == FILE_CONTENT
+
     def tearDown(self):
         self.delete_storage(self.fs)
 
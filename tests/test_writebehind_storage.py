@@ -0,0 +1,172 @@
+import atexit
+import fcntl
+import gc
+import os
+import shutil
+import threading
+import unittest
+import weakref
+import mock
+from depot.io.memory import MemoryFileStorage
+from depot.io.writebehind import WriteBehindFileStorage
+
+FILE_CONTENT = b'HELLO WORLD'
+
+
+class TestWriteBehindFileStorage(unittest.TestCase):
+    def setUp(self):
+        self.remote = MemoryFileStorage()
+        self.fs = WriteBehindFileStorage(self.remote, './lfs', retry_delay=0)
+
+    def tearDown(self):
+        self.fs.shutdown()
+        shutil.rmtree('./lfs', ignore_errors=True)
+
+    def block_uploads(self):
+        unblock = threading.Event()
+        remote_replace = self.remote.replace
+
+        def blocked_replace(*args, **kwargs):
+            unblock.wait()
+            return remote_replace(*args, **kwargs)
+
+        patcher = mock.patch.object(self.remote, 'replace', side_effect=blocked_replace)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return unblock
+
+    def test_uploaded_files_keep_last_modified(self):
+        unblock = self.block_uploads()
+        with mock.patch('depot.io.utils.timestamp', return_value='2001-01-01 00:00:01'):
+            file_id = self.fs.create(FILE_CONTENT)
+        staged_last_modified = self.fs.get(file_id).last_modified
+
+        unblock.set()
+        self.fs.flush()
+        assert self.remote.get(file_id).last_modified == staged_last_modified
+        assert self.fs.get(file_id).last_modified == staged_last_modified
+
+    def test_files_served_from_staging_until_uploaded(self):
+        unblock = self.block_uploads()
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+
+        assert not self.remote.exists(file_id)
+        assert self.fs.exists(file_id)
+        assert file_id in self.fs.list()
+        f = self.fs.get(file_id)
+        assert f.filename == 'file.txt'
+        assert f.read() == FILE_CONTENT
+
+        unblock.set()
+        self.fs.flush()
+        assert self.remote.get(file_id).read() == FILE_CONTENT
+        assert self.fs.staging.list() == []
+        assert self.fs.get(file_id).read() == FILE_CONTENT
+
+    def test_staged_file_readable_after_upload(self):
+        unblock = self.block_uploads()
+        file_id = self.fs.create(FILE_CONTENT)
+
+        f = self.fs.get(file_id)
+        assert f.read(5) == FILE_CONTENT[:5]
+        unblock.set()
+        self.fs.flush()
+        assert f.read() == FILE_CONTENT[5:]
+
+    def test_failed_uploads_are_retried(self):
+        remote_replace = self.remote.replace
+        failures = [IOError('unavailable'), IOError('unavailable')]
+
+        def flaky_replace(*args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return remote_replace(*args, **kwargs)
+
+        with mock.patch.object(self.remote, 'replace', side_effect=flaky_replace) as replace:
+            file_id = self.fs.create(FILE_CONTENT)
+            self.fs.flush()
+        assert replace.call_count == 3
+        assert self.remote.exists(file_id)
+
+    def test_failed_uploads_are_kept_staged(self):
+        with mock.patch.object(self.remote, 'replace', side_effect=IOError('unavailable')):
+            file_id = self.fs.create(FILE_CONTENT)
+            self.fs.flush()
+        assert not self.remote.exists(file_id)
+        assert self.fs.get(file_id).read() == FILE_CONTENT
+        assert list(self.fs.failed) == [file_id]
+        assert str(self.fs.failed[file_id]) == 'unavailable'
+
+        self.fs.replace(file_id, b'NEW CONTENT')
+        self.fs.flush()
+        assert self.remote.get(file_id).read() == b'NEW CONTENT'
+        assert self.fs.failed == {}
+
+    def test_staged_files_uploaded_on_startup(self):
+        with mock.patch.object(self.remote, 'replace', side_effect=IOError('unavailable')):
+            file_id = self.fs.create(FILE_CONTENT)
+            self.fs.flush()
+
+        fs = WriteBehindFileStorage(self.remote, './lfs')
+        fs.shutdown()
+        assert self.remote.get(file_id).read() == FILE_CONTENT
+        assert fs.staging.list() == []
+
+    def test_claimed_files_skipped_by_other_processes(self):
+        with mock.patch.object(self.remote, 'replace', side_effect=IOError('unavailable')):
+            file_id = self.fs.create(FILE_CONTENT)
+            self.fs.flush()
+
+        # Simulate another process sharing the staging area uploading the file.
+        with open(os.path.join('./lfs', '.claims', file_id), 'a') as claim:
+            fcntl.flock(claim, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fs = WriteBehindFileStorage(self.remote, './lfs')
+            fs.flush()
+            assert not self.remote.exists(file_id)
+            assert fs.staging.list() == [file_id]
+            assert fs.get(file_id).read() == FILE_CONTENT
+
+        fs.replace(file_id, b'NEW CONTENT')
+        fs.shutdown()
+        assert self.remote.get(file_id).read() == b'NEW CONTENT'
+        assert fs.staging.list() == []
+        assert os.listdir('./lfs/.claims') == []
+
+    def test_flushed_at_exit_without_being_kept_alive(self):
+        with mock.patch.object(atexit, 'register') as register:
+            fs = WriteBehindFileStorage(self.remote, './lfs')
+        flush_at_exit, = register.call_args.args
+
+        file_id = fs.create(FILE_CONTENT)
+        flush_at_exit()
+        assert self.remote.exists(file_id)
+
+        fs_ref = weakref.ref(fs)
+        del fs
+        gc.collect()
+        assert fs_ref() is None
+        flush_at_exit()
+
+    def test_shutdown_unregisters_flush_at_exit(self):
+        with mock.patch.object(atexit, 'unregister') as unregister:
+            self.fs.shutdown()
+        unregister.assert_called_once_with(self.fs._flush_at_exit)
+
+    def test_delete_pending_upload(self):
+        unblock = self.block_uploads()
+        file_id = self.fs.create(FILE_CONTENT)
+
+        threading.Timer(0.1, unblock.set).start()
+        self.fs.delete(file_id)
+        assert not self.fs.exists(file_id)
+        assert not self.remote.exists(file_id)
+
+    def test_replace_pending_upload(self):
+        unblock = self.block_uploads()
+        file_id = self.fs.create(FILE_CONTENT, 'file.txt')
+
+        threading.Timer(0.1, unblock.set).start()
+        self.fs.replace(file_id, b'NEW CONTENT')
+        f = self.remote.get(file_id)
+        assert f.read() == b'NEW CONTENT'
+        assert f.filename == 'file.txt'
@@ -7,9 +7,11 @@ import shutil
 import time as time_module
 import json
 import uuid
+import mock
 from urllib.parse import parse_qs, unquote
 from depot.middleware import FileServeApp, _FileIter
 from depot.manager import DepotManager
+from depot.io.memory import MemoryFileStorage
 from webtest import TestApp
 
 
@@ -177,6 +179,74 @@ class TestWSGIMiddleware(BaseWSGITests):
         missing = app.get('/depot/nodepot/hello', status=404)
         assert 'Not Found' in missing.status
 
+    def test_404_on_lazily_missing_file(self):
+        app = self.make_app()
+        depot = DepotManager.get()
+
+        class LazyMissingFile(object):
+            public_url = None
+
+            @property
+            def filename(self):
+                raise IOError('File not existing')
+
+        with mock.patch.object(depot, 'get', return_value=LazyMissingFile()):
+            app.get('/depot/default/%s' % uuid.uuid1(), status=404)
+
+    def test_404_are_remembered(self):
+        app = self.make_app(not_found_cache_ttl=5)
+        file_id = str(uuid.uuid1())
+        depot = DepotManager.get()
+
+        with mock.patch.object(depot, 'get', wraps=depot.get) as depot_get:
+            app.get('/depot/default/%s' % file_id, status=404)
+            app.get('/depot/default/%s' % file_id, status=404)
+            app.get('/depot/default/hello', status=404)
+            app.get('/depot/default/hello', status=404)
+        assert depot_get.call_count == 2
+
+    def test_404_are_remembered_per_depot(self):
+        app = self.make_app(not_found_cache_ttl=5)
+        DepotManager.configure('other', {'depot.backend': 'depot.io.memory.MemoryFileStorage'})
+        file_id = DepotManager.get('other').create(FILE_CONTENT)
+
+        app.get('/depot/default/%s' % file_id, status=404)
+        app.get('/depot/other/hello', status=404)
+        assert app.get('/depot/other/%s' % file_id).body == FILE_CONTENT
+
+    def test_404_not_remembered_by_default(self):
+        app = self.make_app()
+        depot = DepotManager.get()
+        file_id = depot.create(FILE_CONTENT)
+        backup_depot = MemoryFileStorage()
+        stored = depot.get(file_id)
+        backup_depot.replace(stored, stored)
+        depot.delete(file_id)
+
+        app.get('/depot/default/%s' % file_id, status=404)
+        backup = backup_depot.get(file_id)
+        depot.replace(backup, backup)
+        assert app.get('/depot/default/%s' % file_id).body == FILE_CONTENT
+
+    def test_404_cache_expires(self):
+        app = self.make_app(not_found_cache_ttl=1)
+        depot = DepotManager.get()
+
+        with mock.patch.object(depot, 'get', wraps=depot.get) as depot_get:
+            app.get('/depot/default/hello', status=404)
+            with mock.patch('time.monotonic', return_value=time_module.monotonic() + 2):
+                app.get('/depot/default/hello', status=404)
+        assert depot_get.call_count == 2
+
+    def test_404_cache_disabled(self):
+        app = self.make_app(not_found_cache_ttl=0)
+        depot = DepotManager.get()
+
+        with mock.patch.object(depot, 'get', wraps=depot.get) as depot_get:
+            app.get('/depot/default/hello', status=404)
+            app.get('/depot/default/hello', status=404)
+        assert depot_get.call_count == 2
+
     def test_invalid_unmodified_header(self):
         app = self.make_app()
         new_file = app.post('/create_file').json
@@ -196,6 +266,24 @@ class TestWSGIMiddleware(BaseWSGITests):
         assert uploaded_file.body == FILE_CONTENT
         assert uploaded_file.request.environ['wsgi.file_wrapper'] is _FileIter
 
+    def test_server_file_wrapper_can_sendfile(self):
+        sent = []
+        def sendfile_wrapper(filelike, block_size):
+            # Mimics WSGI servers that send files through their descriptor.
+            fd = filelike.fileno()
+            sent.append(os.fstat(fd).st_size)
+            data = os.pread(fd, sent[-1], 0)
+            filelike.close()
+            return [data]
+
+        app = self.make_app()
+        new_file = app.post('/create_file').json
+
+        uploaded_file = app.get(DepotManager.url_for('%(uploaded_to)s/%(last)s' % new_file),
+                                extra_environ={'wsgi.file_wrapper': sendfile_wrapper})
+        assert uploaded_file.body == FILE_CONTENT
+        assert sent == [len(FILE_CONTENT)]
+
     def test_wsgi_file_wrapper_is_an_iterator(self):
         file_iter = _FileIter(io.BytesIO(FILE_CONTENT), 5)
 